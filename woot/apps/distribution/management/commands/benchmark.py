@@ -0,0 +1,128 @@
+#django
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+#local
+from apps.distribution.models import Project, Job
+from apps.distribution.tasks import scan_data
+from apps.transcription.models import Grammar, Transcription, Revision, WavFile
+from apps.transcription.processing import process_transcriptions
+from apps.users.models import User
+from libs.corpus import generate_corpus
+
+#util
+from optparse import make_option
+from subprocess import check_output, CalledProcessError
+import datetime
+import platform
+import resource
+import json
+import time
+
+#command
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--clients', action='store', type='int', dest='clients', default=1, help='Number of clients in the corpus'),
+    make_option('--projects', action='store', type='int', dest='projects', default=1, help='Number of projects per client'),
+    make_option('--grammars', action='store', type='int', dest='grammars', default=4, help='Number of grammars per project'),
+    make_option('--transcriptions', action='store', type='int', dest='transcriptions', default=250, help='Number of transcriptions per grammar'),
+    make_option('--alaw', action='store', type='float', dest='alaw', default=0.5, help='Fraction of wav files in A-law, the rest are 16-bit PCM'),
+    make_option('--seed', action='store', type='int', dest='seed', default=0, help='Seed of the corpus generator'),
+    make_option('--workers', action='store', type='int', dest='workers', default=1, help='Number of processes analysing audio'),
+    make_option('--output', action='store', dest='output', default='benchmark.json', help='File the results are written to'),
+  )
+  args = '<none>'
+  help = 'Generate a synthetic corpus and time each ingestion stage against SQLite. Run with --settings=woot.settings.bench.'
+
+  def handle(self, *args, **options):
+    if connection.vendor!='sqlite' or not hasattr(settings, 'BENCH_ROOT'):
+      raise CommandError('the benchmark fills the database with synthetic data, run it with --settings=woot.settings.bench')
+
+    call_command('migrate', interactive=False, verbosity=0)
+    if Project.objects.exists():
+      raise CommandError('%s is not empty, unset BENCH_ROOT to use a new database' % settings.DATABASES['default']['NAME'])
+
+    corpus = {key:options[key] for key in ['clients', 'projects', 'grammars', 'transcriptions', 'alaw', 'seed']}
+    self.stages = []
+
+    self.measure('generate', lambda: generate_corpus(settings.BENCH_DATA_DIR, **corpus)['wav_files'])
+    self.measure('scan_data', self.scan)
+    self.measure('Grammar.process', self.process_grammars)
+    self.measure('Transcription.process', lambda: self.process_transcriptions(options['workers']))
+    self.measure('Project.create_jobs', self.create_jobs)
+    self.revise()
+    self.measure('Grammar.export', self.export)
+
+    results = {
+      'date':timezone.now().isoformat(),
+      'commit':self.commit(),
+      'python':platform.python_version(),
+      'corpus':corpus,
+      'workers':options['workers'],
+      'stages':self.stages,
+    }
+    with open(options['output'], 'w') as open_output:
+      json.dump(results, open_output, indent=1)
+
+    for stage in self.stages:
+      self.stdout.write('%(stage)s: %(seconds).3fs, %(queries)d queries, %(objects)d objects, %(peak_rss_kb)d kB peak rss' % stage)
+    self.stdout.write('results written to %s' % options['output'])
+
+  def measure(self, name, function):
+    '''
+    Run a stage and record its wall time, number of queries and the peak rss of the process so far. The rss is a high
+    water mark, so it only grows from one stage to the next. Audio analysed in worker processes is counted separately.
+    '''
+    with CaptureQueriesContext(connection) as queries:
+      start = time.perf_counter()
+      objects = function()
+      seconds = time.perf_counter() - start
+
+    stage = {
+      'stage':name,
+      'seconds':round(seconds, 3),
+      'queries':len(queries),
+      'objects':objects,
+      'peak_rss_kb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      'peak_rss_workers_kb':resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    self.stages.append(stage)
+
+  #stages: each returns the number of objects it produced
+  def scan(self):
+    scan_data(incremental=False, data_dir=settings.BENCH_DATA_DIR)
+    return WavFile.objects.count()
+
+  def process_grammars(self):
+    for grammar in Grammar.objects.all():
+      grammar.process()
+    return Transcription.objects.count()
+
+  def process_transcriptions(self, workers):
+    return sum(process_transcriptions(project.transcriptions.all(), workers=workers)[0] for project in Project.objects.all())
+
+  def create_jobs(self):
+    for project in Project.objects.all():
+      project.create_jobs()
+    return Job.objects.count()
+
+  def revise(self):
+    ''' Every transcription needs a revision before it can be exported. Not timed. '''
+    user = User.objects.create_user('benchmark@arktic.com', datetime.date(1990, 1, 1))
+    revisions = [Revision(transcription_id=transcription_pk, job_id=job_pk, user=user, utterance='revised') for transcription_pk, job_pk in Transcription.objects.filter(job__isnull=False).values_list('pk', 'job')]
+    Revision.objects.bulk_create(revisions, batch_size=500)
+
+  def export(self):
+    for grammar in Grammar.objects.all():
+      grammar.export()
+    return Revision.objects.count()
+
+  def commit(self):
+    try:
+      return check_output(['git', 'rev-parse', 'HEAD'], cwd=settings.DJANGO_ROOT).decode().strip()
+    except (CalledProcessError, OSError):
+      return None
@@ -0,0 +1,103 @@
+#django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import TextField
+from django.apps import apps
+
+#local
+from apps.transcription.models import Word
+from apps.transcription.interning import duplicate_words, merge_duplicate_words
+
+#util
+from optparse import make_option
+
+#command
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--dry-run', action='store_true', dest='dry_run', default=False, help='Only list the changes'),
+  )
+  args = '<none>'
+  help = 'Bring the columns and indexes of an existing database in line with the models: text columns that became indexed CharFields, db_index, index_together and unique_together'
+
+  def handle(self, *args, **options):
+    dry_run = options['dry_run']
+    changes = 0
+    for app_label in ['users', 'distribution', 'transcription']:
+      for model in apps.get_app_config(app_label).get_models():
+        if dry_run:
+          for description, change in self.changes(model):
+            self.stdout.write('%s: %s' % (model._meta.db_table, description))
+            changes += 1
+          continue
+
+        #some backends rebuild the whole table for one change, so the differences are found again after each one
+        applied = set()
+        while True:
+          pending = list(self.changes(model))
+          if not pending:
+            break
+          description, change = pending[0]
+          if description in applied:
+            raise CommandError('%s: %s did not take effect' % (model._meta.db_table, description))
+
+          self.stdout.write('%s: %s' % (model._meta.db_table, description))
+          with connection.schema_editor() as schema_editor:
+            change(schema_editor)
+          applied.add(description)
+          changes += 1
+
+    self.stdout.write('%d changes%s' % (changes, ' (dry run)' if dry_run else ''))
+
+  def changes(self, model):
+    ''' (description, function of a schema editor) for each difference between the model and its table. '''
+    table = model._meta.db_table
+    cursor = connection.cursor()
+    if table not in connection.introspection.table_names(cursor):
+      return
+
+    columns = {column[0]:column for column in connection.introspection.get_table_description(cursor, table)}
+    constraints = connection.introspection.get_constraints(cursor, table).values()
+    indexed = [tuple(constraint['columns']) for constraint in constraints if constraint['index'] or constraint['unique']]
+    unique = [tuple(constraint['columns']) for constraint in constraints if constraint['unique']]
+
+    def covered(column_names):
+      return any(index[:len(column_names)]==tuple(column_names) for index in indexed)
+
+    for field in model._meta.local_fields:
+      if field.column not in columns or field.rel is not None:
+        continue
+
+      #text columns that can not be indexed become CharFields
+      if field.get_internal_type()=='CharField' and connection.introspection.get_field_type(columns[field.column][1], columns[field.column])=='TextField':
+        old_field = TextField(null=field.null)
+        old_field.set_attributes_from_name(field.name)
+        old_field.model = model
+        yield 'convert %s to varchar(%d)' % (field.column, field.max_length), lambda schema_editor, old_field=old_field, field=field: schema_editor.alter_field(model, old_field, field)
+        if field.db_index:
+          continue #the conversion also adds the index
+
+      if field.db_index and not field.unique and not covered([field.column]):
+        old_field = field.clone()
+        old_field.db_index = False
+        old_field.set_attributes_from_name(field.name)
+        old_field.model = model
+        yield 'index %s' % field.column, lambda schema_editor, old_field=old_field, field=field: schema_editor.alter_field(model, old_field, field)
+
+    def column_names(field_names):
+      return [model._meta.get_field(field_name).column for field_name in field_names]
+
+    index_together = [fields for fields in model._meta.index_together if not covered(column_names(fields))]
+    if index_together:
+      existing = [fields for fields in model._meta.index_together if fields not in index_together]
+      yield 'index together %s' % ', '.join(['(%s)' % ', '.join(fields) for fields in index_together]), lambda schema_editor, existing=existing: schema_editor.alter_index_together(model, existing, model._meta.index_together)
+
+    unique_together = [fields for fields in model._meta.unique_together if tuple(column_names(fields)) not in unique]
+    if unique_together and model is Word:
+      #the index can not be added while two rows have the same values
+      duplicates = duplicate_words().count()
+      if duplicates:
+        yield 'merge %d sets of duplicate words' % duplicates, lambda schema_editor: merge_duplicate_words()
+
+    if unique_together:
+      existing = [fields for fields in model._meta.unique_together if fields not in unique_together]
+      yield 'unique together %s' % ', '.join(['(%s)' % ', '.join(fields) for fields in unique_together]), lambda schema_editor, existing=existing: schema_editor.alter_unique_together(model, existing, model._meta.unique_together)
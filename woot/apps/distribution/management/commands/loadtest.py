@@ -0,0 +1,61 @@
+#django
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
+from django.conf import settings
+from django.db import connection
+
+#local
+from apps.distribution.models import Project
+from apps.distribution.pipeline import run_pipeline
+from apps.distribution.tasks import scan_data
+from apps.transcription.loadtest import load_deltas, create_users, run_load_test
+from libs.corpus import generate_corpus
+
+#util
+from optparse import make_option
+import json
+import os
+
+#vars
+PASSWORD = 'loadtest'
+
+#command
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--users', action='store', type='int', dest='users', default=10, help='Number of simulated transcribers working at the same time'),
+    make_option('--duration', action='store', type='int', dest='duration', default=60, help='Seconds to run for'),
+    make_option('--speed', action='store', type='float', dest='speed', default=60.0, help='How many times faster than recorded the actions are replayed'),
+    make_option('--actions', action='store', type='int', dest='actions', default=8, help='Actions per transcription before the revision is saved'),
+    make_option('--unbatched', action='store_false', dest='batched', default=True, help='Send every action to action_register instead of batches to register_actions'),
+    make_option('--grammars', action='store', type='int', dest='grammars', default=4, help='Number of grammars seeded'),
+    make_option('--transcriptions', action='store', type='int', dest='transcriptions', default=250, help='Number of transcriptions per grammar seeded'),
+    make_option('--deltas', action='store', dest='deltas', default=os.path.join(os.path.dirname(settings.DJANGO_ROOT), 'time.py'), help='File with the recorded deltas between actions'),
+    make_option('--output', action='store', dest='output', default=None, help='File the results are also written to as JSON'),
+  )
+  args = '<none>'
+  help = 'Seed a database and replay the recorded action cadence of transcribers against the transcription views. Run with --settings=woot.settings.bench.'
+
+  def handle(self, *args, **options):
+    if connection.vendor!='sqlite' or not hasattr(settings, 'BENCH_ROOT'):
+      raise CommandError('the load test fills the database with synthetic data, run it with --settings=woot.settings.bench')
+
+    deltas = load_deltas(options['deltas'])
+
+    #seed: a corpus run through the pipeline, so every transcription has audio and belongs to a job
+    call_command('migrate', interactive=False, verbosity=0)
+    if not Project.objects.exists():
+      generate_corpus(settings.BENCH_DATA_DIR, grammars=options['grammars'], transcriptions=options['transcriptions'])
+      scan_data(data_dir=settings.BENCH_DATA_DIR)
+      run_pipeline(Project.objects.all(), from_stage='grammars', concurrency=1)
+    users = create_users(options['users'], PASSWORD)
+
+    self.stdout.write('%d users for %ds, %d deltas replayed %gx faster' % (len(users), options['duration'], len(deltas), options['speed']))
+    report = run_load_test(users, PASSWORD, deltas, duration=options['duration'], speed=options['speed'], actions_per_transcription=options['actions'], batched=options['batched'])
+
+    for endpoint, stats in sorted(report.items()):
+      self.stdout.write('%s: %d requests, %d errors, p50 %.1fms, p95 %.1fms, p99 %.1fms, %.1f queries (max %d)' % (
+        endpoint, stats['requests'], stats['errors'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['queries_mean'], stats['queries_max']))
+
+    if options['output']:
+      with open(options['output'], 'w') as open_output:
+        json.dump({'users':len(users), 'duration':options['duration'], 'speed':options['speed'], 'batched':options['batched'], 'endpoints':report}, open_output, indent=1)
@@ -0,0 +1,24 @@
+#django
+from django.core.management.base import BaseCommand, CommandError
+
+#local
+from apps.distribution.models import Project
+from apps.users.models import User
+
+#util
+import json
+
+#command
+class Command(BaseCommand):
+  args = '<none>'
+  help = 'Recompute completion state and active counters of every project, and the stats of every user, from scratch'
+
+  def handle(self, *args, **options):
+    count = Project.objects.count()
+    for i, project in enumerate(Project.objects.all()):
+      project.update()
+      self.stdout.write('%d/%d: %s, %d active transcriptions' % (i+1, count, str(project), project.active_transcriptions))
+
+    for user in User.objects.all():
+      user.update_stats()
+    self.stdout.write('%d users' % User.objects.count())
@@ -0,0 +1,55 @@
+#django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import TextField
+from django.conf import settings
+
+#local
+from apps.transcription.models import Transcription
+from libs.utils import bulk_update_column, pack_rms
+
+#util
+import json
+
+#command
+class Command(BaseCommand):
+  args = '<none>'
+  help = 'Convert audio_rms from a JSON list of floats to the packed binary envelope'
+
+  def handle(self, *args, **options):
+    field = Transcription._meta.get_field('audio_rms')
+    table = Transcription._meta.db_table
+
+    #1. change the column type if the table still has the old text column
+    cursor = connection.cursor()
+    description = [column for column in connection.introspection.get_table_description(cursor, table) if column[0]==field.column][0]
+    if connection.introspection.get_field_type(description[1], description)=='TextField':
+      self.stdout.write('converting %s.%s to a binary column...' % (table, field.column))
+      old_field = TextField()
+      old_field.set_attributes_from_name(field.name)
+      old_field.model = Transcription
+      with connection.schema_editor() as schema_editor:
+        schema_editor.alter_field(Transcription, old_field, field)
+
+    #2. pack every envelope that is still stored as JSON
+    batch_size = settings.TRANSCRIPTION_BATCH_SIZE
+    last_pk = 0
+    converted = 0
+    while True:
+      rows = list(Transcription.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'audio_rms')[:batch_size])
+      if not rows:
+        break
+      last_pk = rows[-1][0]
+
+      packed = {}
+      for pk, audio_rms in rows:
+        raw = audio_rms.encode() if isinstance(audio_rms, str) else bytes(audio_rms or b'')
+        if raw[:1]==b'[' and len(raw)!=settings.NUMBER_OF_AUDIO_FILE_BINS:
+          packed[pk] = pack_rms(json.loads(raw.decode()))
+
+      with transaction.atomic():
+        bulk_update_column(Transcription, field.column, packed)
+      converted += len(packed)
+      self.stdout.write('converted %d (up to transcription %d)' % (converted, last_pk), ending='\r')
+
+    self.stdout.write('converted %d transcriptions' % converted)
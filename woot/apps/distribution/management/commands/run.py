@@ -2,28 +2,34 @@
 from django.core.management.base import BaseCommand, CommandError
 
 #local
-from apps.transcription.models import Grammar, Transcription, Word
 from apps.distribution.models import Project
-from apps.distribution.tasks import scan_data
+from apps.distribution.pipeline import STAGES, run_pipeline
 
 #util
-import json
+from optparse import make_option
 
 #command
 class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--client', action='store', dest='client', default='sdg', help='Name of the client whose projects are run'),
+    make_option('--project', action='append', dest='projects', default=[], help='Name of a project to run, can be given more than once'),
+    make_option('--from-stage', action='store', dest='from_stage', default='scan', choices=STAGES, help='First stage to run: %s' % ', '.join(STAGES)),
+    make_option('--dry-run', action='store_true', dest='dry_run', default=False, help='Only report the work left in each stage'),
+    make_option('--workers', action='store', type='int', dest='workers', default=1, help='Number of processes analysing audio'),
+    make_option('--concurrency', action='store', type='int', dest='concurrency', default=None, help='Number of projects run side by side'),
+  )
   args = '<none>'
-  help = ''
+  help = 'Scan the data directory and prepare the projects of a client for transcription. Stages that are interrupted pick up where they stopped when run again.'
 
   def handle(self, *args, **options):
-    self.stdout.write('scanning data directories...')
-    scan_data()
+    projects = Project.objects.filter(client__name=options['client'])
+    if options['projects']:
+      projects = projects.filter(name__in=options['projects'])
+      missing = set(options['projects']) - set(projects.values_list('name', flat=True))
+      if missing and options['from_stage']!='scan': #scanning may still create them
+        raise CommandError('no such project for %s: %s' % (options['client'], ', '.join(sorted(missing))))
 
-    #projects
-    for project in Project.objects.filter(client__name='sdg'):
-      print(project)
-      project.process_grammars()
-      project.process_transcriptions()
-      # project.process_words()
-      project.create_jobs()
-      project.is_active = True
-      project.save()
+    report = run_pipeline(projects, from_stage=options['from_stage'], dry_run=options['dry_run'], workers=options['workers'], concurrency=options['concurrency'])
+    if options['dry_run']:
+      for name, stage, left, finished in report:
+        self.stdout.write('%s: %s, %d left (last finished %s)' % (name, stage, left, finished or 'never'))
@@ -8,12 +8,17 @@ from apps.distribution.tasks import scan_data
 
 #util
 import json
+from optparse import make_option
 
 #command
 class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--full', action='store_false', dest='incremental', default=True, help='Ignore the manifest and rescan everything'),
+    make_option('--hash', action='store_true', dest='use_hash', default=False, help='Compare relfile contents by hash as well as size and mtime'),
+  )
   args = '<none>'
   help = ''
 
   def handle(self, *args, **options):
     self.stdout.write('scanning data directories...')
-    scan_data()
+    scan_data(incremental=options['incremental'], use_hash=options['use_hash'])
@@ -3,19 +3,24 @@ from django.core.management.base import BaseCommand, CommandError
 
 #local
 from apps.transcription.models import Grammar, Transcription, Word
+from apps.transcription.processing import process_transcriptions
 from apps.distribution.models import Project
 from apps.distribution.tasks import scan_data
 
 #util
 import json
+from optparse import make_option
 
 #command
 class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option('--workers', type='int', dest='workers', default=1, help='Number of processes used to decode audio'),
+    make_option('--batch-size', type='int', dest='batch_size', default=None, help='Transcriptions written per transaction'),
+  )
   args = '<none>'
   help = ''
 
   def handle(self, *args, **options):
     self.stdout.write('processing transcriptions...')
-    for i, t in enumerate(Transcription.objects.filter(is_active=False)):
-      print(['audio', i+1, Transcription.objects.count()])
-      t.process()
+    processed, failures = process_transcriptions(Transcription.objects.filter(audio_time__isnull=True), workers=options['workers'], batch_size=options['batch_size'])
+    self.stdout.write('processed %d transcriptions, %d failed' % (processed, len(failures)))
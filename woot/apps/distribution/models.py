@@ -1,26 +1,32 @@
 #woot.apps.distribution.models
 
 #django
-from django.db import models
+from django.db import models, connection, transaction
 from django.conf import settings
 from django.utils import timezone
+from django.db.models import Count, Sum, F
 
 #local
 from apps.users.models import User
-from libs.utils import generate_id_token
+from libs.utils import generate_id_token, generate_id_tokens, bulk_update_column, in_thread
 
 #util
 import os
 import zipfile as zp
 import shutil as sh
 import datetime as dt
+import time
+from collections import deque
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 #vars
 
 #classes
 class Client(models.Model):
   #properties
-  name = models.CharField(max_length=255)
+  name = models.CharField(max_length=255, db_index=True)
   client_path = models.TextField(max_length=255)
 
   #methods
@@ -38,46 +44,198 @@ class Client(models.Model):
     download from the admin in the form of a zip file.
 
     '''
-    for project in self.projects.filter(is_active=True, is_approved=True):
+    for project in self.projects.all():
       project.update()
 
-  def export(self):
-    count = self.grammars.count()
-    for i,g in enumerate(self.grammars.all()):
-      print('%d/%d: %s' % (i+1, count, str(g)))
-      g.export()
+  def count_active_transcriptions(self):
+    ''' Set the active_transcriptions counters of the project and its grammars from the active transcriptions. '''
+    Grammar = self.grammars.model
+    active = dict(self.transcriptions.filter(is_active=True).values_list('grammar').annotate(Count('pk')))
+    bulk_update_column(Grammar, 'active_transcriptions', {pk:active.get(pk, 0) for pk in self.grammars.values_list('pk', flat=True)})
+    Project.objects.filter(pk=self.pk).update(active_transcriptions=sum(active.values()))
+    self.active_transcriptions = sum(active.values())
+
+  def export(self, workers=None):
+    '''
+    Export the relfile of every grammar, settings.EXPORT_WORKERS grammars at a time. See Grammar.export.
+    '''
+    grammars = list(self.grammars.select_related('client'))
+    count = len(grammars)
+
+    def export_grammar(grammar):
+      grammar.export()
+      return grammar
+
+    workers = workers or settings.EXPORT_WORKERS
+    if workers==1:
+      for i, g in enumerate(grammars):
+        print('%d/%d: %s' % (i+1, count, str(g)))
+        g.export()
+      return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      for i, g in enumerate(executor.map(in_thread(export_grammar), grammars)):
+        print('%d/%d: %s' % (i+1, count, str(g)))
 
 class Project(models.Model):
   #connections
   client = models.ForeignKey(Client, related_name='projects')
 
   #properties
-  id_token = models.CharField(max_length=8)
+  id_token = models.CharField(max_length=8, db_index=True)
   name = models.CharField(max_length=255)
   date_created = models.DateTimeField(auto_now_add=True)
   is_active = models.BooleanField(default=False)
+  active_transcriptions = models.IntegerField(editable=False, default=0)
+  lexicon_version = models.IntegerField(editable=False, default=0) #incremented when autocomplete words are added
   project_path = models.TextField(max_length=255)
   completed_project_file = models.FileField(upload_to='completed_projects')
+  date_exported = models.DateTimeField(null=True) #when completed_project_file was last built
 
   #methods
   def __str__(self):
     return str(self.client) + ' > ' + str(self.name)
 
   def update(self):
-    ''' Updates project when a revision is submitted. '''
-    for job in self.jobs.filter(is_active=True):
-      job.update()
+    '''
+    Recompute completion state from scratch: transcriptions, then the active counters of jobs, grammars and the
+    project itself. Uses a fixed number of queries however large the project is.
 
-    for grammar in self.grammars.filter(is_active=True):
-      grammar.update()
+    Saving a revision keeps all of this up to date incrementally (see Transcription.complete), so this is only
+    needed to reconcile the counters, e.g. with the reconcile command.
+    '''
+    from apps.transcription.models import Revision
+
+    now = timezone.now()
+    Grammar = self.grammars.model
+    JobTranscription = self.transcriptions.model.job.through
+
+    #a transcription is done when it has at least one revision with an utterance
+    done = Revision.objects.filter(transcription__project=self).exclude(utterance='').values('transcription')
+    self.transcriptions.filter(is_active=True, pk__in=done).update(is_active=False)
+    self.transcriptions.filter(is_active=False, audio_time__isnull=False, job__isnull=False).exclude(pk__in=done).update(is_active=True) #utterances cleared since
+
+    #jobs
+    job_pks = list(self.jobs.values_list('pk', flat=True))
+    active = dict(JobTranscription.objects.filter(job__project=self, transcription__is_active=True).values_list('job').annotate(Count('transcription')))
+    time_taken = dict(Revision.objects.filter(job__project=self, user=F('job__user'), transcription__is_active=False).values_list('job').annotate(Sum('time_to_complete')))
+    bulk_update_column(Job, 'active_transcriptions', {pk:active.get(pk, 0) for pk in job_pks})
+    bulk_update_column(Job, 'time_taken', {pk:time_taken.get(pk) or 0 for pk in job_pks})
+    self.jobs.filter(is_active=True, active_transcriptions=0).update(is_active=False, date_completed=now)
+    self.jobs.filter(is_active=False, active_transcriptions__gt=0).update(is_active=True, date_completed=None)
+
+    #grammars
+    active = dict(self.transcriptions.filter(is_active=True).values_list('grammar').annotate(Count('pk')))
+    bulk_update_column(Grammar, 'active_transcriptions', {pk:active.get(pk, 0) for pk in self.grammars.values_list('pk', flat=True)})
+    self.grammars.filter(active_transcriptions__gt=0).update(is_active=True)
+    self.grammars.filter(is_active=True, active_transcriptions=0).update(is_active=False, date_completed=now)
 
     #update status: active, processed
-    self.is_active = (self.jobs.filter(is_active=True).count()!=0 and self.grammars.filter(is_active=True).count()!=0)
+    self.active_transcriptions = self.transcriptions.filter(is_active=True).count()
+    self.is_active = (self.jobs.filter(is_active=True).exists() and self.grammars.filter(is_active=True).exists())
     self.save()
 
-  def export(self):
-    ''' Export prepares all of the individual relfiles to be packaged and be available for download. '''
-    pass
+  def export(self, workers=None):
+    '''
+    Export prepares all of the individual relfiles to be packaged and be available for download.
+
+    The relfile of every completed grammar is streamed into its own entry of completed_project_file, with no
+    intermediate files. Relfiles are generated by up to settings.EXPORT_WORKERS threads at a time. A zip takes one entry
+    at a time, so each thread hands its relfile over in chunks of about settings.EXPORT_BUFFER_SIZE bytes through a short
+    queue, and waits while the entries before its own are written. Grammars with no revisions saved since the last
+    export are copied from the previous zip instead of being generated again.
+    '''
+    from apps.transcription.models import Revision
+
+    workers = workers or settings.EXPORT_WORKERS
+    started = timezone.now()
+    grammars = list(self.grammars.filter(date_completed__isnull=False).order_by('name'))
+
+    #previous export
+    previous = None
+    if self.completed_project_file and os.path.exists(self.completed_project_file.path) and self.date_exported is not None:
+      previous = zp.ZipFile(self.completed_project_file.path)
+      previous_names = set(previous.namelist())
+      changed = set(Revision.objects.filter(transcription__project=self, date_modified__gte=self.date_exported).values_list('transcription__grammar', flat=True).distinct())
+
+    name = os.path.join('completed_projects', '%s-%s.zip' % (self.client.name, self.name))
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    cancelled = threading.Event()
+    def put(chunks, item):
+      while not cancelled.is_set(): #once the export has failed, nobody reads the queue any more
+        try:
+          chunks.put(item, timeout=1)
+          return True
+        except queue.Full:
+          pass
+      return False
+
+    def relfile(grammar, chunks):
+      try:
+        for chunk in grammar.export_chunks():
+          if not put(chunks, chunk):
+            return
+        put(chunks, None)
+      except Exception as e:
+        put(chunks, e)
+
+    def write(package, entry_name, source):
+      with package.open(entry_name, 'w') as dst:
+        if source is None:
+          with previous.open(entry_name) as src:
+            sh.copyfileobj(src, dst, settings.EXPORT_BUFFER_SIZE)
+        elif isinstance(source, queue.Queue):
+          for chunk in iter(source.get, None):
+            if isinstance(chunk, Exception):
+              raise chunk
+            dst.write(chunk)
+        else: #with one worker, relfiles are generated in this thread and on this connection
+          for chunk in source.export_chunks():
+            dst.write(chunk)
+
+    generated, copied = 0, 0
+    try:
+      with zp.ZipFile(path + '.tmp', 'w', zp.ZIP_DEFLATED) as package, ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+          entries = deque()
+          for i, grammar in enumerate(grammars):
+            entry_name = '%s.csv' % grammar.name
+            if previous is not None and grammar.pk not in changed and entry_name in previous_names:
+              entries.append((entry_name, None))
+              copied += 1
+            elif workers>1:
+              chunks = queue.Queue(maxsize=2)
+              executor.submit(in_thread(relfile), grammar, chunks)
+              entries.append((entry_name, chunks))
+              generated += 1
+            else:
+              entries.append((entry_name, grammar))
+              generated += 1
+
+            while len(entries)>workers:
+              write(package, *entries.popleft())
+            print('grammar %d/%d' % (i+1, len(grammars)), end='\r')
+
+          while entries:
+            write(package, *entries.popleft())
+        except BaseException:
+          cancelled.set() #threads waiting on a full queue stop, so that the executor can shut down
+          raise
+    except BaseException:
+      if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+      raise
+    finally:
+      if previous is not None:
+        previous.close()
+    os.replace(path + '.tmp', path)
+
+    self.completed_project_file.name = name
+    self.date_exported = started
+    self.save()
+    print('%s: %d relfiles generated, %d unchanged' % (self.name, generated, copied))
 
   def process_grammars(self):
     '''
@@ -89,15 +247,14 @@ class Project(models.Model):
       print('grammar %d/%d'%(i+1, count), end='\r' if i<count-1 else '\n')
       grammar.process()
 
-  def process_transcriptions(self):
+  def process_transcriptions(self, workers=1):
     '''
-    Wrapper for individual processing done by transcriptions.
+    Wrapper for individual processing done by transcriptions. See apps.transcription.processing.
     '''
+    from apps.transcription.processing import process_transcriptions
+
     print('processing transcriptions...')
-    count = self.transcriptions.count()
-    for i, transcription in enumerate(self.transcriptions.all()):
-      print('transcription %d/%d'%(i+1, count), end='\r' if i<count-1 else '\n')
-      transcription.process()
+    return process_transcriptions(self.transcriptions.all(), workers=workers)
 
   def process_words(self):
     '''
@@ -109,23 +266,51 @@ class Project(models.Model):
       print('words %d/%d'%(i+1, count), end='\r' if i<count-1 else '\n')
       transcription.process_words()
 
-  def create_jobs(self):
+  def create_jobs(self, contiguous=False):
     '''
-    Create all possible jobs from the set of transcriptions.
+    Create all possible jobs from the set of transcriptions. See build_jobs.
     '''
     if self.jobs.count()==0:
       print('creating jobs...')
-      filter_set = self.transcriptions.filter(is_available=True).order_by('grammar__name')
-      counter = filter_set.count() - 1 if filter_set.count() else 0
-      while counter:
-        print('available: %d'%(counter), end='\r')
-        job = self.jobs.create(client=self.client, id_token=generate_id_token(Job))
-        lower_bound = counter-settings.NUMBER_OF_TRANSCRIPTIONS_PER_JOB if counter>=settings.NUMBER_OF_TRANSCRIPTIONS_PER_JOB else 0
-        job_set = filter_set[lower_bound:counter]
-        job.get_transcription_set(job_set)
-        job.save()
-        counter = lower_bound
-      print('available: 0')
+      self.build_jobs(self.transcriptions.filter(is_available=True), contiguous=contiguous)
+
+  def build_jobs(self, transcriptions, contiguous=False):
+    '''
+    Pack a queryset of available transcriptions into new jobs and return the number of jobs.
+
+    Transcriptions are packed into jobs of about settings.JOB_TARGET_DURATION seconds of audio, and at most
+    settings.JOB_MAX_TRANSCRIPTIONS transcriptions (see apps.distribution.packing). With contiguous=True, the
+    transcriptions of a grammar stay together. Jobs and their transcription links are written with bulk inserts.
+    '''
+    from apps.distribution.packing import pack_transcriptions, duration_summary
+
+    start = time.time()
+    filter_set = transcriptions.order_by('grammar__name', 'pk')
+    transcriptions = [(pk, float(audio_time or 0)) for pk, audio_time in filter_set.values_list('pk', 'audio_time')]
+    packed = [job_set for job_set in pack_transcriptions(transcriptions, settings.JOB_TARGET_DURATION, settings.JOB_MAX_TRANSCRIPTIONS, contiguous=contiguous) if job_set] #an empty job could be claimed
+
+    with transaction.atomic():
+      id_tokens = generate_id_tokens(Job, len(packed))
+      self.jobs.bulk_create([Job(client=self.client, project=self, id_token=id_token, active_transcriptions=len(job_set), total_transcription_time=round(sum(audio_time for pk, audio_time in job_set), 5)) for id_token, job_set in zip(id_tokens, packed)], batch_size=500)
+      job_pks = {}
+      for i in range(0, len(id_tokens), 500):
+        job_pks.update(self.jobs.filter(id_token__in=id_tokens[i:i+500]).values_list('id_token', 'pk'))
+
+      Through = Job.transcriptions.through
+      Through.objects.bulk_create([Through(job_id=job_pks[id_token], transcription_id=pk) for id_token, job_set in zip(id_tokens, packed) for pk, audio_time in job_set], batch_size=1000)
+
+      now = timezone.now()
+      pks = [pk for pk, audio_time in transcriptions]
+      for i in range(0, len(pks), 500):
+        self.transcriptions.filter(pk__in=pks[i:i+500]).update(is_available=False, date_last_requested=now)
+
+      #revisions can only be saved once a transcription is in a job, so the counters Transcription.complete
+      #decrements start from here
+      self.count_active_transcriptions()
+
+    print(duration_summary([sum(audio_time for pk, audio_time in job_set) for job_set in packed]))
+    print('%d transcriptions in %.1fs' % (len(transcriptions), time.time() - start))
+    return len(packed)
 
 class Job(models.Model):
   #connections
@@ -135,14 +320,18 @@ class Job(models.Model):
 
   #properties
   is_active = models.BooleanField(default=True)
-  is_available = models.BooleanField(default=True)
-  id_token = models.CharField(max_length=8) #a random string of characters to identify the job
+  is_available = models.BooleanField(default=True, db_index=True)
+  id_token = models.CharField(max_length=8, db_index=True) #a random string of characters to identify the job
   active_transcriptions = models.IntegerField(editable=False, default=settings.NUMBER_OF_TRANSCRIPTIONS_PER_JOB)
   date_created = models.DateTimeField(auto_now_add=True)
   date_completed = models.DateTimeField(auto_now_add=False, null=True)
+  lease_expires = models.DateTimeField(null=True, db_index=True) #the job returns to the pool if the user is idle past this
   total_transcription_time = models.DecimalField(max_digits=8, decimal_places=5, null=True)
   time_taken = models.DecimalField(max_digits=8, decimal_places=6, null=True)
 
+  class Meta:
+    index_together = [('project', 'is_active')]
+
   #methods
   def __str__(self):
     return str(self.project) + ' > ' + str(self.user) + ', job ' + str(self.pk) + ':' + str(self.id_token)
@@ -161,22 +350,63 @@ class Job(models.Model):
     #set total_transcription_time
     self.total_transcription_time = float(sum([float(t.audio_time) for t in self.transcriptions.all()]))
 
-  def update(self): #not used for export. Just for recording values.
-    ''' active_transcriptions, time_taken '''
-
-    for transcription in self.transcriptions.all():
-      transcription.update()
+  def renew_lease(self, user):
+    ''' Extend the lease if the user still holds the job. Returns False if it has been reclaimed. '''
+    return Job.objects.filter(pk=self.pk, user=user, is_active=True).update(lease_expires=lease_expiry())>0
 
+  def update(self): #not used for export. Just for recording values.
+    '''
+    Recompute active_transcriptions and time_taken from scratch. These are kept up to date incrementally when revisions
+    are saved (see Transcription.complete), so this only reconciles them.
+    '''
     self.active_transcriptions = self.transcriptions.filter(is_active=True).count()
-    if self.active_transcriptions==0:
+    if self.active_transcriptions==0 and self.is_active:
       self.is_active = False
       self.date_completed = timezone.now()
 
-    time_taken = 0
-    for transcription in self.transcriptions.filter(is_active=False):
-      #get total time for current user
-      for revision in transcription.revisions.filter(user=self.user):
-        time_taken += revision.time_to_complete if revision.time_to_complete else 0
-    self.time_taken = time_taken
+    #get total time for current user
+    self.time_taken = self.revisions.filter(user=self.user, transcription__is_active=False).aggregate(time_taken=Sum('time_to_complete'))['time_taken'] or 0
 
     self.save()
+
+def claim_job(user):
+  '''
+  Atomically assign the oldest available job to user under a lease of settings.JOB_LEASE_DURATION seconds.
+  Returns the job, or None if no job is available. Two concurrent callers never receive the same job.
+  '''
+  if supports_skip_locked():
+    with transaction.atomic():
+      #rows locked by other claimers are skipped instead of waited on
+      cursor = connection.cursor()
+      cursor.execute('SELECT %(pk)s FROM %(table)s WHERE %(is_available)s = %%s ORDER BY %(pk)s LIMIT 1 FOR UPDATE SKIP LOCKED' % {
+        'pk':connection.ops.quote_name(Job._meta.pk.column),
+        'table':connection.ops.quote_name(Job._meta.db_table),
+        'is_available':connection.ops.quote_name('is_available'),
+      }, [True])
+      row = cursor.fetchone()
+      if row is None:
+        return None
+      Job.objects.filter(pk=row[0]).update(is_available=False, user=user, lease_expires=lease_expiry())
+      return Job.objects.get(pk=row[0])
+
+  #compare and swap: the update only succeeds if the job is still available, otherwise another claimer won it
+  while True:
+    pks = list(Job.objects.filter(is_available=True).order_by('pk').values_list('pk', flat=True)[:1])
+    if not pks:
+      return None
+    if Job.objects.filter(pk=pks[0], is_available=True).update(is_available=False, user=user, lease_expires=lease_expiry()):
+      return Job.objects.get(pk=pks[0])
+
+def reclaim_expired_jobs():
+  ''' Return unfinished jobs whose lease has run out to the pool. Returns the number of jobs reclaimed. '''
+  return Job.objects.filter(is_active=True, is_available=False, lease_expires__lt=timezone.now()).update(is_available=True, user=None, lease_expires=None)
+
+def lease_expiry():
+  return timezone.now() + dt.timedelta(seconds=settings.JOB_LEASE_DURATION)
+
+def supports_skip_locked():
+  if connection.vendor=='postgresql':
+    return connection.pg_version>=90500
+  elif connection.vendor=='mysql':
+    return connection.mysql_version>=(8, 0, 1)
+  return False
@@ -0,0 +1,56 @@
+#apps.distribution.packing
+
+#django
+
+#local
+
+#util
+import heapq
+import math
+
+#third party
+import numpy as np
+
+#methods
+def pack_transcriptions(transcriptions, target_duration, max_count, contiguous=False):
+  '''
+  Split a list of (pk, audio_time) into jobs of roughly target_duration seconds, each holding at most max_count
+  transcriptions. Returns a list of jobs, each a list of (pk, audio_time).
+
+  contiguous=True keeps the given order (e.g. by grammar), closing a job when the next transcription would take it
+  over the target. Otherwise the longest transcriptions are placed first, each in the emptiest job, which keeps job
+  durations as even as possible.
+  '''
+  if contiguous:
+    jobs = []
+    job, duration = [], 0.0
+    for pk, audio_time in transcriptions:
+      if job and (len(job)==max_count or duration + audio_time>target_duration):
+        jobs.append(job)
+        job, duration = [], 0.0
+      job.append((pk, audio_time))
+      duration += audio_time
+    if job:
+      jobs.append(job)
+    return jobs
+
+  transcriptions = sorted(transcriptions, key=lambda t: -t[1])
+  total = sum(audio_time for pk, audio_time in transcriptions)
+  number_of_jobs = max(int(math.ceil(total / target_duration)) if target_duration else 0, int(math.ceil(len(transcriptions) / float(max_count))))
+  number_of_jobs = min(number_of_jobs, len(transcriptions)) #transcriptions longer than the target would leave jobs empty
+  jobs = [[] for _ in range(number_of_jobs)]
+  heap = [(0.0, i) for i in range(number_of_jobs)] #(duration, job index) of jobs that are not full
+  for pk, audio_time in transcriptions:
+    duration, i = heapq.heappop(heap)
+    jobs[i].append((pk, audio_time))
+    if len(jobs[i])<max_count:
+      heapq.heappush(heap, (duration + audio_time, i))
+  return [job for job in jobs if job]
+
+def duration_summary(durations):
+  ''' One line describing the distribution of job durations in seconds. '''
+  if not len(durations):
+    return 'no jobs'
+  durations = np.asarray(durations, dtype=np.float64)
+  p10, p50, p90 = np.percentile(durations, [10, 50, 90])
+  return '%d jobs: min %.1fs, p10 %.1fs, median %.1fs, p90 %.1fs, max %.1fs, mean %.1fs, std %.1fs' % (len(durations), durations.min(), p10, p50, p90, durations.max(), durations.mean(), durations.std())
@@ -0,0 +1,142 @@
+#apps.distribution.pipeline
+
+#django
+from django.conf import settings
+from django.utils import timezone
+
+#local
+from apps.distribution.tasks import scan_data, is_relfile
+from apps.transcription.processing import process_transcriptions
+from libs.manifest import Manifest
+from libs.utils import in_thread
+
+#util
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#vars
+STAGES = ['scan', 'grammars', 'transcriptions', 'jobs', 'update']
+
+#classes
+class Checkpoint(object):
+  '''
+  When each stage last finished, for the whole run (scan) and for each project. Stored as JSON in
+  settings.PIPELINE_CHECKPOINT. Work inside a stage is checkpointed in the database itself: ingested grammars have
+  transcriptions, processed transcriptions have an audio_time and packed transcriptions are no longer available,
+  so a stage that is run again only picks up what is left.
+  '''
+  def __init__(self, path):
+    self.path = path
+    self.stages = {}
+    self.lock = threading.Lock()
+
+  @classmethod
+  def load(cls, path):
+    checkpoint = cls(path)
+    if os.path.exists(path):
+      with open(path) as open_checkpoint:
+        checkpoint.stages = json.load(open_checkpoint)
+    return checkpoint
+
+  def save(self):
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as open_checkpoint:
+      json.dump(self.stages, open_checkpoint, indent=1, sort_keys=True)
+    os.replace(tmp_path, self.path)
+
+  def key(self, project=None):
+    return str(project.pk) if project is not None else 'run'
+
+  def finished(self, stage, project=None):
+    return self.stages.get(self.key(project), {}).get(stage)
+
+  def mark(self, stage, project=None):
+    with self.lock:
+      self.stages.setdefault(self.key(project), {})[stage] = timezone.now().isoformat()
+      self.save()
+
+#methods
+def remaining(stage, project=None, data_dir=None):
+  ''' How much work a stage has left, as a number of objects. '''
+  if stage=='scan':
+    data_dir = data_dir or os.path.join(settings.DJANGO_ROOT, 'data')
+    diff = Manifest.load(settings.SCAN_MANIFEST).scan(data_dir, is_relfile) #the manifest is not saved
+    return sum(len(paths) for paths in diff.values())
+  elif stage=='grammars':
+    return project.grammars.filter(transcriptions__isnull=True).distinct().count()
+  elif stage=='transcriptions':
+    return project.transcriptions.filter(audio_time__isnull=True).count()
+  elif stage=='jobs':
+    return project.transcriptions.filter(is_available=True, job__isnull=True).count()
+  elif stage=='update':
+    return 1
+
+def run_stage(stage, project, workers=1, concurrency=1):
+  if stage=='grammars':
+    #grammars are independent of each other, so they are ingested side by side
+    grammars = list(project.grammars.filter(transcriptions__isnull=True).distinct())
+    if concurrency>1:
+      with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(in_thread(lambda grammar: grammar.process()), grammars))
+    else:
+      for grammar in grammars:
+        grammar.process()
+
+  elif stage=='transcriptions':
+    processed, failures = process_transcriptions(project.transcriptions.filter(audio_time__isnull=True), workers=workers)
+    if failures:
+      raise PipelineError('%s: %d transcriptions failed, run again to retry them' % (project, len(failures)))
+
+  elif stage=='jobs':
+    project.build_jobs(project.transcriptions.filter(is_available=True, job__isnull=True))
+
+  elif stage=='update':
+    project.update()
+    project.is_active = True
+    project.save()
+
+def run_project(project, stages, checkpoint, workers=1, concurrency=1):
+  for stage in stages:
+    left = remaining(stage, project)
+    print('%s: %s, %d left' % (project, stage, left))
+    if left:
+      run_stage(stage, project, workers=workers, concurrency=concurrency)
+    checkpoint.mark(stage, project)
+
+def run_pipeline(projects, from_stage='scan', dry_run=False, workers=1, concurrency=None, data_dir=None):
+  '''
+  Run the stages from from_stage onwards. Scanning covers the whole data directory and runs first. The other stages
+  run in order for each project. Projects run side by side in up to settings.PIPELINE_CONCURRENCY threads, except
+  when audio is processed by several worker processes, which are forked and must not be forked from threads.
+  With dry_run=True nothing is run and the work left in each stage is returned instead.
+  '''
+  concurrency = concurrency or settings.PIPELINE_CONCURRENCY
+  stages = STAGES[STAGES.index(from_stage):]
+  checkpoint = Checkpoint.load(settings.PIPELINE_CHECKPOINT)
+
+  if dry_run:
+    report = []
+    if 'scan' in stages:
+      report.append(('run', 'scan', remaining('scan', data_dir=data_dir), checkpoint.finished('scan')))
+    for project in projects:
+      for stage in stages[1:] if 'scan' in stages else stages:
+        report.append((str(project), stage, remaining(stage, project), checkpoint.finished(stage, project)))
+    return report
+
+  if 'scan' in stages:
+    scan_data(data_dir=data_dir)
+    checkpoint.mark('scan')
+    stages = stages[1:]
+
+  projects = list(projects)
+  if concurrency>1 and workers==1 and len(projects)>1:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      list(executor.map(in_thread(lambda project: run_project(project, stages, checkpoint)), projects))
+  else:
+    for project in projects:
+      run_project(project, stages, checkpoint, workers=workers, concurrency=concurrency if workers==1 else 1)
+
+class PipelineError(Exception):
+  pass
@@ -2,83 +2,194 @@
 
 #django
 from django.conf import settings
+from django.db.models import F
 
 #local
-from apps.distribution.models import Client, Project
+from apps.distribution.models import Client, Project, reclaim_expired_jobs
 from apps.transcription.models import Grammar
 from apps.transcription.models import Transcription, CSVFile, WavFile
+from apps.transcription.processing import process_transcriptions
 from libs.utils import generate_id_token
+from libs.manifest import Manifest
+from libs.relfile import parse_relfile_file_names
 
 #util
 import os
 
 #third party
-from celery import task
+from celery import task, chord
 
 #from apps.distribution.tasks import scan_data; scan_data();
 
 @task()
-def scan_data():
+def scan_data(incremental=True, use_hash=False, data_dir=None):
   '''
   Walks through data directory and finds new grammars, creating them and adding them to the right clients and projects.
+
+  The directory tree is recorded in a manifest (settings.SCAN_MANIFEST). With incremental=True, only directories and
+  relfiles that changed since the last scan are read from disk; otherwise the manifest is rebuilt and every relfile
+  is looked at again. Returns the number of new, changed and removed files.
   '''
+  data_dir = data_dir or os.path.join(settings.DJANGO_ROOT, 'data')
+  manifest = Manifest.load(settings.SCAN_MANIFEST) if incremental else Manifest(settings.SCAN_MANIFEST)
+
+  diff = manifest.scan(data_dir, is_relfile, use_hash=use_hash)
+  print('scan: %d new, %d changed, %d removed' % (len(diff['new']), len(diff['changed']), len(diff['removed'])))
+
+  #only relfiles that are new or have changed need to go near the database
+  relfiles = {}
+  for path in diff['new'] + diff['changed']:
+    sup, file_name = os.path.split(path)
+    parts = os.path.relpath(path, data_dir).split(os.sep)
+    if len(parts)>2 and is_relfile(sup, file_name): #data/<client>/<project>/...
+      relfiles.setdefault((parts[0], parts[1]), []).append((sup, file_name))
+
+  #wav files that were missing from a relfile may have arrived since: the relfiles of their project are resolved again
+  projects_with_new_wav_files = set()
+  for path in diff['new']:
+    parts = os.path.relpath(path, data_dir).split(os.sep)
+    if len(parts)>2 and '.wav' in parts[-1]:
+      projects_with_new_wav_files.add((parts[0], parts[1]))
+
+  for client_name, project_name in projects_with_new_wav_files:
+    project_relfiles = relfiles.setdefault((client_name, project_name), [])
+    for sup, subs, file_list in manifest.walk(os.path.join(data_dir, client_name, project_name)):
+      project_relfiles += [(sup, file_name) for file_name in file_list if is_relfile(sup, file_name) and (sup, file_name) not in project_relfiles]
+
+  #a project with new wav files but no relfiles yet has nothing to resolve
+  relfiles = {key:project_relfiles for key, project_relfiles in relfiles.items() if project_relfiles}
+
+  for (client_name, project_name), project_relfiles in sorted(relfiles.items()):
+    client, created = Client.objects.get_or_create(name=client_name)
+
+    if created:
+      client.client_path = os.path.join(data_dir, client_name)
+      client.save()
+      print('created client: ' + str(client))
 
-  #1. get all filenames+paths in project dir
-  #2. get all filenames from all csv files in project dir -> dictionary
-  #3.
+    project, created = client.projects.get_or_create(name=project_name)
 
-  data_dir = os.path.join(settings.DJANGO_ROOT, 'data')
-  for name in os.listdir(data_dir):
-    client, created = Client.objects.get_or_create(name=name)
+    if created:
+      project.id_token = generate_id_token(Project)
+      project.project_path = os.path.join(client.client_path, project_name)
+      project.save()
+      print('created project: ' + str(project))
 
-    if created: #scan directory for grammars
-      client.client_path = os.path.join(data_dir, name)
-      client.save()
-      print('created client: ' + str(client))
+    #wav files are looked up in the manifest, not on disk
+    wav_file_dictionary = {}
+    for sup, subs, file_list in manifest.walk(project.project_path):
+      for file_name in file_list:
+        if '.wav' in file_name:
+          wav_file_dictionary[file_name] = os.path.join(sup, file_name)
 
-    for project_name in [dir_i for dir_i in os.listdir(client.client_path) if os.path.isdir(os.path.join(client.client_path, dir_i))]:
-      project, created = client.projects.get_or_create(name=project_name)
+    for i, (sup, file_name) in enumerate(project_relfiles):
+      root, ext = os.path.splitext(file_name)
+      csv_file, created = project.csv_files.get_or_create(client=client, name=root, file_name=file_name, path=sup)
+      grammar, created = project.grammars.get_or_create(client=client, name=csv_file.name)
 
       if created:
-        project.id_token = generate_id_token(Project)
-        project.project_path = os.path.join(client.client_path, project_name)
-        project.save()
-        print('created project: ' + str(project))
-
-      #generate list of .csv files and list of .wav files
-      csv_file_list = []
-      wav_file_dictionary = {}
-      for sup, subs, file_list in os.walk(project.project_path):
-        for file_name in file_list:
-          if '.csv' in file_name and 'Unsorted' not in sup and 'save' not in sup:
-            csv_file_list.append(file_name)
-            root, ext = os.path.splitext(file_name)
-            project.csv_files.get_or_create(client=client, name=root, file_name=file_name, path=sup)
-          elif '.wav' in file_name:
-            wav_file_dictionary[file_name] = os.path.join(sup, file_name)
-
-      for i, csv_file in enumerate(project.csv_files.all()):
-        grammar, created = project.grammars.get_or_create(client=client, name=csv_file.name)
-
-        if created:
-          grammar.csv_file = csv_file
-          grammar.id_token = generate_id_token(Grammar)
-          print('created grammar ' + str(grammar))
-
-          with open(os.path.join(csv_file.path, csv_file.file_name)) as open_rel_file:
-            lines = open_rel_file.readlines()
-            for j, line in enumerate(lines):
-              tokens = line.split('|') #this can be part of a relfile parser object with delimeter '|'
-              transcription_audio_file_name = os.path.basename(tokens[0])
-              grammar.wav_files.get_or_create(client=client, project=project, path=wav_file_dictionary[transcription_audio_file_name], file_name=transcription_audio_file_name)
-              print('grammar %d/%d, wav %d/%d'%(i+1,project.csv_files.count(),j+1,len(lines)), end='\r' if j<len(lines)-1 else '\n')
-
-          grammar.save()
-          csv_file.save()
+        grammar.csv_file = csv_file
+        grammar.id_token = generate_id_token(Grammar)
+        print('created grammar ' + str(grammar))
+
+      #register any wav files the grammar does not have yet in bulk
+      existing = set(grammar.wav_files.values_list('file_name', flat=True))
+      wav_files = []
+      missing = 0
+      for transcription_audio_file_name in parse_relfile_file_names(os.path.join(sup, file_name)):
+        if transcription_audio_file_name in existing:
+          continue
+        existing.add(transcription_audio_file_name)
+        if transcription_audio_file_name in wav_file_dictionary:
+          wav_files.append(WavFile(client=client, project=project, grammar=grammar, path=wav_file_dictionary[transcription_audio_file_name], file_name=transcription_audio_file_name))
+        else:
+          missing += 1
+
+      WavFile.objects.bulk_create(wav_files, batch_size=settings.RELFILE_CHUNK_SIZE)
+      print('grammar %d/%d: %d wav files%s' % (i+1, len(project_relfiles), len(wav_files), ', %d missing' % missing if missing else ''))
+
+      grammar.save()
+      csv_file.save()
+
+  forget_removed(diff['removed'])
+
+  #only record the scan once the database is up to date, so a crash is picked up again next time
+  manifest.save()
+  return {key:len(paths) for key, paths in diff.items()}
+
+def forget_removed(paths):
+  '''
+  Remove what was registered for files that have disappeared. Wav files are only removed if they have not been made
+  into transcriptions, and relfiles only if their grammar has not been ingested; the rest is kept and reported.
+  '''
+  wav_paths = [path for path in paths if '.wav' in path]
+  for i in range(0, len(wav_paths), 500):
+    WavFile.objects.filter(path__in=wav_paths[i:i+500], transcription__isnull=True).delete()
+
+  for path in paths:
+    sup, file_name = os.path.split(path)
+    if is_relfile(sup, file_name):
+      for csv_file in CSVFile.objects.filter(path=sup, file_name=file_name).select_related('grammar'):
+        grammar = csv_file.grammar
+        if grammar is not None and grammar.transcriptions.exists():
+          print('removed relfile %s: keeping grammar %s, it has transcriptions' % (path, grammar))
+        else:
+          csv_file.delete()
+          if grammar is not None:
+            grammar.delete()
+          print('removed relfile %s' % path)
+
+def is_relfile(sup, file_name):
+  return '.csv' in file_name and 'Unsorted' not in sup and 'save' not in sup
 
 @task()
-def process_grammar(grammar_id_token):
+def process_grammar(grammar_id_token, chunk_size=None):
+  '''
+  Ingest the relfile of a grammar, then fan its audio out to process_audio_chunk tasks of settings.PROCESSING_CHUNK_SIZE
+  transcriptions, which any worker can pick up. finalize_grammar runs once every chunk is done. Progress is kept on
+  the grammar (processing_status, processing_done, processing_failed, processing_total) and shown in the admin.
+  '''
   grammar = Grammar.objects.get(id_token=grammar_id_token)
+  Grammar.objects.filter(pk=grammar.pk).update(processing_status='ingesting')
   grammar.process()
-  for transcription in grammar.transcriptions.all():
-    transcription.process()
+
+  chunk_size = chunk_size or settings.PROCESSING_CHUNK_SIZE
+  pks = list(grammar.transcriptions.order_by('pk').values_list('pk', flat=True))
+  chunks = [pks[i:i+chunk_size] for i in range(0, len(pks), chunk_size)]
+  Grammar.objects.filter(pk=grammar.pk).update(processing_status='processing', processing_total=len(pks), processing_done=0, processing_failed=0)
+
+  if chunks:
+    chord([process_audio_chunk.si(grammar.pk, chunk) for chunk in chunks])(finalize_grammar.si(grammar_id_token))
+  else:
+    finalize_grammar.delay(grammar_id_token)
+
+@task()
+def process_audio_chunk(grammar_pk, transcription_pks):
+  ''' Process the audio of a chunk of transcriptions and add the outcome to the grammar's progress. '''
+  processed, failures = process_transcriptions(Transcription.objects.filter(pk__in=transcription_pks))
+  Grammar.objects.filter(pk=grammar_pk).update(processing_done=F('processing_done')+processed, processing_failed=F('processing_failed')+len(failures))
+  return processed
+
+@task()
+def finalize_grammar(grammar_id_token):
+  '''
+  Recount the grammar, mark it active if it has transcriptions and build jobs from them. build_jobs keeps the counters
+  of the project right, so the project is only reconciled once, by the last of its grammars to finish processing.
+  '''
+  grammar = Grammar.objects.get(id_token=grammar_id_token)
+  Grammar.objects.filter(pk=grammar.pk).update(processing_status='finalizing')
+  grammar.update()
+  grammar.project.build_jobs(grammar.transcriptions.filter(is_available=True, job__isnull=True), contiguous=True)
+  Grammar.objects.filter(pk=grammar.pk).update(processing_status='done')
+
+  #marked done first: of two grammars finishing together, at least one sees the other done
+  if not grammar.project.grammars.filter(processing_status__in=['ingesting', 'processing', 'finalizing']).exists():
+    grammar.project.update()
+
+@task()
+def reclaim_jobs():
+  ''' Run every minute by celerybeat, see CELERYBEAT_SCHEDULE. '''
+  reclaimed = reclaim_expired_jobs()
+  if reclaimed:
+    print('reclaimed %d jobs' % reclaimed)
+  return reclaimed
@@ -1,12 +1,595 @@
 #woot.apps.distribution.tests
 
 #django
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.db import connection, connections
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import timezone
 
 #local
+from apps.users.models import User
+from apps.distribution.models import Client, Project, Job, claim_job, reclaim_expired_jobs
+from apps.transcription.models import Grammar, Transcription, Revision, Word, CSVFile, WavFile
+from apps.distribution.packing import pack_transcriptions
+from apps.distribution.tasks import process_grammar, finalize_grammar, scan_data
+from apps.distribution.pipeline import run_pipeline
+from libs.corpus import generate_corpus, write_wav, WAVE_FORMAT_PCM, WAVE_FORMAT_ALAW
+from libs.relfile import parse_relfile
+from libs.utils import analyse_wav
+from libs import utils
+
+#util
+import datetime
+import io
+import json
+import math
+import random
+import struct
+import re
+import tempfile
+import threading
+import time
+import zipfile
+import wave
+import os
+from unittest import mock, skipIf
+
+#third party
+from celery import current_app
+try:
+  import audioop
+except ImportError: #removed in python 3.13
+  audioop = None
 
 #vars
 
 #classes
-class TestProjectExport(TestCase):
-  pass
+class ProjectExportData(object):
+  def setUp(self):
+    user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1))
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    job = self.project.jobs.create(client=client, id_token='JOBTOKEN')
+
+    for name in ['first', 'second']:
+      grammar = self.project.grammars.create(client=client, name=name, id_token=name.upper()[:8], date_completed=timezone.now())
+      CSVFile.objects.create(client=client, project=self.project, grammar=grammar, name=name, path='/data/2014/%s' % name, file_name='%s.csv' % name)
+      for i in range(3):
+        transcription = grammar.transcriptions.create(client=client, project=self.project, id_token='%s%d' % (name, i), confidence='ok', utterance='original', value='{}', confidence_value='0.50')
+        WavFile.objects.create(client=client, project=self.project, grammar=grammar, transcription=transcription, path='/data/2014/%s/%d.wav' % (name, i), file_name='%d.wav' % i)
+        transcription.revisions.create(user=user, job=job, id_token='%s%d' % (name[:6], i), utterance='revised %s %d' % (name, i))
+    Revision.objects.update(date_modified=timezone.now()-datetime.timedelta(hours=1))
+
+  def package(self):
+    with zipfile.ZipFile(Project.objects.get(pk=self.project.pk).completed_project_file.path) as package:
+      return {name:package.read(name).decode('utf-8') for name in package.namelist()}
+
+  def relfiles(self):
+    return {'%s.csv' % g.name:''.join(g.export_lines()) for g in self.project.grammars.all()}
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestProjectExport(ProjectExportData, TestCase):
+  def test_package_contains_every_relfile(self):
+    self.project.export(workers=1) #test data is only visible on this connection
+    self.assertEqual(self.package(), self.relfiles())
+
+  def test_only_changed_grammars_are_generated_again(self):
+    self.project.export(workers=1)
+    Transcription.objects.update(value='{changed}') #does not touch the revisions, so only regenerated relfiles show it
+    revision = Revision.objects.get(transcription__id_token='first0')
+    revision.utterance = 'revised again'
+    revision.save()
+
+    Project.objects.get(pk=self.project.pk).export(workers=1)
+    package = self.package()
+    self.assertIn('{changed}', package['first.csv'])
+    self.assertIn('revised again', package['first.csv'])
+    self.assertNotIn('{changed}', package['second.csv'])
+
+def on_this_connection(cls, name):
+  ''' Patch a method so that the threads calling it use the connection of this thread. '''
+  #an in-memory sqlite database only exists on this connection, so the threads share it
+  shared = connection if connection.vendor=='sqlite' else None
+  if shared is not None:
+    shared.allow_thread_sharing = True
+
+  method = getattr(cls, name)
+  def shared_method(self, *args, **kwargs):
+    if shared is not None:
+      connections['default'] = shared
+    return method(self, *args, **kwargs)
+  return mock.patch.object(cls, name, shared_method)
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), EXPORT_BUFFER_SIZE=64)
+class TestThreadedProjectExport(ProjectExportData, TransactionTestCase):
+  def export(self):
+    with on_this_connection(Grammar, 'export_chunks'):
+      Project.objects.get(pk=self.project.pk).export(workers=2)
+
+  def test_relfiles_are_streamed_from_threads(self):
+    self.export() #lines are longer than the buffer, so every relfile is handed over in several chunks
+    self.assertEqual(self.package(), self.relfiles())
+
+  def test_a_failing_relfile_leaves_no_package(self):
+    Revision.objects.filter(transcription__id_token='first2').delete()
+    with self.assertRaises(Revision.DoesNotExist):
+      self.export()
+    self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'completed_projects')), [])
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestThreadedClientExport(ProjectExportData, TransactionTestCase):
+  def export(self):
+    with on_this_connection(Grammar, 'export'):
+      Client.objects.get().export(workers=2)
+
+  def completed(self):
+    completed_dir = os.path.join(settings.MEDIA_ROOT, 'completed', 'client')
+    relfiles = {}
+    for name in os.listdir(completed_dir):
+      with open(os.path.join(completed_dir, name)) as relfile:
+        relfiles[name] = relfile.read()
+    return relfiles
+
+  def test_every_grammar_is_exported(self):
+    self.export()
+    self.assertEqual(self.completed(), self.relfiles())
+
+  def test_a_failing_grammar_leaves_no_temporary_file(self):
+    Revision.objects.filter(transcription__id_token='second2').delete()
+    with self.assertRaises(Revision.DoesNotExist):
+      self.export()
+    self.assertEqual(list(self.completed()), ['first.csv'])
+
+class TestClaimJob(TransactionTestCase):
+  def setUp(self):
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1')
+    for i in range(50):
+      project.jobs.create(client=client, id_token='JOB%05d' % i)
+    self.users = [User.objects.create_user('transcriber%d@arktic.com' % i, datetime.date(1990, 1, 1)) for i in range(100)]
+
+  def test_claim_takes_the_oldest_available_job(self):
+    job = claim_job(self.users[0])
+    self.assertEqual(job.id_token, 'JOB00000')
+    self.assertEqual(job.user, self.users[0])
+    self.assertFalse(job.is_available)
+    self.assertEqual(claim_job(self.users[1]).id_token, 'JOB00001')
+
+  def test_no_job_is_claimed_twice(self):
+    #an in-memory sqlite database only exists on this connection, so the claimers share it
+    shared = connection if connection.vendor=='sqlite' else None
+    if shared is not None:
+      shared.allow_thread_sharing = True
+
+    claims = {}
+    errors = []
+    barrier = threading.Barrier(len(self.users))
+    def claimer(user):
+      if shared is not None:
+        connections['default'] = shared
+      try:
+        barrier.wait()
+        job = claim_job(user)
+        claims[user.pk] = job.pk if job is not None else None
+      except Exception as e:
+        errors.append(e)
+      finally:
+        if shared is None:
+          connection.close()
+
+    threads = [threading.Thread(target=claimer, args=(user,)) for user in self.users]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(errors, [])
+    claimed = [pk for pk in claims.values() if pk is not None]
+    self.assertEqual(len(claimed), 50)
+    self.assertEqual(len(set(claimed)), 50)
+    self.assertEqual(Job.objects.filter(is_available=True).count(), 0)
+    self.assertEqual(sorted(Job.objects.values_list('user', flat=True)), sorted(user_pk for user_pk, pk in claims.items() if pk is not None))
+
+class TestReclaimJobs(TestCase):
+  def setUp(self):
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1')
+    project.jobs.create(client=client, id_token='JOB00000')
+    project.jobs.create(client=client, id_token='JOB00001')
+    self.user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1))
+    self.other_user = User.objects.create_user('other@arktic.com', datetime.date(1990, 1, 1))
+
+  def expire(self, job):
+    Job.objects.filter(pk=job.pk).update(lease_expires=timezone.now()-datetime.timedelta(seconds=1))
+
+  def test_expired_jobs_return_to_the_pool(self):
+    job = claim_job(self.user)
+    active = claim_job(self.other_user)
+    self.expire(job)
+
+    self.assertEqual(reclaim_expired_jobs(), 1)
+    job = Job.objects.get(pk=job.pk)
+    self.assertTrue(job.is_available)
+    self.assertIsNone(job.user)
+    self.assertFalse(Job.objects.get(pk=active.pk).is_available)
+
+  def test_a_reclaimed_lease_is_not_renewed(self):
+    job = claim_job(self.user)
+    self.assertTrue(job.renew_lease(self.user))
+    self.expire(job)
+    reclaim_expired_jobs()
+    self.assertFalse(job.renew_lease(self.user))
+
+@override_settings(ID_TOKEN_POOL_SIZE=3)
+class TestIdTokens(TestCase):
+  def setUp(self):
+    self.addCleanup(utils.id_token_pools.clear)
+    utils.id_token_pools.clear()
+
+  def test_taken_tokens_are_skipped(self):
+    Job.objects.create(id_token='TAKEN000')
+    with mock.patch.object(utils, 'get_id_token', side_effect=['TAKEN000', 'NEW00001', 'NEW00002', 'NEW00003']):
+      self.assertEqual(sorted(utils.generate_id_tokens(Job, 3, batch_size=2)), ['NEW00001', 'NEW00002', 'NEW00003'])
+
+  def test_the_pool_is_refilled_when_empty(self):
+    with self.assertNumQueries(1):
+      id_tokens = [utils.generate_id_token(Job) for i in range(3)]
+    with self.assertNumQueries(1):
+      id_tokens.append(utils.generate_id_token(Job))
+    self.assertEqual(len(set(id_tokens)), 4)
+
+  def test_a_forked_process_fills_its_own_pool(self):
+    utils.generate_id_token(Job)
+    with mock.patch.object(utils.os, 'getpid', return_value=-1), self.assertNumQueries(1):
+      utils.generate_id_token(Job)
+    self.assertEqual(utils.id_token_pools[Job][0], -1)
+
+  def test_threads_share_the_pool(self):
+    counter = iter(range(1000000))
+    def generate_id_tokens(Obj, n):
+      time.sleep(0.001) #let the other threads find the pool empty as well
+      return ['T%07d' % next(counter) for i in range(n)]
+
+    id_tokens, errors = [], []
+    def take():
+      try:
+        for i in range(20):
+          id_tokens.append(utils.generate_id_token(Job))
+      except Exception as e:
+        errors.append(e)
+
+    with mock.patch.object(utils, 'generate_id_tokens', generate_id_tokens):
+      threads = [threading.Thread(target=take) for i in range(10)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(errors, [])
+    self.assertEqual(len(set(id_tokens)), 200)
+
+class TestPackTranscriptions(TestCase):
+  transcriptions = [(1, 5.0), (2, 4.0), (3, 3.0), (4, 3.0), (5, 1.0)]
+
+  def test_jobs_are_balanced(self):
+    jobs = pack_transcriptions(self.transcriptions, 8, 3)
+    self.assertEqual(sorted(pk for job in jobs for pk, audio_time in job), [1, 2, 3, 4, 5])
+    self.assertEqual(sorted(sum(audio_time for pk, audio_time in job) for job in jobs), [8.0, 8.0])
+
+  def test_contiguous_jobs_keep_the_order(self):
+    jobs = pack_transcriptions(self.transcriptions, 8, 3, contiguous=True)
+    self.assertEqual([[pk for pk, audio_time in job] for job in jobs], [[1], [2, 3], [4, 5]])
+
+  def test_jobs_are_capped(self):
+    jobs = pack_transcriptions([(pk, 1.0) for pk in range(10)], 100, 4)
+    self.assertEqual(sorted(len(job) for job in jobs), [3, 3, 4])
+
+  def test_no_empty_jobs_for_long_transcriptions(self):
+    self.assertEqual(pack_transcriptions([(1, 1000.0)], 90, 40), [[(1, 1000.0)]])
+    jobs = pack_transcriptions([(1, 1000.0), (2, 500.0), (3, 10.0)], 90, 40)
+    self.assertEqual(len(jobs), 3)
+    self.assertTrue(all(jobs))
+
+class TestQueryPlans(TestCase):
+  '''
+  The lookups on hot paths must be served by an index. Each query is explained on a seeded database and the test
+  fails if the plan reads the whole of the queried table.
+  '''
+  def setUp(self):
+    user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1))
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    self.grammar = self.project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    for j in range(10):
+      job = self.project.jobs.create(client=client, id_token='JOB%05d' % j, is_available=j%2==0)
+      for i in range(20):
+        transcription = self.grammar.transcriptions.create(client=client, project=self.project, id_token='T%03d%02d' % (j, i), is_active=i%2==0)
+        WavFile.objects.create(client=client, project=self.project, grammar=self.grammar, transcription=transcription, path='/data', file_name='%d-%d.wav' % (j, i))
+        transcription.revisions.create(user=user, job=job, id_token='R%03d%02d' % (j, i), utterance='word%d' % i)
+        Word.objects.create(client=client, project=self.project, char='word%d-%d' % (j, i), id_token='W%03d%02d' % (j, i))
+
+  def full_scans(self, queryset, model):
+    ''' The lines of the plan of the queryset that read every row of the model's table. '''
+    sql, params = queryset.query.sql_with_params()
+    table = model._meta.db_table
+    cursor = connection.cursor()
+
+    if connection.vendor=='sqlite':
+      cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+      plan = [row[-1] for row in cursor.fetchall()]
+      return [line for line in plan if re.match(r'SCAN (TABLE )?%s( AS \w+)?$' % table, line)]
+    elif connection.vendor=='mysql':
+      cursor.execute('EXPLAIN ' + sql, params)
+      columns = [column[0] for column in cursor.description]
+      plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+      return [line for line in plan if line['table']==table and line['type']=='ALL']
+    elif connection.vendor=='postgresql':
+      cursor.execute('SET enable_seqscan = off') #tiny tables are otherwise always scanned
+      cursor.execute('EXPLAIN ' + sql, params)
+      plan = [row[0] for row in cursor.fetchall()]
+      return [line for line in plan if 'Seq Scan on %s' % table in line]
+    self.skipTest('no query plan check for %s' % connection.vendor)
+
+  def assertIndexed(self, queryset, model=None):
+    self.assertEqual(self.full_scans(queryset, model or queryset.model), [])
+
+  def test_lookups_by_id_token(self):
+    self.assertIndexed(Transcription.objects.filter(id_token='T00105'))
+    self.assertIndexed(Job.objects.filter(id_token='JOB00003'))
+    self.assertIndexed(Revision.objects.filter(id_token='R00105'))
+    self.assertIndexed(Project.objects.filter(id_token='PROJECT1'))
+
+  def test_lookups_by_name(self):
+    self.assertIndexed(WavFile.objects.filter(file_name='1-5.wav'))
+    self.assertIndexed(Grammar.objects.filter(name='grammar'))
+    self.assertIndexed(Client.objects.filter(name='client'))
+    self.assertIndexed(Word.objects.filter(project=self.project, char__in=['word1-1', 'word2-2']))
+
+  def test_job_allocation(self):
+    self.assertIndexed(Job.objects.filter(is_available=True).order_by('pk').values_list('pk', flat=True)[:1])
+    self.assertIndexed(Job.objects.filter(is_active=True, is_available=False, lease_expires__lt=timezone.now()))
+    self.assertIndexed(self.project.jobs.filter(is_active=True))
+
+  def test_counters_and_export(self):
+    self.assertIndexed(self.grammar.transcriptions.filter(is_active=True))
+    self.assertIndexed(self.project.transcriptions.filter(is_available=True))
+    self.assertIndexed(Revision.objects.filter(transcription__grammar=self.grammar).order_by('date_created', 'pk'), Revision)
+    self.assertIndexed(Revision.objects.filter(transcription__grammar=self.grammar).order_by('date_created', 'pk'), Transcription)
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), PROCESSING_CHUNK_SIZE=2)
+class TestProcessGrammar(TestCase):
+  def setUp(self):
+    #tasks, chords included, run in this process
+    self.addCleanup(setattr, current_app.conf, 'CELERY_ALWAYS_EAGER', current_app.conf.CELERY_ALWAYS_EAGER)
+    current_app.conf.CELERY_ALWAYS_EAGER = True
+
+    data_dir = tempfile.mkdtemp()
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1')
+    grammar = project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    CSVFile.objects.create(client=client, project=project, grammar=grammar, name='grammar', path=data_dir, file_name='grammar.csv')
+
+    with open(os.path.join(data_dir, 'grammar.csv'), 'w') as relfile:
+      for i in range(5):
+        path = os.path.join(data_dir, '%d.wav' % i)
+        audio = wave.open(path, 'wb')
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(8000)
+        audio.writeframes(b'\x10\x00' * 8000 * (i+1))
+        audio.close()
+
+        WavFile.objects.create(client=client, project=project, grammar=grammar, path=path, file_name='%d.wav' % i)
+        relfile.write('./2014/%d.wav|grammar|ok|utterance %d|{}|500\n' % (i, i))
+
+  def test_pipeline_runs_end_to_end(self):
+    process_grammar.delay('GRAMMAR1')
+
+    grammar = Grammar.objects.get(id_token='GRAMMAR1')
+    self.assertEqual((grammar.processing_status, grammar.processing_total, grammar.processing_done, grammar.processing_failed), ('done', 5, 5, 0))
+    self.assertTrue(grammar.is_active)
+    self.assertEqual(grammar.active_transcriptions, 5)
+    self.assertEqual(sorted(float(t) for t in grammar.transcriptions.values_list('audio_time', flat=True)), [1.0, 2.0, 3.0, 4.0, 5.0])
+    self.assertEqual(grammar.transcriptions.filter(job__isnull=False).distinct().count(), 5)
+    self.assertTrue(Project.objects.get().is_active)
+
+  def test_processing_again_builds_no_jobs(self):
+    process_grammar.delay('GRAMMAR1')
+    jobs = list(Job.objects.order_by('pk').values_list('pk', flat=True))
+
+    process_grammar.delay('GRAMMAR1')
+    self.assertEqual(list(Job.objects.order_by('pk').values_list('pk', flat=True)), jobs)
+    self.assertEqual(Transcription.objects.filter(job__isnull=False).count(), 5) #each in one job
+
+  def test_the_project_is_reconciled_by_its_last_grammar(self):
+    project = Project.objects.get()
+    other = project.grammars.create(client=project.client, name='other', id_token='GRAMMAR2', processing_status='processing')
+    with mock.patch.object(Project, 'update') as update:
+      process_grammar.delay('GRAMMAR1')
+      self.assertEqual(update.call_count, 0)
+
+      finalize_grammar.delay('GRAMMAR2') #nothing to ingest
+      self.assertEqual(update.call_count, 1)
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), PIPELINE_CHECKPOINT=os.path.join(tempfile.mkdtemp(), 'pipeline.json'))
+class TestRunPipeline(TestCase):
+  def setUp(self):
+    data_dir = tempfile.mkdtemp()
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    grammar = self.project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    CSVFile.objects.create(client=client, project=self.project, grammar=grammar, name='grammar', path=data_dir, file_name='grammar.csv')
+
+    with open(os.path.join(data_dir, 'grammar.csv'), 'w') as relfile:
+      for i in range(3):
+        path = os.path.join(data_dir, '%d.wav' % i)
+        audio = wave.open(path, 'wb')
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(8000)
+        audio.writeframes(b'\x10\x00' * 8000)
+        audio.close()
+
+        WavFile.objects.create(client=client, project=self.project, grammar=grammar, path=path, file_name='%d.wav' % i)
+        relfile.write('./2014/%d.wav|grammar|ok|utterance %d|{}|500\n' % (i, i))
+
+  def left(self):
+    report = run_pipeline(Project.objects.all(), from_stage='grammars', dry_run=True)
+    return [(stage, left) for name, stage, left, finished in report]
+
+  def test_resumes_from_database_state(self):
+    self.assertEqual(self.left(), [('grammars', 1), ('transcriptions', 0), ('jobs', 0), ('update', 1)])
+
+    #interrupted after the grammars stage
+    run_pipeline(Project.objects.all(), from_stage='grammars', concurrency=1)
+    Transcription.objects.update(audio_time=None, is_available=False)
+    Job.objects.all().delete()
+    self.assertEqual(self.left(), [('grammars', 0), ('transcriptions', 3), ('jobs', 0), ('update', 1)])
+
+    run_pipeline(Project.objects.all(), from_stage='transcriptions', concurrency=1)
+    self.assertEqual(self.left(), [('grammars', 0), ('transcriptions', 0), ('jobs', 0), ('update', 1)])
+    self.assertEqual(Transcription.objects.filter(job__isnull=False).distinct().count(), 3)
+    self.assertTrue(Project.objects.get().is_active)
+
+class TestGenerateCorpus(TestCase):
+  def test_relfiles_and_wav_files_can_be_read(self):
+    data_dir = tempfile.mkdtemp()
+    counts = generate_corpus(data_dir, grammars=2, transcriptions=4, alaw=0.5, seed=1)
+    self.assertEqual((counts['relfiles'], counts['wav_files']), (2, 8))
+
+    project_path = os.path.join(data_dir, 'client0', 'project0')
+    lines = list(parse_relfile(os.path.join(project_path, 'grammar0.csv')))
+    self.assertEqual(len(lines), 4)
+
+    seconds = 0
+    for line in lines:
+      self.assertTrue(line.utterance)
+      self.assertTrue(0<=line.confidence_value<1)
+      seconds += analyse_wav(os.path.join(project_path, '2014', '10October', '01', line.file_name))[0]
+    self.assertTrue(seconds>0)
+
+  def test_rms_does_not_depend_on_the_chunk_size(self):
+    data_dir = tempfile.mkdtemp()
+    generate_corpus(data_dir, grammars=1, transcriptions=2, alaw=0, seed=2)
+    audio_dir = os.path.join(data_dir, 'client0', 'project0', '2014', '10October', '01')
+    for file_name in os.listdir(audio_dir):
+      path = os.path.join(audio_dir, file_name)
+      with mock.patch.object(utils, 'RMS_CHUNK_SAMPLES', 1001):
+        chunked = analyse_wav(path)
+      self.assertEqual(chunked, analyse_wav(path))
+
+class TestDecodeAudio(TestCase):
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp()
+    self.random = random.Random(0)
+
+  def per_section_rms(self, path):
+    ''' The rms of each section as it was computed before, one section of 16-bit frames at a time like audioop.rms. '''
+    audio = wave.open(path, 'rb')
+    frames = audio.getnframes()
+    per_section = frames // settings.NUMBER_OF_AUDIO_FILE_BINS
+    values = []
+    for i in range(settings.NUMBER_OF_AUDIO_FILE_BINS):
+      data = audio.readframes(per_section if i<settings.NUMBER_OF_AUDIO_FILE_BINS-1 else frames - i*per_section)
+      samples = struct.unpack('<%dh' % (len(data)//2), data)
+      values.append(int(math.sqrt(sum(sample*sample for sample in samples) / float(len(samples)))) if samples else 0)
+    seconds = frames / float(audio.getframerate())
+    audio.close()
+    return seconds, values
+
+  def test_decode_tables_follow_g711(self):
+    alaw, mulaw = utils.alaw_table(), utils.mulaw_table()
+    self.assertEqual([int(alaw[i]) for i in [0xd5, 0x55, 0xaa, 0x2a, 0x80, 0x00]], [8, -8, 32256, -32256, 5504, -5504])
+    self.assertEqual([int(mulaw[i]) for i in [0xff, 0x7f, 0x00, 0x80]], [0, 0, -32124, 32124])
+
+  @skipIf(audioop is None, 'audioop was removed in python 3.13')
+  def test_decode_tables_match_audioop(self):
+    self.assertEqual(utils.alaw_table().astype('<i2').tobytes(), audioop.alaw2lin(bytes(range(256)), 2))
+    self.assertEqual(utils.mulaw_table().astype('<i2').tobytes(), audioop.ulaw2lin(bytes(range(256)), 2))
+
+  def test_rms_matches_the_per_section_algorithm(self):
+    path = os.path.join(self.data_dir, 'pcm.wav')
+    frames = 8000*3 + 77 #not a multiple of the number of sections, so the last one is longer
+    write_wav(path, struct.pack('<%dh' % frames, *[self.random.randint(-32768, 32767) // (1 + i//4000) for i in range(frames)]), WAVE_FORMAT_PCM, 16)
+    self.assertEqual(analyse_wav(path), self.per_section_rms(path))
+
+  @skipIf(audioop is None, 'audioop was removed in python 3.13')
+  def test_alaw_files_are_converted_like_audioop(self):
+    path = os.path.join(self.data_dir, 'alaw.wav')
+    data = bytes(self.random.randrange(256) for i in range(8000))
+    write_wav(path, data, WAVE_FORMAT_ALAW, 8)
+
+    seconds, values = analyse_wav(path, convert=True)
+    audio = wave.open(path, 'rb')
+    self.assertEqual((audio.getsampwidth(), audio.readframes(audio.getnframes())), (2, audioop.alaw2lin(data, 2)))
+    audio.close()
+    self.assertEqual((seconds, values), self.per_section_rms(path))
+
+class TestPackRms(TestCase):
+  def test_values_are_scaled_to_the_loudest_section(self):
+    self.assertEqual(list(utils.pack_rms([0, 50, 100, 32767])), [0, 0, 1, 255])
+    self.assertEqual(list(utils.pack_rms([0, 1, 2])), [0, 128, 255])
+
+  def test_silent_files_stay_at_zero(self):
+    self.assertEqual(utils.pack_rms([0]*settings.NUMBER_OF_AUDIO_FILE_BINS), bytes(settings.NUMBER_OF_AUDIO_FILE_BINS))
+
+  def test_json_envelopes_are_packed_by_the_command(self):
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1')
+    grammar = project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    loud = [float(i*300) for i in range(settings.NUMBER_OF_AUDIO_FILE_BINS)]
+    rows = {
+      'json':json.dumps(loud).encode(),
+      'silent':json.dumps([0.0]*settings.NUMBER_OF_AUDIO_FILE_BINS).encode(),
+      'packed':utils.pack_rms(loud),
+      'empty':b'',
+    }
+    for id_token, audio_rms in rows.items():
+      grammar.transcriptions.create(client=client, project=project, id_token=id_token, audio_rms=audio_rms)
+
+    call_command('rms', stdout=io.StringIO())
+    packed = {id_token:bytes(audio_rms) for id_token, audio_rms in Transcription.objects.values_list('id_token', 'audio_rms')}
+    self.assertEqual(packed, {'json':utils.pack_rms(loud), 'silent':bytes(settings.NUMBER_OF_AUDIO_FILE_BINS), 'packed':utils.pack_rms(loud), 'empty':b''})
+    self.assertEqual(max(packed['json']), 255)
+
+@override_settings(SCAN_MANIFEST=os.path.join(tempfile.mkdtemp(), 'manifest.json'))
+class TestScanData(TestCase):
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp()
+    self.audio_dir = os.path.join(self.data_dir, 'client', 'project', '2014')
+    os.makedirs(self.audio_dir)
+    with open(os.path.join(self.data_dir, 'client', 'project', 'grammar.csv'), 'w') as relfile:
+      for name in ['a', 'b']:
+        relfile.write('./2014/%s.wav|grammar|ok|utterance|{}|500\n' % name)
+    self.write_wav('a')
+
+  def write_wav(self, name):
+    open(os.path.join(self.audio_dir, name + '.wav'), 'wb').close()
+    os.utime(self.audio_dir, ns=(0, os.stat(self.audio_dir).st_mtime_ns + 1)) #in case the clock is coarse
+
+  def wav_files(self):
+    return sorted(WavFile.objects.values_list('file_name', flat=True))
+
+  def test_wav_files_that_arrive_later_are_registered(self):
+    scan_data(data_dir=self.data_dir)
+    self.assertEqual(self.wav_files(), ['a.wav'])
+
+    self.write_wav('b')
+    scan_data(data_dir=self.data_dir)
+    self.assertEqual(self.wav_files(), ['a.wav', 'b.wav'])
+
+  def test_removed_files_are_forgotten(self):
+    scan_data(data_dir=self.data_dir)
+    os.remove(os.path.join(self.audio_dir, 'a.wav'))
+    os.utime(self.audio_dir, ns=(0, os.stat(self.audio_dir).st_mtime_ns + 1))
+    scan_data(data_dir=self.data_dir)
+    self.assertEqual(self.wav_files(), [])
+
+    project_dir = os.path.join(self.data_dir, 'client', 'project')
+    os.remove(os.path.join(project_dir, 'grammar.csv'))
+    os.utime(project_dir, ns=(0, os.stat(project_dir).st_mtime_ns + 1))
+    scan_data(data_dir=self.data_dir)
+    self.assertFalse(Grammar.objects.exists())
+    self.assertFalse(CSVFile.objects.exists())
@@ -2,10 +2,84 @@
 
 #django
 from django.test import TestCase
+from django.test.utils import override_settings
 
 #local
+from apps.users.models import User
+from apps.distribution.models import Client
+from libs import profiling
+
+#util
+import datetime
+import logging
+import json
+from unittest import mock
 
 #vars
 
 #classes
+class ListHandler(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+@override_settings(PROFILING_ENABLED=True)
+class TestProfiling(TestCase):
+  def setUp(self):
+    User.objects.create_superuser('admin@arktic.com', datetime.date(1990, 1, 1), 'password')
+    User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1), 'password')
+    profiling.recent.clear()
+
+    #the records go to this handler instead of the rotating file in DJANGO_ROOT
+    self.handler = ListHandler()
+    handlers = mock.patch.object(profiling.logger, 'handlers', [self.handler])
+    handlers.start()
+    self.addCleanup(handlers.stop)
+
+  def test_requests_are_recorded_by_view(self):
+    self.client.login(email='transcriber@arktic.com', password='password')
+    self.client.get('/start/')
+
+    record = profiling.recent[-1]
+    self.assertEqual((record['url_name'], record['path'], record['status']), ('apps.pages.views.StartView', '/start/', 200))
+    self.assertTrue(record['queries']>0)
+    self.assertEqual(json.loads(self.handler.messages[-1]), record)
+
+  def test_only_staff_see_the_records(self):
+    self.client.login(email='transcriber@arktic.com', password='password')
+    self.assertNotEqual(self.client.get('/profiling/').status_code, 200)
+
+    self.client.login(email='admin@arktic.com', password='password')
+    self.client.get('/start/')
+    response = self.client.get('/profiling/', {'url_name':'apps.pages.views.StartView'})
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(json.loads(response.content.decode())['summary']['apps.pages.views.StartView']['requests'], 1)
+
+  def test_statements_differing_only_in_values_count_as_duplicates(self):
+    self.assertEqual(profiling.normalize('SELECT "id" FROM "job" WHERE ("id_token" = \'AB12\' AND "id" IN (1, 2, 3)) LIMIT 21'), 'SELECT "id" FROM "job" WHERE ("id_token" = ? AND "id" IN (...)) LIMIT ?')
+
+@override_settings(COMPRESS_ENABLED=False)
+class TestStartView(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1), 'password')
+    User.objects.filter(pk=self.user.pk).update(transcriptions_done=7)
+    client = Client.objects.create(name='client')
+    for i, active_transcriptions in enumerate([5, 0, 12]):
+      project = client.projects.create(name='project%d' % i, id_token='PROJECT%d' % i, active_transcriptions=active_transcriptions)
+      for j in range(i+1):
+        project.jobs.create(client=client, id_token='JOB%d%d' % (i, j))
+    project.jobs.create(client=client, id_token='MINE0000', user=self.user, is_available=False)
+    self.client.login(email='transcriber@arktic.com', password='password')
+
+  def test_counters_are_read_in_a_fixed_number_of_queries(self):
+    #session, user, user again, available jobs, projects, active jobs of the user
+    with self.assertNumQueries(6):
+      response = self.client.get('/start/')
 
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual([(project.name, project.active_transcriptions, project.available_jobs) for project in response.context['projects']], [('project0', 5, 1), ('project2', 12, 3)])
+    self.assertEqual((response.context['remaining_transcriptions'], response.context['transcriptions_done_by_user']), (17, 7))
+    self.assertEqual([job.id_token for job in response.context['active_jobs']], ['MINE0000'])
@@ -5,15 +5,19 @@ from django.shortcuts import render
 from django.views.generic import View
 from django.http import HttpResponse, HttpResponseRedirect
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
 from django.template import RequestContext
+from django.db.models import Count
 
 #local
 from apps.pages.forms import LoginForm
 from apps.users.models import User
-from apps.transcription.models import Transcription
+from apps.distribution.models import Project, Job
+from libs import profiling
 
 #util
-import numpy as np
+import json
 
 #classes
 class LoginView(View):
@@ -44,19 +48,46 @@ class StartView(View):
       user = User.objects.get(email=user)
 
       #list of jobs
-      active_jobs = user.jobs.filter(is_active=True)
+      active_jobs = user.jobs.filter(is_active=True).annotate(transcription_count=Count('transcriptions'))
 
-      #total remaining transcriptions
-      remaining_transcriptions = Transcription.objects.filter(is_active=True).count()
-      transcriptions_done_by_user = len(np.unique([revision.transcription.pk for revision in user.revisions.all()]))
+      #remaining transcriptions and available jobs of each project, from counters kept by Transcription.complete
+      available_jobs = dict(Job.objects.filter(is_available=True).values_list('project').annotate(Count('pk')))
+      projects = list(Project.objects.filter(active_transcriptions__gt=0).order_by('name'))
+      for project in projects:
+        project.available_jobs = available_jobs.get(project.pk, 0)
 
       return render(request, 'pages/start.html', {'user':user,
                                                   'active_jobs':active_jobs,
-                                                  'remaining_transcriptions':remaining_transcriptions,
-                                                  'transcriptions_done_by_user':transcriptions_done_by_user,})
+                                                  'projects':projects,
+                                                  'remaining_transcriptions':sum([project.active_transcriptions for project in projects]),
+                                                  'transcriptions_done_by_user':user.transcriptions_done,})
     else:
       return HttpResponseRedirect('/login/')
 
 def logout_view(request):
   logout(request)
   return HttpResponseRedirect('/login/')
+
+@staff_member_required
+def profiling_view(request):
+  '''
+  The latest requests recorded by this process, newest first, with a summary by url name. ?url_name= only shows
+  one view, ?limit= caps the number of requests listed. See libs.profiling.
+  '''
+  records = [record for record in reversed(profiling.recent) if record['url_name']==request.GET['url_name']] if 'url_name' in request.GET else list(reversed(profiling.recent))
+
+  summary = {}
+  for record in records:
+    summary.setdefault(record['url_name'], []).append(record)
+  summary = {url_name:{'requests':len(group),
+                       'mean_ms':sum(record['ms'] for record in group) / len(group),
+                       'max_ms':max(record['ms'] for record in group),
+                       'mean_queries':sum(record['queries'] for record in group) / float(len(group)),
+                       'max_queries':max(record['queries'] for record in group)} for url_name, group in summary.items()}
+
+  try:
+    limit = int(request.GET.get('limit', 100))
+  except ValueError:
+    limit = 100
+
+  return HttpResponse(json.dumps({'enabled':settings.PROFILING_ENABLED, 'summary':summary, 'requests':records[:limit]}, indent=1), content_type='application/json')
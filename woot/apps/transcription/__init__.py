@@ -1 +1 @@
-
+default_app_config = 'apps.transcription.apps.TranscriptionConfig'
@@ -4,3 +4,12 @@
 from django.contrib import admin
 
 #local
+from apps.transcription.models import Grammar
+
+#classes
+class GrammarAdmin(admin.ModelAdmin):
+  list_display = ('name', 'project', 'is_active', 'active_transcriptions', 'processing_status', 'progress', 'processing_done', 'processing_failed', 'processing_total')
+  list_filter = ('processing_status', 'is_active')
+  readonly_fields = ('processing_status', 'processing_total', 'processing_done', 'processing_failed')
+
+admin.site.register(Grammar, GrammarAdmin)
@@ -0,0 +1,12 @@
+#apps.transcription.apps
+
+#django
+from django.apps import AppConfig
+
+#classes
+class TranscriptionConfig(AppConfig):
+  name = 'apps.transcription'
+
+  def ready(self):
+    #connects the signals that keep the word interner and the lexicon version in step with deleted words
+    from apps.transcription import interning
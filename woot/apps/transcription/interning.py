@@ -0,0 +1,156 @@
+#apps.transcription.interning
+
+#django
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+#local
+from apps.distribution.models import Project
+from apps.transcription.models import Word
+from apps.transcription.lexicon import is_lexicon_word, invalidate_lexicon
+from libs.utils import generate_id_tokens
+
+#util
+import threading
+from collections import OrderedDict
+
+#classes
+class WordInterner(object):
+  '''
+  Resolves the words of an utterance to Word primary keys, creating the ones a project does not have yet.
+
+  Each process keeps a char -> pk map for the most recently used settings.WORD_INTERNER_PROJECTS projects, each
+  holding at most settings.WORD_INTERNER_SIZE words. Words missing from the map are looked up with one query and
+  new words are inserted with one bulk insert. The unique (project, char) index settles concurrent inserts. Deleted
+  words are forgotten, and so is everything remembered for a primary key that a new project has taken over.
+  '''
+  def __init__(self):
+    self.projects = OrderedDict() #project pk -> OrderedDict of char -> word pk
+    self.lock = threading.Lock()
+
+  def words(self, project_pk):
+    with self.lock:
+      words = self.projects.pop(project_pk, None)
+      self.projects[project_pk] = words if words is not None else OrderedDict()
+      while len(self.projects)>settings.WORD_INTERNER_PROJECTS:
+        self.projects.popitem(last=False)
+      return self.projects[project_pk]
+
+  def remember(self, words, pairs):
+    with self.lock:
+      for char, pk in pairs:
+        words[char] = pk
+        words.move_to_end(char)
+      while len(words)>settings.WORD_INTERNER_SIZE:
+        words.popitem(last=False)
+
+  def intern(self, project_pk, chars, client_pk=None, grammar_pk=None):
+    '''
+    Returns a dictionary of char -> word pk for chars, and the list of chars that were created.
+    '''
+    words = self.words(project_pk)
+    with self.lock:
+      pks = {char:words[char] for char in chars if char in words}
+
+    #words from the database
+    missing = set(chars) - set(pks)
+    if missing:
+      found = list(Word.objects.filter(project_id=project_pk, char__in=missing).values_list('char', 'pk'))
+      pks.update(pair for pair in found if pair[0] in missing)
+      missing -= set(pks)
+
+    #new words
+    created = sorted(missing)
+    if created:
+      new_words = [Word(project_id=project_pk, client_id=client_pk, grammar_id=grammar_pk, id_token=id_token, char=char, tag=('[' in char and ']' in char)) for char, id_token in zip(created, generate_id_tokens(Word, len(created)))]
+      try:
+        with transaction.atomic():
+          Word.objects.bulk_create(new_words)
+      except IntegrityError:
+        #another process created some of them first: create the rest one by one
+        created = []
+        for word in new_words:
+          try:
+            with transaction.atomic():
+              word.save()
+            created.append(word.char)
+          except IntegrityError:
+            pass
+
+      pks.update(pair for pair in Word.objects.filter(project_id=project_pk, char__in=missing).values_list('char', 'pk') if pair[0] in missing)
+
+      #a case-insensitive collation can match a differently cased word, which is then used as before
+      for char in missing:
+        if char not in pks:
+          pks[char] = Word.objects.filter(project_id=project_pk, char=char).values_list('pk', flat=True)[0]
+
+    #words created inside a transaction that may still roll back are only remembered once they are found again
+    if transaction.get_connection().in_atomic_block:
+      self.remember(words, [(char, pk) for char, pk in pks.items() if char not in missing])
+    else:
+      self.remember(words, pks.items())
+    return pks, created
+
+  def forget(self, project_pk, char=None):
+    ''' Forget a word of a project, or all of its words. '''
+    with self.lock:
+      if char is None:
+        self.projects.pop(project_pk, None)
+      elif project_pk in self.projects:
+        self.projects[project_pk].pop(char, None)
+
+  def clear(self):
+    with self.lock:
+      self.projects.clear()
+
+word_interner = WordInterner()
+
+#methods
+def duplicate_words():
+  ''' (project pk, char) of each set of words that the unique (project, char) index would take as one word. '''
+  #grouped by the database, so that a case-insensitive collation groups differently cased words
+  return Word.objects.values('project', 'char').annotate(count=Count('pk')).filter(count__gt=1).values_list('project', 'char')
+
+def merge_duplicate_words():
+  '''
+  Merge each set of duplicate words into its oldest word, which takes over their links to revisions and transcriptions,
+  and their grammar if it has none. The unique (project, char) index can only be added once this is done, see the
+  indexes command. Returns the number of words removed.
+  '''
+  removed = 0
+  for project_pk, char in list(duplicate_words()):
+    with transaction.atomic():
+      words = list(Word.objects.filter(project_id=project_pk, char=char).order_by('pk'))
+      word, duplicates = words[0], [duplicate.pk for duplicate in words[1:]]
+
+      for Through, column in [(Word.revision.through, 'revision_id'), (Word.transcription.through, 'transcription_id')]:
+        linked = set(Through.objects.filter(word_id__in=duplicates).values_list(column, flat=True))
+        linked -= set(Through.objects.filter(word_id=word.pk).values_list(column, flat=True))
+        Through.objects.filter(word_id__in=duplicates).delete()
+        Through.objects.bulk_create([Through(**{'word_id':word.pk, column:pk}) for pk in linked])
+
+      grammars = [duplicate.grammar_id for duplicate in words if duplicate.grammar_id is not None]
+      Word.objects.filter(pk=word.pk).update(tag=any(duplicate.tag for duplicate in words), grammar=grammars[0] if grammars else None)
+      Word.objects.filter(pk__in=duplicates).delete()
+      removed += len(duplicates)
+
+  return removed
+
+#signals
+@receiver(post_save, sender=Project)
+def forget_new_project(sender, instance, created, **kwargs):
+  if created: #a primary key can be used again, for instance after a rollback in sqlite
+    word_interner.forget(instance.pk)
+
+@receiver(post_delete, sender=Project)
+def forget_deleted_project(sender, instance, **kwargs):
+  word_interner.forget(instance.pk)
+
+@receiver(post_delete, sender=Word)
+def forget_deleted_word(sender, instance, **kwargs):
+  word_interner.forget(instance.project_id, instance.char)
+  if is_lexicon_word(instance.char, instance.tag): #lexicons cached under the old version still offer it
+    invalidate_lexicon(instance.project_id)
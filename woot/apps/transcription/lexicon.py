@@ -0,0 +1,174 @@
+#apps.transcription.lexicon
+
+#django
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, F, Count, Max
+
+#local
+from apps.distribution.models import Project
+
+#util
+import bisect
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+#methods
+def is_lexicon_word(char, tag):
+  ''' Only phrases and tags are offered for autocomplete. '''
+  return tag or ' ' in char
+
+def lexicon_words(project):
+  ''' The words of a project that are offered for autocomplete, see is_lexicon_word. '''
+  return project.words.filter(Q(char__contains=' ') | Q(tag=True))
+
+def get_lexicon(project):
+  '''
+  The autocomplete list for a project. It is cached under the project's lexicon_version, so a stale list is never
+  served after invalidate_lexicon, even by another process.
+  '''
+  key = 'lexicon-%d-%d' % (project.pk, project.lexicon_version)
+  words = cache.get(key)
+  if words is None:
+    words = list(lexicon_words(project).values_list('char', flat=True))
+    cache.set(key, words, settings.LEXICON_CACHE_TIMEOUT)
+  return words
+
+def invalidate_lexicon(project_pk):
+  ''' Called whenever a word that would appear in the lexicon is added to or deleted from a project. '''
+  Project.objects.filter(pk=project_pk).update(lexicon_version=F('lexicon_version')+1)
+
+#prefix index
+class PrefixIndex(object):
+  '''
+  Case-insensitive prefix search over the words of a project, ranked by the number of revisions each word appears in.
+
+  Keys are kept in one sorted list and searched with bisect, so a lookup is two binary searches and a pass over the
+  matching range. Ranges for short prefixes can be large, so their results are memoized until the next change.
+  An index that other threads can read is not changed: words are added to a copy, see PrefixIndexRegistry.
+  '''
+  def __init__(self, entries=()):
+    self.keys = [] #sorted lowercase keys
+    self.chars = [] #word for each key
+    self.frequencies = [] #frequency for each key
+    self.last_pk = 0
+    self.size = 0 #number of words
+    self.memo = {}
+    for pk, char, frequency in entries:
+      self.add(pk, char, frequency, sort=False)
+    self.sort()
+
+  def __len__(self):
+    return self.size
+
+  def copy(self):
+    index = PrefixIndex()
+    index.keys, index.chars, index.frequencies = list(self.keys), list(self.chars), list(self.frequencies)
+    index.last_pk, index.size = self.last_pk, self.size
+    return index
+
+  def add(self, pk, char, frequency=0, sort=True):
+    self.last_pk = max(self.last_pk, pk)
+    self.size += 1
+    for key in index_keys(char):
+      if sort:
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.chars.insert(i, char)
+        self.frequencies.insert(i, frequency)
+      else:
+        self.keys.append(key)
+        self.chars.append(char)
+        self.frequencies.append(frequency)
+    self.memo = {}
+
+  def sort(self):
+    order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+    self.keys = [self.keys[i] for i in order]
+    self.chars = [self.chars[i] for i in order]
+    self.frequencies = [self.frequencies[i] for i in order]
+
+  def search(self, prefix, k=10):
+    prefix = prefix.lower()
+    if not prefix:
+      return []
+    if (prefix, k) in self.memo:
+      return self.memo[(prefix, k)]
+
+    lo = bisect.bisect_left(self.keys, prefix)
+    hi = bisect.bisect_left(self.keys, prefix + '\uffff')
+    matches = []
+    for i in heapq.nlargest(k*2, range(lo, hi), key=lambda i: (self.frequencies[i], -len(self.chars[i]))): #a tag can match under two keys
+      if self.chars[i] not in matches:
+        matches.append(self.chars[i])
+    matches = matches[:k]
+
+    if len(prefix)<=settings.SUGGEST_MEMO_PREFIX_LENGTH:
+      self.memo[(prefix, k)] = matches
+    return matches
+
+def index_keys(char):
+  ''' Tags can also be found without typing the bracket: "noi" finds "[noise]". '''
+  key = char.lower()
+  return [key, key.lstrip('[')] if key.startswith('[') else [key]
+
+def load_prefix_index(project):
+  ''' The settings.SUGGEST_INDEX_SIZE most frequent lexicon words of a project, the same words get_lexicon offers. '''
+  words = lexicon_words(project).annotate(frequency=Count('revision')).order_by('-frequency', 'pk')
+  index = PrefixIndex(words.values_list('pk', 'char', 'frequency')[:settings.SUGGEST_INDEX_SIZE])
+  index.last_pk = lexicon_words(project).aggregate(last_pk=Max('pk'))['last_pk'] or 0 #words trimmed from the index are not reloaded
+  return index
+
+class PrefixIndexRegistry(object):
+  '''
+  Prefix indexes for the most recently used settings.SUGGEST_MAX_PROJECTS projects in this process.
+
+  New words are loaded into an index every settings.SUGGEST_REFRESH_INTERVAL seconds. Frequencies only change when
+  the whole index is rebuilt, every settings.SUGGEST_REBUILD_INTERVAL seconds. New words go into a copy of the index
+  that then replaces it, so a search running in another thread never sees a list halfway through an insert.
+  '''
+  def __init__(self):
+    self.indexes = OrderedDict() #project pk -> (index, refreshed, built)
+    self.lock = threading.Lock()
+
+  def get(self, project):
+    now = time.time()
+    with self.lock:
+      index, refreshed, built = self.indexes.pop(project.pk, (None, 0, 0))
+      if index is None or now - built > settings.SUGGEST_REBUILD_INTERVAL:
+        index, refreshed, built = load_prefix_index(project), now, now
+      elif now - refreshed > settings.SUGGEST_REFRESH_INTERVAL:
+        words = list(lexicon_words(project).filter(pk__gt=index.last_pk).order_by('pk').values_list('pk', 'char'))
+        if words:
+          index = index.copy()
+          for pk, char in words:
+            index.add(pk, char)
+        refreshed = now
+
+      self.indexes[project.pk] = (index, refreshed, built)
+      while len(self.indexes)>settings.SUGGEST_MAX_PROJECTS:
+        self.indexes.popitem(last=False)
+      return index
+
+  def clear(self):
+    with self.lock:
+      self.indexes.clear()
+
+prefix_indexes = PrefixIndexRegistry()
+
+def suggest(project, prefix, k=10):
+  return prefix_indexes.get(project).search(prefix, k)
+
+def use_suggest(project):
+  '''
+  Projects with a large lexicon are autocompleted from the server instead of shipping the lexicon to the browser. The
+  decision is cached under the lexicon version like the lexicon itself, so it is only counted again after a change.
+  '''
+  key = 'lexicon-suggest-%d-%d' % (project.pk, project.lexicon_version)
+  decision = cache.get(key)
+  if decision is None:
+    decision = lexicon_words(project).count()>settings.SUGGEST_THRESHOLD
+    cache.set(key, decision, settings.LEXICON_CACHE_TIMEOUT)
+  return decision
@@ -0,0 +1,171 @@
+#apps.transcription.loadtest
+
+#django
+from django.db import connection, reset_queries
+from django.test import Client as TestClient
+
+#local
+from apps.distribution.models import Job
+from apps.users.models import User
+from libs.corpus import WORDS
+from libs.utils import in_thread
+
+#util
+import ast
+import math
+import json
+import random
+import threading
+import time
+import datetime
+
+#vars
+PAUSE = 60 #seconds: longer gaps between actions in the recorded deltas are breaks, not typing
+ACTIONS = ['play', 'pause', 'key', 'key', 'key', 'tab']
+
+#classes
+class Recorder(object):
+  ''' Latency and number of queries of every request, by endpoint. Shared by the sessions. '''
+  def __init__(self):
+    self.samples = {} #endpoint -> [(seconds, queries, status)]
+    self.lock = threading.Lock()
+
+  def request(self, client, endpoint, method, path, data=None):
+    connection.use_debug_cursor = True #queries are only recorded with a debug cursor
+    reset_queries()
+    start = time.perf_counter()
+    try:
+      response = getattr(client, method)(path, data or {})
+    except Exception:
+      self.record(endpoint, time.perf_counter() - start, 500)
+      raise
+    self.record(endpoint, time.perf_counter() - start, response.status_code)
+    return response
+
+  def record(self, endpoint, seconds, status):
+    with self.lock:
+      self.samples.setdefault(endpoint, []).append((seconds, len(connection.queries), status))
+
+  def report(self):
+    report = {}
+    for endpoint, samples in sorted(self.samples.items()):
+      latencies = sorted(seconds for seconds, queries, status in samples)
+      queries = [queries for seconds, queries, status in samples]
+      report[endpoint] = {
+        'requests':len(samples),
+        'errors':len([status for seconds, queries, status in samples if status>=400]),
+        'p50_ms':1000*percentile(latencies, 50),
+        'p95_ms':1000*percentile(latencies, 95),
+        'p99_ms':1000*percentile(latencies, 99),
+        'queries_mean':sum(queries) / float(len(queries)),
+        'queries_max':max(queries),
+      }
+    return report
+
+class Session(object):
+  '''
+  One simulated transcriber: claims a job from the start page, opens it, and works through its transcriptions. Every
+  recorded delta is one action; after actions_per_transcription actions the revision is saved. Actions are buffered and
+  sent to register_actions when the revision is saved, like the page does, or one by one to action_register.
+  '''
+  def __init__(self, user, password, deltas, recorder, speed=60.0, actions_per_transcription=8, batched=True, seed=0):
+    self.user = user
+    self.client = TestClient()
+    self.client.login(email=user.email, password=password)
+    self.deltas = deltas
+    self.recorder = recorder
+    self.speed = speed
+    self.actions_per_transcription = actions_per_transcription
+    self.batched = batched
+    self.random = random.Random(seed)
+    self.position = self.random.randrange(len(deltas)) #every session replays from somewhere else
+
+  def wait(self):
+    delta = min(self.deltas[self.position % len(self.deltas)], PAUSE)
+    self.position += 1
+    time.sleep(delta / self.speed)
+
+  def request(self, endpoint, method, path, data=None):
+    return self.recorder.request(self.client, endpoint, method, path, data)
+
+  def run(self, until):
+    started = time.perf_counter()
+    try:
+      while time.time()<until:
+        self.request('StartView', 'get', '/start/')
+        location = self.request('create_new_job', 'get', '/new/').get('Location', '')
+        if '/transcription/' not in location:
+          return #no jobs left
+
+        job_id_token = location.rstrip('/').split('/')[-1]
+        self.request('TranscriptionView', 'get', '/transcription/%s' % job_id_token)
+        for transcription_id_token, utterance in Job.objects.get(id_token=job_id_token).transcriptions.values_list('id_token', 'utterance'):
+          if time.time()>=until:
+            return
+          self.transcribe(job_id_token, transcription_id_token, utterance)
+    except Exception as e:
+      #a failed request is also an error of its endpoint, this counts the sessions that stopped early
+      self.recorder.record('session', time.perf_counter() - started, 500)
+      print('%s: session stopped, %s: %s' % (self.user.email, type(e).__name__, e))
+
+  def transcribe(self, job_id_token, transcription_id_token, utterance):
+    actions = []
+    for i in range(self.actions_per_transcription):
+      self.wait()
+      action = {'transcription_id':transcription_id_token, 'action_name':self.random.choice(ACTIONS), 'audio_time':'%.2f' % self.random.random()}
+      if self.batched:
+        actions.append(dict(action, date_performed=time.time()))
+      else:
+        self.request('action_register', 'post', '/transcription/action/', dict(action, job_id=job_id_token))
+
+    if actions:
+      self.request('register_actions', 'post', '/transcription/actions/', {'job_id':job_id_token, 'actions':json.dumps(actions)})
+
+    #now and then a transcriber adds a word of their own
+    words = utterance.split()
+    if self.random.random()<0.1:
+      word = '%s%d' % (self.random.choice(WORDS), self.random.randrange(1000))
+      self.request('add_word', 'post', '/transcription/add/', {'transcription_id':transcription_id_token, 'word':word})
+      words.append(word)
+
+    self.request('update_revision', 'post', '/transcription/revision/', {'transcription_id':transcription_id_token, 'job_id':job_id_token, 'utterance':' '.join(words)})
+
+#methods
+def load_deltas(path):
+  '''
+  The recorded seconds between a transcriber's actions, from the deltas list in time.py. The file is parsed, not
+  imported, because it plots the deltas when it runs.
+  '''
+  with open(path) as open_deltas:
+    tree = ast.parse(open_deltas.read(), path)
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and any(getattr(target, 'id', None)=='deltas' for target in node.targets):
+      return ast.literal_eval(node.value)
+  raise ValueError('no deltas in %s' % path)
+
+def percentile(values, p):
+  ''' Nearest-rank percentile of sorted values. '''
+  if not values:
+    return 0.0
+  return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def create_users(n, password):
+  users = []
+  for i in range(n):
+    email = 'loadtest%d@arktic.com' % i
+    users.append(User.objects.filter(email=email).first() or User.objects.create_user(email, datetime.date(1990, 1, 1), password))
+  return users
+
+def run_load_test(users, password, deltas, duration=60, **session_options):
+  '''
+  Run one session per user in its own thread for duration seconds of wall time and return the report of the recorder.
+  '''
+  recorder = Recorder()
+  sessions = [Session(user, password, deltas, recorder, seed=i, **session_options) for i, user in enumerate(users)]
+  until = time.time() + duration
+  threads = [threading.Thread(target=in_thread(session.run), args=(until,)) for session in sessions]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return recorder.report()
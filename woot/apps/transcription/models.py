@@ -1,21 +1,25 @@
 #apps.transcription.models
 
 #django
-from django.db import models
+from django.db import models, transaction
 from django.core.files import File
-from django.db.models import Q
+from django.db.models import Q, F
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
+from django.utils import timezone
 
 #local
 from apps.distribution.models import Client, Project, Job
 from apps.users.models import User
-from libs.utils import generate_id_token, process_audio
+from libs.utils import process_audio, bulk_update_column, pack_rms
+from apps.transcription.lexicon import is_lexicon_word, invalidate_lexicon
+from libs.relfile import parse_relfile
 
 #util
 import os
 from datetime import datetime as dt
-import json
+import time
+import base64
 
 #vars
 
@@ -27,6 +31,13 @@ class Grammar(models.Model):
     ('en','english'),
     ('es','spanish'),
   )
+  processing_choices = (
+    ('','not started'),
+    ('ingesting','ingesting'),
+    ('processing','processing audio'),
+    ('finalizing','finalizing'),
+    ('done','done'),
+  )
 
   #connections
   client = models.ForeignKey(Client, related_name='grammars')
@@ -34,70 +45,101 @@ class Grammar(models.Model):
 
   #properties
   is_active = models.BooleanField(default=False)
-  id_token = models.CharField(max_length=8, null=True)
-  name = models.CharField(max_length=255)
+  active_transcriptions = models.IntegerField(editable=False, default=0)
+  id_token = models.CharField(max_length=8, null=True, db_index=True)
+  name = models.CharField(max_length=255, db_index=True)
   date_created = models.DateTimeField(auto_now_add=True)
   date_completed = models.DateTimeField(auto_now_add=False, null=True)
   language = models.CharField(max_length=255, choices=language_choices, default='english')
   complete_rel_file = models.FileField(upload_to='completed')
 
+  #-processing progress, see apps.distribution.tasks.process_grammar
+  processing_status = models.CharField(max_length=20, choices=processing_choices, default='')
+  processing_total = models.IntegerField(default=0)
+  processing_done = models.IntegerField(default=0)
+  processing_failed = models.IntegerField(default=0)
+
   #methods
   def __str__(self):
     return '%s > %s > %d:%s > %s'%(self.client.name, self.project.name, self.pk, self.id_token, self.name)
 
-  def update(self):
-    for transcription in self.transcriptions.all():
-      transcription.update()
+  def progress(self):
+    ''' Percentage of the transcriptions whose audio has been processed, for the admin. '''
+    return '%d%%' % (100*(self.processing_done + self.processing_failed)//self.processing_total) if self.processing_total else '-'
 
-    self.is_active = self.transcriptions.filter(is_active=True).count()>0
+  def update(self):
+    ''' Recompute active_transcriptions from scratch. See Project.update. '''
+    self.active_transcriptions = self.transcriptions.filter(is_active=True).count()
+    self.is_active = self.active_transcriptions>0
     self.save()
 
-  def process(self):
+  def process(self, chunk_size=None):
     '''
-    Open relfile and create transcription objects.
+    Stream the relfile and create transcription objects in bulk.
+
+    All wav files for the grammar are loaded once into a file_name -> WavFile map. Transcriptions are written
+    with bulk_create in chunks of settings.RELFILE_CHUNK_SIZE inside a single transaction.
     '''
     if self.transcriptions.count()==0:
-      with open(os.path.join(self.csv_file.path, self.csv_file.file_name)) as open_relfile:
-        lines = open_relfile.readlines()
-        for i, line in enumerate(lines):
-          print('%s: line %d/%d' % (self.name, i+1, len(lines)), end='\r' if i<len(lines)-1 else '\n')
-          tokens = line.split('|') #this can be part of a relfile parser object with delimeter '|'
-          transcription_audio_file_name = os.path.basename(tokens[0])
-          confidence = tokens[2]
-          utterance = tokens[3].strip() if ''.join(tokens[3].split()) != '' else ''
-          value = tokens[4]
-          confidence_value = tokens[5].rstrip() #chomp newline
-          if confidence_value is not '':
-            confidence_value = float(float(confidence_value)/1000.0) #show as decimal
-          else:
-            confidence_value = 0.0
-
-          if self.wav_files.filter(file_name=transcription_audio_file_name).count()>0:
-            #if .filter returns multiple files, take the first and delete the rest
-            if self.wav_files.filter(file_name=transcription_audio_file_name).count()>1:
-              for wav_file_i in self.wav_files.filter(file_name=transcription_audio_file_name):
-                print(wav_file_i)
-              wav_file = self.wav_files.filter(file_name=transcription_audio_file_name)[0]
-              self.wav_files.filter(file_name=transcription_audio_file_name)[1:].delete()
-            else:
-              wav_file = self.wav_files.get(file_name=transcription_audio_file_name)
-
-            transcription, created = self.transcriptions.get_or_create(client=self.client, project=self.project, wav_file__file_name=wav_file.file_name)
-
-            transcription.wav_file = wav_file
-            transcription.save()
-            wav_file.save()
-
-            if created:
-              transcription.id_token = str(transcription.pk)
-              transcription.confidence = confidence
-              transcription.utterance = utterance
-              transcription.value = value
-              transcription.confidence_value = confidence_value
-              transcription.save()
+      chunk_size = chunk_size or settings.RELFILE_CHUNK_SIZE
+      start = time.time()
+
+      #if there are multiple wav files with the same name, take the first and delete the rest
+      wav_files = {}
+      duplicates = []
+      for wav_file in self.wav_files.order_by('pk'):
+        if wav_file.file_name in wav_files:
+          duplicates.append(wav_file.pk)
+        else:
+          wav_files[wav_file.file_name] = wav_file
+
+      with transaction.atomic():
+        if duplicates:
+          print('%s: removing %d duplicate wav files' % (self.name, len(duplicates)))
+          WavFile.objects.filter(pk__in=duplicates).delete()
+
+        rows = 0
+        chunk = []
+        for line in parse_relfile(os.path.join(self.csv_file.path, self.csv_file.file_name)):
+          #a file name appearing twice in the relfile refers to the same transcription
+          wav_file = wav_files.pop(line.file_name, None)
+          if wav_file is not None:
+            chunk.append((wav_file, Transcription(client_id=self.client_id,
+                                                  project_id=self.project_id,
+                                                  grammar=self,
+                                                  confidence=line.confidence,
+                                                  utterance=line.utterance,
+                                                  value=line.value,
+                                                  confidence_value=line.confidence_value)))
+
+          if len(chunk)==chunk_size:
+            rows += self.create_transcriptions(chunk)
+            chunk = []
+            print('%s: %d transcriptions' % (self.name, rows), end='\r')
+
+        if chunk:
+          rows += self.create_transcriptions(chunk)
+
+        self.is_active = True
+        self.save()
 
-      self.is_active = True
-      self.save()
+      seconds = time.time() - start
+      print('%s: %d transcriptions in %.2fs (%.0f rows/s)' % (self.name, rows, seconds, rows/seconds if seconds else 0))
+
+  def create_transcriptions(self, chunk):
+    '''
+    Insert a chunk of (wav_file, transcription) pairs. Transcriptions are given their primary key as an id_token and
+    linked to their wav files. Uses a fixed number of queries per chunk.
+    '''
+    Transcription.objects.bulk_create([transcription for wav_file, transcription in chunk])
+
+    #bulk_create does not return primary keys, but the new rows are the only ones without an id_token
+    new_transcriptions = self.transcriptions.filter(id_token='')
+    pks = list(new_transcriptions.order_by('pk').values_list('pk', flat=True))
+    new_transcriptions.update(id_token=F('id'))
+
+    bulk_update_column(WavFile, 'transcription_id', {wav_file.pk:pk for (wav_file, transcription), pk in zip(chunk, pks)})
+    return len(pks)
 
   def export(self):
     '''
@@ -125,13 +167,47 @@ class Grammar(models.Model):
 
     '''
     completed_dir = os.path.join(settings.MEDIA_ROOT, 'completed', self.client.name)
+    os.makedirs(completed_dir, exist_ok=True)
 
-    if not os.path.exists(completed_dir):
-      os.mkdir(completed_dir)
-
-    with open(os.path.join(completed_dir, '%s.csv'%self.name), 'w+') as csv_file:
-      for t in self.transcriptions.all():
-        csv_file.write(t.line())
+    #written to a temporary file first, so a failed export never leaves a partial relfile behind
+    path = os.path.join(completed_dir, '%s.csv'%self.name)
+    try:
+      with open(path + '.tmp', 'w+', buffering=settings.EXPORT_BUFFER_SIZE) as csv_file:
+        csv_file.writelines(self.export_lines())
+      os.replace(path + '.tmp', path)
+    finally:
+      if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+
+  def export_lines(self):
+    '''
+    The lines of the completed relfile, the same as Transcription.line() for each transcription, in three queries.
+    Raises Revision.DoesNotExist for a transcription without revisions, like revisions.latest() does.
+    '''
+    file_name = self.csv_file.file_name
+
+    #latest revision of each transcription: later revisions overwrite earlier ones
+    utterances = {}
+    for transcription_pk, utterance in Revision.objects.filter(transcription__grammar=self).order_by('date_created', 'pk').values_list('transcription', 'utterance').iterator():
+      utterances[transcription_pk] = utterance
+
+    transcriptions = self.transcriptions.order_by('pk').values_list('pk', 'wav_file__path', 'confidence', 'value', 'confidence_value')
+    for pk, path, confidence, value, confidence_value in transcriptions.iterator():
+      if pk not in utterances:
+        raise Revision.DoesNotExist('transcription %d has no revisions' % pk)
+      yield '%s|%s|%s|%s|%s|%d\n' % ('./' + path[path.index('2014'):], file_name, confidence, utterances[pk], value, int(1000*float(confidence_value)) if confidence_value else 0)
+
+  def export_chunks(self):
+    ''' The lines of export_lines, encoded and joined into chunks of about settings.EXPORT_BUFFER_SIZE bytes. '''
+    chunk, size = [], 0
+    for line in self.export_lines():
+      chunk.append(line)
+      size += len(line)
+      if size>=settings.EXPORT_BUFFER_SIZE:
+        yield ''.join(chunk).encode('utf-8')
+        chunk, size = [], 0
+    if chunk:
+      yield ''.join(chunk).encode('utf-8')
 
 class Transcription(models.Model):
   #connections
@@ -141,11 +217,11 @@ class Transcription(models.Model):
   job = models.ManyToManyField(Job, related_name='transcriptions', null=True)
 
   #properties
-  id_token = models.CharField(max_length=8)
+  id_token = models.CharField(max_length=8, db_index=True)
   audio_file_data_path = models.CharField(max_length=255) #temporary
   audio_file = models.FileField(upload_to='audio')
   audio_time = models.DecimalField(max_digits=8, decimal_places=6, null=True)
-  audio_rms = models.TextField()
+  audio_rms = models.BinaryField(default=b'') #NUMBER_OF_AUDIO_FILE_BINS bytes, see libs.utils.pack_rms
   confidence = models.CharField(max_length=255)
   utterance = models.CharField(max_length=255)
   value = models.CharField(max_length=255)
@@ -157,6 +233,9 @@ class Transcription(models.Model):
   date_last_requested = models.DateTimeField(auto_now_add=False, null=True)
   latest_revision_done_by_current_user = models.BooleanField(default=False)
 
+  class Meta:
+    index_together = [('project', 'is_available'), ('grammar', 'is_active')]
+
   #methods
   def __str__(self):
     return '%s > %s > %d:%s > "%s"'%(self.client.name, self.project.name, self.pk, self.id_token, self.utterance)
@@ -169,69 +248,90 @@ class Transcription(models.Model):
   def grammar_name(self):
     return self.grammar.name if len(self.grammar.name)<50 else self.grammar.name[:46] + '...'
 
+  def latest_revision(self):
+    ''' Same as revisions.latest(), but uses prefetched revisions if there are any. Returns None if there are no revisions. '''
+    revisions = self.revisions.all()
+    return max(revisions, key=lambda revision: revision.date_created) if revisions else None
+
   def latest_revision_words(self):
-    try:
-      latest_revision = self.revisions.latest()
-      return latest_revision.split_utterance()
-    except ObjectDoesNotExist:
-      return []
+    latest_revision = self.latest_revision()
+    return latest_revision.split_utterance() if latest_revision is not None else []
 
   def update(self):
     #if deactivation condition is satisfied, deactivate transcription
     self.is_active = not self.deactivation_condition()
     self.save()
 
+  def complete(self):
+    '''
+    Deactivate the transcription and decrement the active counters of its jobs, grammar and project, closing any of
+    them that reach zero. Only the first call for a transcription has any effect. This is a fixed number of queries
+    however large the job, grammar or project is, and should run in the same transaction as the revision save.
+    '''
+    if Transcription.objects.filter(pk=self.pk, is_active=True).update(is_active=False):
+      self.is_active = False
+      now = timezone.now()
+
+      jobs = Job.objects.filter(transcriptions=self)
+      jobs.update(active_transcriptions=F('active_transcriptions')-1)
+      jobs.filter(is_active=True, active_transcriptions__lte=0).update(is_active=False, date_completed=now)
+
+      grammars = Grammar.objects.filter(pk=self.grammar_id)
+      grammars.update(active_transcriptions=F('active_transcriptions')-1)
+      grammars.filter(is_active=True, active_transcriptions__lte=0).update(is_active=False, date_completed=now)
+
+      projects = Project.objects.filter(pk=self.project_id)
+      projects.update(active_transcriptions=F('active_transcriptions')-1)
+      projects.filter(is_active=True, active_transcriptions__lte=0).update(is_active=False)
+
+  def reopen(self):
+    '''
+    The reverse of complete: reactivate the transcription if none of its revisions has an utterance any more, and
+    increment the active counters of its jobs, grammar and project, reopening any of them that had been closed.
+    '''
+    if not self.revisions.exclude(utterance='').exists() and Transcription.objects.filter(pk=self.pk, is_active=False).update(is_active=True):
+      self.is_active = True
+      Job.objects.filter(transcriptions=self).update(active_transcriptions=F('active_transcriptions')+1, is_active=True, date_completed=None)
+      Grammar.objects.filter(pk=self.grammar_id).update(active_transcriptions=F('active_transcriptions')+1, is_active=True, date_completed=None)
+      Project.objects.filter(pk=self.project_id).update(active_transcriptions=F('active_transcriptions')+1, is_active=True)
+
   def deactivation_condition(self):
     ''' Has at least one revision with an utterance'''
     return (self.revisions.exclude(utterance='').count()>0)
 
   def set_latest_revision_done_by_current_user(self, user):
-    if self.revisions.count()>0:
-      latest_revision = self.revisions.latest()
-      self.latest_revision_done_by_current_user = (latest_revision.user.email==user.email and latest_revision.utterance!='')
-    else:
-      self.latest_revision_done_by_current_user = False
-    self.save()
+    ''' This depends on who is asking, so it is set for the current request only and never saved. '''
+    latest_revision = self.latest_revision()
+    self.latest_revision_done_by_current_user = (latest_revision is not None and latest_revision.user_id==user.pk and latest_revision.utterance!='')
 
   def process(self):
     #1. process audio file -> IRREVERSIBLE
-    if len(self.audio_rms)<10:
-      (seconds, rms_values) = process_audio(self.wav_file.path)
-      self.audio_time = seconds
-
-      max_rms = max(rms_values)
-      rms_values = [float(value)/float(max_rms) for value in rms_values]
-
-      self.audio_rms = json.dumps(rms_values)
-
-      #2. add open audio file to transcription
-      with open(self.wav_file.path, 'rb') as open_audio_file:
-        self.audio_file = File(open_audio_file)
-        self.save()
+    #2. add audio file to transcription
+    if not self.audio_rms:
+      self.audio_time, self.audio_rms, self.audio_file = analyse_audio(self.wav_file.path)
 
     self.is_active = True
     self.is_available = True
     self.save()
 
-  def unpack_rms(self):
-    return [(int(rms*31+1), 32-int(rms*31+1)) for rms in json.loads(self.audio_rms)]
+  def packed_rms(self):
+    ''' The envelope as base64 for the job page, where it is drawn by transcription.js. '''
+    return base64.b64encode(bytes(self.audio_rms)).decode()
 
   def process_words(self):
+    ''' Link the tags of the original utterance. See apps.transcription.interning. '''
+    from apps.transcription.interning import word_interner
+
     if self.words.count()==0:
-      words = self.utterance.split()
-      for word in words:
-        tag = ('[' in word or ']' in word)
-
-        #many to many relationship
-        if tag and not (('[' in word and ']' not in word) or (']' in word and '[' not in word)):
-          w, created = self.project.words.get_or_create(char=word) #unique by char to project
-          if created:
-            w.client = self.client
-            w.grammar = self.grammar
-            w.id_token = generate_id_token(Word)
-            w.tag = True
-            self.words.add(w)
-            w.save()
+      #tags only, rejecting tokens with only one bracket
+      words = [word for word in self.utterance.split() if '[' in word and ']' in word]
+      if words:
+        pks, created = word_interner.intern(self.project_id, words, client_pk=self.client_id, grammar_pk=self.grammar_id)
+        if created:
+          invalidate_lexicon(self.project_id)
+
+        Through = Word.transcription.through
+        Through.objects.bulk_create([Through(word_id=pk, transcription_id=self.pk) for pk in set(pks.values())])
 
 class Revision(models.Model):
   #connections
@@ -240,14 +340,20 @@ class Revision(models.Model):
   job = models.ForeignKey(Job, related_name='revisions')
 
   #properties
-  id_token = models.CharField(max_length=8)
+  id_token = models.CharField(max_length=8, db_index=True)
   date_created = models.DateTimeField(auto_now_add=True)
+  date_modified = models.DateTimeField(auto_now=True, db_index=True) #used to find grammars changed since the last export
   utterance = models.CharField(max_length=255)
 
   ''' need to be determined by action_sequence() '''
   time_to_complete = models.DecimalField(max_digits=8, decimal_places=6, null=True)
   number_of_plays = models.IntegerField(default=0)
 
+  #sorting
+  class Meta:
+    get_latest_by = 'date_created'
+    index_together = [('transcription', 'user')]
+
   #methods
   def __str__(self):
     return '%s: "%s" modified to "%s" > by %s'%(self.id_token, self.transcription.utterance, self.utterance, self.user)
@@ -259,29 +365,26 @@ class Revision(models.Model):
     pass
 
   def process_words(self):
-    words = self.utterance.split()
-    for word in words:
-      #many to many relationship
-      if not (('[' in word and ']' not in word) or (']' in word and '[' not in word)): #reject with only one bracket
-        w, created = self.job.project.words.get_or_create(char=word) #unique by char to project
-        if created:
-          w.client = self.transcription.client
-          w.grammar = self.transcription.grammar
-          w.id_token = generate_id_token(Word)
-          w.tag = ('[' in word and ']' in word)
+    '''
+    Replace the words linked to the revision with the words of its utterance, creating new words for the project in
+    bulk. See apps.transcription.interning.
+    '''
+    from apps.transcription.interning import word_interner
 
-        self.words.add(w)
-        w.save()
+    words = [word for word in self.utterance.split() if not (('[' in word and ']' not in word) or (']' in word and '[' not in word))] #reject with only one bracket
+    pks, created = word_interner.intern(self.job.project_id, words, client_pk=self.transcription.client_id, grammar_pk=self.transcription.grammar_id) if words else ({}, [])
+    if any(is_lexicon_word(char, '[' in char and ']' in char) for char in created):
+      invalidate_lexicon(self.job.project_id)
+
+    Through = Word.revision.through
+    Through.objects.filter(revision=self).delete()
+    Through.objects.bulk_create([Through(word_id=pk, revision_id=self.pk) for pk in set(pks.values())])
 
   def process_actions(self):
     for action in self.job.actions.filter(transcription=self.transcription):
       self.actions.add(action)
       action.save()
 
-  #sorting
-  class Meta:
-    get_latest_by = 'date_created'
-
 class Word(models.Model):
   #connections
   client = models.ForeignKey(Client, related_name='words', null=True)
@@ -291,10 +394,13 @@ class Word(models.Model):
   revision = models.ManyToManyField(Revision, related_name='words')
 
   #properties
-  id_token = models.CharField(max_length=8)
+  id_token = models.CharField(max_length=8, db_index=True)
   char = models.CharField(max_length=255)
   tag = models.BooleanField(default=False)
 
+  class Meta:
+    unique_together = ('project', 'char')
+
   #methods
   def __str__(self):
     return self.char
@@ -308,8 +414,9 @@ class Action(models.Model): #lawsuit
   revision = models.ForeignKey(Revision, related_name='actions', null=True)
 
   #properties
-  id_token = models.CharField(max_length=8)
+  id_token = models.CharField(max_length=8, db_index=True)
   date_created = models.DateTimeField(auto_now_add=True)
+  date_performed = models.DateTimeField(null=True) #when the action happened in the browser, see register_actions
   char = models.CharField(max_length=255, default='')
   audio_time = models.DecimalField(max_digits=8, decimal_places=6, null=True) #time at which the audio was skipped: next
 
@@ -327,7 +434,7 @@ class CSVFile(models.Model):
   #properties
   name = models.CharField(max_length=255)
   path = models.TextField(max_length=255)
-  file_name = models.TextField(max_length=255)
+  file_name = models.CharField(max_length=255, db_index=True)
 
   #methods
   def __str__(self):
@@ -342,8 +449,22 @@ class WavFile(models.Model):
 
   #properties
   path = models.TextField(max_length=255)
-  file_name = models.TextField(max_length=255)
+  file_name = models.CharField(max_length=255, db_index=True)
 
   #methods
   def __str__(self):
     return '%s > %s > %s > %d:%s'%(self.client.name, self.project.name, self.grammar.name, self.pk, self.file_name)
+
+#methods
+def analyse_audio(wav_file_path):
+  '''
+  Process a wav file and copy it into media storage as a transcription audio file.
+  Returns (seconds, rms, audio file name). Does not touch the database, so it is safe to run in a worker process.
+  '''
+  (seconds, rms_values) = process_audio(wav_file_path)
+
+  field = Transcription._meta.get_field('audio_file')
+  with open(wav_file_path, 'rb') as open_audio_file:
+    audio_file_name = field.storage.save(field.generate_filename(None, wav_file_path), File(open_audio_file))
+
+  return seconds, pack_rms(rms_values), audio_file_name
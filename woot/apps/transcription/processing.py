@@ -0,0 +1,90 @@
+#apps.transcription.processing
+
+#django
+from django.conf import settings
+from django.db import connections, transaction
+
+#local
+from apps.transcription.models import Transcription, Revision, analyse_audio
+from libs.utils import bulk_update_column
+
+#util
+import time
+import traceback
+from multiprocessing import Pool
+
+#methods
+def process_transcriptions(transcriptions, workers=1, batch_size=None):
+  '''
+  Process the audio of a queryset of transcriptions, optionally across a pool of worker processes.
+
+  Workers decode the audio, compute the rms envelope and copy the file into media storage. They never touch the
+  database: results are written back by this process in batches of settings.TRANSCRIPTION_BATCH_SIZE, each in its
+  own transaction, so a crash partway through leaves every finished batch committed. Transcriptions that already have
+  audio are left as they are, and only the ones processed here that are in no job and have no revision with an
+  utterance are made active and available.
+  Returns (number processed, list of (pk, error) failures).
+  '''
+  batch_size = batch_size or settings.TRANSCRIPTION_BATCH_SIZE
+
+  processed = 0
+  targets = list(transcriptions.filter(audio_time__isnull=True).values_list('pk', 'wav_file__path'))
+
+  count = len(targets)
+  failures = []
+  batch = []
+  start = time.time()
+
+  if workers>1:
+    #forked workers must not share the parent's database connections
+    for connection in connections.all():
+      connection.close()
+    pool = Pool(workers)
+    results = pool.imap_unordered(analyse_worker, targets, chunksize=max(1, min(batch_size, count//(workers*4) or 1)))
+  else:
+    pool = None
+    results = map(analyse_worker, targets)
+
+  try:
+    for i, (pk, result, error) in enumerate(results):
+      if error is None:
+        batch.append((pk, result))
+      else:
+        failures.append((pk, error))
+
+      if len(batch)==batch_size:
+        processed += write_batch(batch)
+        batch = []
+
+      seconds = time.time() - start
+      print('transcription %d/%d (%.1f/s, %d failed)' % (i+1, count, (i+1)/seconds if seconds else 0, len(failures)), end='\r' if i<count-1 else '\n')
+
+    if batch:
+      processed += write_batch(batch)
+  finally:
+    if pool is not None:
+      pool.terminate()
+
+  for pk, error in failures:
+    print('transcription %d failed: %s' % (pk, error.strip().split('\n')[-1]))
+
+  return processed, failures
+
+def analyse_worker(target):
+  pk, wav_file_path = target
+  try:
+    return pk, analyse_audio(wav_file_path), None
+  except Exception:
+    return pk, None, traceback.format_exc()
+
+def write_batch(batch):
+  ''' Write a batch of analysed transcriptions with one statement per column. '''
+  with transaction.atomic():
+    bulk_update_column(Transcription, 'audio_time', {pk:seconds for pk, (seconds, rms, audio_file_name) in batch})
+    bulk_update_column(Transcription, 'audio_rms', {pk:rms for pk, (seconds, rms, audio_file_name) in batch})
+    bulk_update_column(Transcription, 'audio_file', {pk:audio_file_name for pk, (seconds, rms, audio_file_name) in batch})
+
+    #jobbed or completed transcriptions keep their state, see Transcription.complete
+    done = Revision.objects.exclude(utterance='').values('transcription')
+    Transcription.objects.filter(pk__in=[pk for pk, result in batch], job__isnull=True).exclude(pk__in=done).update(is_active=True, is_available=True)
+  return len(batch)
@@ -3,6 +3,18 @@ $(document).ready(function() {
   var numchars = ["zero","one","two","three","four","five","six","seven","eight","nine"];
 
   //--SETUP AND BINDINGS
+  //draw waveforms: the rms attribute holds one base64 encoded byte per bar
+  $('canvas.bars').each(function(){
+    var bins = atob($(this).attr('rms'));
+    var context = this.getContext('2d');
+    var barWidth = this.width/bins.length;
+    context.fillStyle = 'gray';
+    for (var i=0;i<bins.length;i++) {
+      var height = Math.floor(bins.charCodeAt(i)*31/255) + 1;
+      context.fillRect(i*barWidth, this.height-height, barWidth, height);
+    }
+  });
+
   //set up play variable for play-pause button
   var play = $('li.audio:first audio').attr('id');
   $('#play-pause').attr('play', play);
@@ -1,10 +1,482 @@
 #woot.apps.transcription.tests
 
 #django
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.conf import settings
+from django.utils import timezone
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError
 
 #local
+from apps.users.models import User
+from apps.distribution.models import Client, Project, Job, reclaim_expired_jobs
+from apps.transcription.models import Grammar, Transcription, Revision, Action, CSVFile, WavFile, Word
+from apps.transcription.lexicon import PrefixIndex, prefix_indexes, suggest, use_suggest, invalidate_lexicon
+from apps.transcription.interning import word_interner
+from apps.transcription.loadtest import Recorder, Session, load_deltas, percentile
+from apps.transcription.processing import process_transcriptions
+from libs.utils import pack_rms
+
+#util
+import base64
+import datetime
+import io
+import json
+import os
+import tempfile
+import time
+import wave
+from unittest import mock
 
 #vars
 
 #classes
+@override_settings(COMPRESS_ENABLED=False)
+class TestTranscriptionView(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1), password='password')
+    other_user = User.objects.create_user('other@arktic.com', datetime.date(1990, 1, 1), password='password')
+
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1')
+    grammar = project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    self.job = project.jobs.create(client=client, user=self.user, id_token='JOBTOKEN', is_available=False)
+
+    for i in range(20):
+      transcription = grammar.transcriptions.create(client=client, project=project, id_token=str(i), utterance='original %d' % i, audio_file='audio/%d.wav' % i, is_active=True)
+      transcription.job.add(self.job)
+      if i%2==0: #every other transcription was last revised by the current user
+        first = transcription.revisions.create(user=other_user, job=self.job, id_token='R%d' % i, utterance='first')
+        transcription.revisions.create(user=self.user, job=self.job, id_token='S%d' % i, utterance='second')
+        Revision.objects.filter(pk=first.pk).update(date_created=timezone.now()-datetime.timedelta(hours=1))
+
+    self.client.login(email='transcriber@arktic.com', password='password')
+
+  def test_get_uses_a_fixed_number_of_queries(self):
+    #session, user, job, transcriptions, revisions
+    with self.assertNumQueries(5):
+      response = self.client.get('/transcription/JOBTOKEN')
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual([t.latest_revision_done_by_current_user for t in response.context['transcriptions']], [int(t.id_token)%2==0 for t in response.context['transcriptions']])
+
+  def test_envelopes_are_drawn_from_base64(self):
+    envelope = pack_rms([i % 7 for i in range(settings.NUMBER_OF_AUDIO_FILE_BINS)])
+    Transcription.objects.filter(id_token='3').update(audio_rms=envelope)
+    transcription = Transcription.objects.get(id_token='3')
+    self.assertEqual(base64.b64decode(transcription.packed_rms()), envelope)
+
+    #transcription.js reads one byte per bar from the rms attribute of the canvas
+    response = self.client.get('/transcription/JOBTOKEN')
+    self.assertContains(response, 'rms="%s"' % transcription.packed_rms())
+    self.assertEqual(len(base64.b64decode(transcription.packed_rms())), settings.NUMBER_OF_AUDIO_FILE_BINS)
+
+  def test_actions_are_registered_in_one_request(self):
+    actions = [{'transcription_id':str(i), 'action_name':'replay', 'audio_time':i/10.0, 'date_performed':1414000000+i} for i in range(5)]
+    actions.append({'transcription_id':'not in the job', 'action_name':'replay', 'audio_time':0, 'date_performed':1414000000})
+    response = self.client.post('/transcription/actions/', {'job_id':'JOBTOKEN', 'actions':json.dumps(actions)})
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(Action.objects.count(), 5)
+    self.assertEqual(len(set(Action.objects.values_list('id_token', flat=True))), 5)
+    action = Action.objects.get(transcription__id_token='3')
+    self.assertEqual((action.char, float(action.audio_time), action.user), ('replay', 0.3, self.user))
+    self.assertEqual(action.date_performed, datetime.datetime.fromtimestamp(1414000003, timezone.utc))
+
+  def test_malformed_actions_are_rejected(self):
+    for action in [{'transcription_id':'0', 'audio_time':'soon'}, {'transcription_id':'0', 'date_performed':'yesterday'}, {'transcription_id':'0', 'date_performed':1e300}, 'play']:
+      response = self.client.post('/transcription/actions/', {'job_id':'JOBTOKEN', 'actions':json.dumps([action])})
+      self.assertEqual(response.status_code, 400)
+    self.assertEqual(Action.objects.count(), 0)
+
+  def test_get_writes_nothing(self):
+    before = list(Transcription.objects.order_by('pk').values_list('is_active', 'latest_revision_done_by_current_user'))
+    self.client.get('/transcription/JOBTOKEN')
+    self.assertEqual(list(Transcription.objects.order_by('pk').values_list('is_active', 'latest_revision_done_by_current_user')), before)
+
+class TestPrefixIndex(TestCase):
+  def setUp(self):
+    self.index = PrefixIndex([(1, 'hello', 2), (2, 'help', 5), (3, '[noise]', 1), (4, 'Helium', 0), (5, 'world', 9)])
+
+  def test_search_is_ranked_by_frequency(self):
+    self.assertEqual(self.index.search('hel'), ['help', 'hello', 'Helium'])
+    self.assertEqual(self.index.search('HEL', k=1), ['help'])
+
+  def test_tags_match_without_the_bracket(self):
+    self.assertEqual(self.index.search('noi'), ['[noise]'])
+    self.assertEqual(self.index.search('[n'), ['[noise]'])
+
+  def test_added_words_are_found(self):
+    self.index.search('w')
+    self.index.add(6, 'wonder', 10)
+    self.assertEqual(self.index.search('w'), ['wonder', 'world'])
+    self.assertEqual(self.index.last_pk, 6)
+
+@override_settings(SUGGEST_THRESHOLD=1)
+class TestSuggest(TestCase):
+  def setUp(self):
+    prefix_indexes.clear()
+    cache.clear()
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    for i, (char, tag) in enumerate([('hello', False), ('hello there', False), ('[hesitation]', True), ('help me', False)]):
+      self.project.words.create(client=client, id_token='W%d' % i, char=char, tag=tag)
+
+  def test_only_lexicon_words_are_suggested(self):
+    self.assertEqual(sorted(suggest(self.project, 'he')), ['[hesitation]', 'hello there', 'help me'])
+
+  @override_settings(SUGGEST_REFRESH_INTERVAL=-1)
+  def test_new_words_go_into_a_copy_of_the_index(self):
+    index = prefix_indexes.get(self.project)
+    self.assertEqual(len(index), 3)
+    self.project.words.create(id_token='W9', char='hello again')
+
+    refreshed = prefix_indexes.get(self.project)
+    self.assertIsNot(refreshed, index)
+    self.assertEqual((len(index), len(refreshed)), (3, 4)) #searches still running on the old index see it unchanged
+    self.assertEqual(refreshed.search('hello a'), ['hello again'])
+    self.assertIs(prefix_indexes.get(self.project), refreshed) #nothing new, nothing copied
+
+  def test_the_decision_is_cached_until_the_lexicon_changes(self):
+    self.assertTrue(use_suggest(self.project))
+    with self.assertNumQueries(0):
+      use_suggest(self.project)
+
+    invalidate_lexicon(self.project.pk)
+    self.project = Project.objects.get(pk=self.project.pk)
+    with self.assertNumQueries(1):
+      use_suggest(self.project)
+
+class TestLexiconView(TestCase):
+  def setUp(self):
+    cache.clear() #lexicons of earlier tests were cached under the same project pk
+    user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1), password='password')
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    job = self.project.jobs.create(client=client, id_token='JOBTOKEN')
+    grammar = self.project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    transcription = grammar.transcriptions.create(client=client, project=self.project, id_token='T', utterance='original')
+    self.revision = transcription.revisions.create(user=user, job=job, id_token='R', utterance='hello [noise]')
+    self.project.words.create(client=client, id_token='W1', char='[breath]', tag=True)
+    self.client.login(email='transcriber@arktic.com', password='password')
+
+  def get(self, etag=None):
+    return self.client.get('/transcription/lexicon/PROJECT1/', **({'HTTP_IF_NONE_MATCH':etag} if etag else {}))
+
+  def assertChanged(self, etag):
+    response = self.get(etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+
+  def test_an_unchanged_lexicon_is_not_sent_again(self):
+    response = self.get()
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(json.loads(response.content.decode())['words'], ['[breath]'])
+    self.assertEqual(self.get(response['ETag']).status_code, 304)
+
+  def test_added_words_change_the_etag(self):
+    etag = self.get()['ETag']
+    self.client.post('/transcription/add/', {'transcription_id':'T', 'word':'hello there'})
+    self.assertChanged(etag)
+
+  def test_words_of_revisions_change_the_etag(self):
+    etag = self.get()['ETag']
+    self.revision.process_words()
+    self.assertChanged(etag)
+
+  def test_deleted_words_change_the_etag(self):
+    etag = self.get()['ETag']
+    self.project.words.filter(char='[breath]').delete()
+    self.assertChanged(etag)
+    self.assertEqual(json.loads(self.get().content.decode())['words'], [])
+
+class TestGrammarProcess(TestCase):
+  def setUp(self):
+    data_dir = tempfile.mkdtemp()
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    self.grammar = self.project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    CSVFile.objects.create(client=client, project=self.project, grammar=self.grammar, name='grammar', path=data_dir, file_name='grammar.csv')
+    for i in range(5):
+      WavFile.objects.create(client=client, project=self.project, grammar=self.grammar, path=os.path.join(data_dir, '%d.wav' % i), file_name='%d.wav' % i)
+
+    with open(os.path.join(data_dir, 'grammar.csv'), 'w') as relfile:
+      for i in [0, 1, 2, 1, 3, 9, 4]: #1 appears twice, 9 has no wav file
+        relfile.write('./2014/%d.wav|grammar|ok|utterance %d|{code:%d}|%d\n' % (i, i, i, 100*i))
+      relfile.write('\n')
+
+    #a transcription of another grammar that is still waiting for its id_token
+    other = self.project.grammars.create(client=client, name='other', id_token='GRAMMAR2')
+    self.placeholder = other.transcriptions.create(client=client, project=self.project, id_token='')
+
+  def test_each_wav_file_gets_one_transcription(self):
+    self.grammar.process(chunk_size=2)
+
+    transcriptions = list(self.grammar.transcriptions.order_by('pk'))
+    self.assertEqual([(t.utterance, t.value, float(t.confidence_value)) for t in transcriptions], [('utterance %d' % i, '{code:%d}' % i, i/10.0) for i in range(5)])
+    self.assertEqual([t.id_token for t in transcriptions], [str(t.pk) for t in transcriptions])
+    self.assertEqual([t.wav_file.file_name for t in transcriptions], ['%d.wav' % i for i in range(5)])
+    self.assertTrue(Grammar.objects.get(pk=self.grammar.pk).is_active)
+    self.assertEqual(Transcription.objects.get(pk=self.placeholder.pk).id_token, '') #only the grammar's own rows are numbered
+
+  def test_a_processed_grammar_is_not_processed_again(self):
+    self.grammar.process()
+    with self.assertNumQueries(1):
+      self.grammar.process()
+    self.assertEqual(self.grammar.transcriptions.count(), 5)
+
+class TestGrammarExport(TestCase):
+  def setUp(self):
+    user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1))
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1')
+    job = project.jobs.create(client=client, id_token='JOBTOKEN')
+    self.grammar = project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    CSVFile.objects.create(client=client, project=project, grammar=self.grammar, name='grammar', path='/data/2014/grammar', file_name='grammar.csv')
+
+    for i in range(5):
+      transcription = self.grammar.transcriptions.create(client=client, project=project, id_token=str(i), confidence='ok', utterance='original %d' % i, value='{code:%d}' % i, confidence_value='0.%d2' % i)
+      WavFile.objects.create(client=client, project=project, grammar=self.grammar, transcription=transcription, path='/data/2014/10October/01/%d.wav' % i, file_name='%d.wav' % i)
+      for j in range(i%3+1):
+        revision = transcription.revisions.create(user=user, job=job, id_token='R%d%d' % (i, j), utterance='revision %d of %d' % (j, i))
+        Revision.objects.filter(pk=revision.pk).update(date_created=timezone.now()-datetime.timedelta(hours=3-j))
+
+  def test_lines_match_transcription_line(self):
+    with self.assertNumQueries(3):
+      lines = list(self.grammar.export_lines())
+
+    self.assertEqual(lines, [t.line() for t in self.grammar.transcriptions.order_by('pk')])
+    self.assertEqual(lines[2], './2014/10October/01/2.wav|grammar.csv|ok|revision 2 of 2|{code:2}|220\n')
+
+class TestRevisionWords(TestCase):
+  def setUp(self):
+    user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1), password='password')
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    job = self.project.jobs.create(client=client, id_token='JOBTOKEN')
+    grammar = self.project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    transcription = grammar.transcriptions.create(client=client, project=self.project, id_token='T', utterance='original')
+    self.revision = transcription.revisions.create(user=user, job=job, id_token='R', utterance='hello [noise] hello world [broken')
+    self.other = transcription.revisions.create(user=user, job=job, id_token='S', utterance='world again')
+
+  def test_words_are_created_once_and_linked(self):
+    self.revision.process_words()
+    self.other.process_words()
+
+    self.assertEqual(sorted(self.project.words.values_list('char', 'tag')), [('[noise]', True), ('again', False), ('hello', False), ('world', False)])
+    self.assertEqual(sorted(self.revision.words.values_list('char', flat=True)), ['[noise]', 'hello', 'world'])
+    self.assertEqual(sorted(self.other.words.values_list('char', flat=True)), ['again', 'world'])
+
+  def test_new_utterance_replaces_the_words(self):
+    self.revision.process_words()
+    self.revision.utterance = 'hello again'
+    self.revision.process_words()
+    self.assertEqual(sorted(self.revision.words.values_list('char', flat=True)), ['again', 'hello'])
+
+  def test_deleted_words_are_forgotten(self):
+    self.revision.process_words()
+    self.other.process_words() #finds world and remembers it
+    self.project.words.filter(char='world').delete()
+
+    self.revision.process_words()
+    self.assertEqual(sorted(self.revision.words.values_list('char', flat=True)), ['[noise]', 'hello', 'world']) #linked to the new world
+
+  def test_a_new_project_starts_with_no_words(self):
+    word_interner.remember(word_interner.words(self.project.pk + 1), [('hello', 0)])
+    project = Project.objects.create(pk=self.project.pk + 1, client=self.project.client, name='other', id_token='PROJECT2')
+    self.assertNotIn(project.pk, word_interner.projects)
+
+  def test_a_word_is_added_once(self):
+    self.client.login(email='transcriber@arktic.com', password='password')
+    for i in range(2):
+      self.client.post('/transcription/add/', {'transcription_id':'T', 'word':'hello'})
+    self.assertEqual(self.project.words.filter(char='hello').count(), 1)
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestProcessTranscriptions(TransactionTestCase): #the worker pool closes the connections of this process
+  def setUp(self):
+    user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1))
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1')
+    grammar = project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    job = project.jobs.create(client=client, id_token='JOBTOKEN')
+
+    data_dir = tempfile.mkdtemp()
+    for i in range(5):
+      path = os.path.join(data_dir, '%d.wav' % i)
+      audio = wave.open(path, 'wb')
+      audio.setnchannels(1)
+      audio.setsampwidth(2)
+      audio.setframerate(8000)
+      audio.writeframes(b'\x10\x00' * 8000 * (i+1))
+      audio.close()
+      transcription = grammar.transcriptions.create(client=client, project=project, id_token=str(i), utterance='original %d' % i)
+      WavFile.objects.create(client=client, project=project, grammar=grammar, transcription=transcription, path=path, file_name='%d.wav' % i)
+
+    #3 is already in a job, 4 was processed and completed before
+    Transcription.objects.get(id_token='3').job.add(job)
+    Transcription.objects.filter(id_token='4').update(audio_time=5)
+    Transcription.objects.get(id_token='4').revisions.create(user=user, job=job, id_token='R4', utterance='done')
+
+  def states(self):
+    return list(Transcription.objects.order_by('id_token').values_list('is_active', 'is_available'))
+
+  def test_workers_process_the_audio(self):
+    processed, failures = process_transcriptions(Transcription.objects.all(), workers=2, batch_size=2)
+
+    self.assertEqual((processed, failures), (4, []))
+    self.assertEqual(sorted(float(t) for t in Transcription.objects.values_list('audio_time', flat=True)), [1.0, 2.0, 3.0, 4.0, 5.0])
+    self.assertEqual(self.states(), [(True, True)] * 3 + [(False, False)] * 2)
+    self.assertFalse(Transcription.objects.exclude(id_token='4').filter(audio_rms=b'').exists())
+
+  def test_processing_again_reopens_nothing(self):
+    process_transcriptions(Transcription.objects.all())
+    Transcription.objects.filter(id_token='0').update(is_active=False, is_available=False) #packed and completed since
+
+    self.assertEqual(process_transcriptions(Transcription.objects.all(), workers=2), (0, []))
+    self.assertEqual(self.states(), [(False, False)] + [(True, True)] * 2 + [(False, False)] * 2)
+
+class TestMergeDuplicateWords(TransactionTestCase): #the unique index is dropped and added again
+  def setUp(self):
+    with connection.schema_editor() as schema_editor:
+      schema_editor.alter_unique_together(Word, Word._meta.unique_together, [])
+
+    user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1))
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1')
+    job = self.project.jobs.create(client=client, id_token='JOBTOKEN')
+    self.grammar = self.project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    self.transcription = self.grammar.transcriptions.create(client=client, project=self.project, id_token='T', utterance='hello')
+    self.revisions = [self.transcription.revisions.create(user=user, job=job, id_token='R%d' % i, utterance='hello') for i in range(2)]
+
+    self.first = self.project.words.create(client=client, id_token='W1', char='hello')
+    second = self.project.words.create(client=client, grammar=self.grammar, id_token='W2', char='hello')
+    self.project.words.create(client=client, id_token='W3', char='world')
+    self.first.revision.add(self.revisions[0])
+    second.revision.add(*self.revisions)
+    second.transcription.add(self.transcription)
+
+  def test_duplicates_are_merged_before_the_index_is_added(self):
+    call_command('indexes', stdout=io.StringIO())
+
+    word = self.project.words.get(char='hello')
+    self.assertEqual((word.pk, word.grammar), (self.first.pk, self.grammar))
+    self.assertEqual(sorted(word.revision.values_list('pk', flat=True)), sorted(revision.pk for revision in self.revisions))
+    self.assertEqual(list(word.transcription.all()), [self.transcription])
+    self.assertEqual(self.project.words.count(), 2)
+
+    with self.assertRaises(IntegrityError), transaction.atomic():
+      self.project.words.create(id_token='W4', char='hello')
+
+class TestCompletionCounters(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1), password='password')
+    client = Client.objects.create(name='client')
+    self.project = client.projects.create(name='project', id_token='PROJECT1', is_active=True)
+    self.grammar = self.project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1', is_active=True)
+    for i in range(3):
+      self.grammar.transcriptions.create(client=client, project=self.project, id_token=str(i), utterance='original %d' % i, audio_time=1, is_active=True, is_available=True)
+
+    self.project.build_jobs(self.project.transcriptions.filter(is_available=True))
+    self.job = self.project.jobs.get()
+    Job.objects.filter(pk=self.job.pk).update(user=self.user, is_available=False)
+    self.client.login(email='transcriber@arktic.com', password='password')
+
+  def counts(self):
+    return (Project.objects.get().active_transcriptions, Grammar.objects.get().active_transcriptions, Job.objects.get().active_transcriptions)
+
+  def test_counters_start_when_jobs_are_built(self):
+    self.assertEqual(self.counts(), (3, 3, 3))
+
+  def test_revisions_complete_and_reopen_transcriptions(self):
+    self.client.post('/transcription/revision/', {'transcription_id':'0', 'job_id':self.job.id_token, 'utterance':'done'})
+    self.assertEqual(self.counts(), (2, 2, 2))
+    self.assertTrue(Project.objects.get().is_active)
+    self.assertTrue(Grammar.objects.get().is_active)
+
+    #clearing the utterance puts the transcription back
+    self.client.post('/transcription/revision/', {'transcription_id':'0', 'job_id':self.job.id_token, 'utterance':''})
+    self.assertEqual(self.counts(), (3, 3, 3))
+    self.assertTrue(Transcription.objects.get(id_token='0').is_active)
+
+  def test_transcriptions_done_counts_each_revision_once(self):
+    for transcription_id, utterance in [('0', 'done'), ('0', 'done again'), ('1', 'done')]:
+      self.client.post('/transcription/revision/', {'transcription_id':transcription_id, 'job_id':self.job.id_token, 'utterance':utterance})
+    self.assertEqual(User.objects.get(pk=self.user.pk).transcriptions_done, 2)
+
+    #reconcile recomputes the same values from scratch
+    User.objects.filter(pk=self.user.pk).update(transcriptions_done=0)
+    Project.objects.update(active_transcriptions=0)
+    call_command('reconcile', stdout=io.StringIO())
+    self.assertEqual(User.objects.get(pk=self.user.pk).transcriptions_done, 2)
+    self.assertEqual(self.counts(), (1, 1, 1))
+
+  def test_nothing_is_written_to_a_reclaimed_job(self):
+    Job.objects.filter(pk=self.job.pk).update(lease_expires=timezone.now()-datetime.timedelta(seconds=1))
+    self.assertEqual(reclaim_expired_jobs(), 1)
+
+    response = self.client.post('/transcription/revision/', {'transcription_id':'0', 'job_id':self.job.id_token, 'utterance':'done'})
+    self.assertEqual(response.status_code, 409)
+    response = self.client.post('/transcription/action/', {'transcription_id':'0', 'job_id':self.job.id_token, 'action_name':'play', 'audio_time':'0.1'})
+    self.assertEqual(response.status_code, 409)
+    response = self.client.post('/transcription/actions/', {'job_id':self.job.id_token, 'actions':json.dumps([{'transcription_id':'0', 'action_name':'play'}])})
+    self.assertEqual(response.status_code, 409)
+
+    self.assertEqual((Revision.objects.count(), Action.objects.count()), (0, 0))
+    self.assertEqual(self.counts(), (3, 3, 3))
+
+  def test_complete_uses_a_fixed_number_of_queries(self):
+    for transcription in Transcription.objects.all():
+      with self.assertNumQueries(7):
+        transcription.complete()
+
+    self.assertEqual(self.counts(), (0, 0, 0))
+    self.assertFalse(Job.objects.get().is_active)
+    self.assertFalse(Grammar.objects.get().is_active)
+    self.assertFalse(Project.objects.get().is_active)
+
+class TestLoadTest(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('transcriber@arktic.com', datetime.date(1990, 1, 1), password='password')
+    client = Client.objects.create(name='client')
+    project = client.projects.create(name='project', id_token='PROJECT1', is_active=True)
+    grammar = project.grammars.create(client=client, name='grammar', id_token='GRAMMAR1')
+    job = project.jobs.create(client=client, id_token='JOBTOKEN', is_available=True, is_active=True)
+    for i in range(3):
+      transcription = grammar.transcriptions.create(client=client, project=project, id_token=str(i), utterance='original %d' % i, audio_file='audio/%d.wav' % i, is_active=True)
+      transcription.job.add(job)
+
+  def test_session_works_through_a_job(self):
+    recorder = Recorder()
+    Session(self.user, 'password', [1, 2, 3600], recorder, speed=1e6, actions_per_transcription=2).run(time.time()+60)
+
+    report = recorder.report()
+    self.assertEqual(report['register_actions']['requests'], 3)
+    self.assertEqual(report['update_revision']['requests'], 3)
+    self.assertEqual(report['create_new_job']['requests'], 2) #the second finds no job
+    self.assertEqual(sum(stats['errors'] for stats in report.values()), 0)
+    self.assertTrue(report['TranscriptionView']['queries_max']>0)
+    self.assertEqual(Revision.objects.filter(user=self.user).count(), 3)
+    self.assertEqual(Action.objects.count(), 6)
+
+  def test_a_stopped_session_is_an_error(self):
+    recorder = Recorder()
+    with mock.patch.object(Session, 'transcribe', side_effect=RuntimeError('stopped')):
+      Session(self.user, 'password', [1], recorder, speed=1e6).run(time.time()+60)
+
+    report = recorder.report()
+    self.assertEqual((report['session']['requests'], report['session']['errors']), (1, 1))
+    self.assertEqual(report['TranscriptionView']['errors'], 0)
+
+  def test_deltas_are_read_without_running_the_file(self):
+    path = os.path.join(tempfile.mkdtemp(), 'time.py')
+    with open(path, 'w') as open_deltas:
+      open_deltas.write('import matplotlib.pyplot as plt\n\ndeltas = [0, 9, 4]\n\nplt.show()\n')
+    self.assertEqual(load_deltas(path), [0, 9, 4])
+
+  def test_percentile(self):
+    values = list(range(1, 101))
+    self.assertEqual([percentile(values, p) for p in [50, 95, 99, 100]], [50, 95, 99, 100])
+    self.assertEqual(percentile([7], 99), 7)
@@ -5,7 +5,7 @@ from django.contrib import admin
 from django.conf.urls import patterns, include, url
 
 #local
-from apps.transcription.views import start_redirect, TranscriptionView, create_new_job, action_register, update_revision, add_word
+from apps.transcription.views import start_redirect, TranscriptionView, create_new_job, action_register, register_actions, update_revision, add_word, lexicon, suggest_words
 
 #third party
 
@@ -18,6 +18,9 @@ urlpatterns = patterns('',
   url(r'^(?P<job_id_token>[A-Z0-9]{8})$', TranscriptionView.as_view()),
   url(r'^new/$', create_new_job),
   url(r'^action/$', action_register),
+  url(r'^actions/$', register_actions),
   url(r'^revision/$', update_revision),
   url(r'^add/$', add_word),
+  url(r'^lexicon/(?P<project_id_token>[A-Z0-9]{8})/$', lexicon),
+  url(r'^suggest/$', suggest_words),
 )
@@ -4,39 +4,39 @@
 from django.views.generic import View
 from django.conf import settings
 from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponse, HttpResponseRedirect
-from django.db.models import Q
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest
+from django.views.decorators.http import condition
+from django.views.decorators.cache import cache_control
+from django.db.models import Q, F
+from django.db import transaction, IntegrityError
+from django.utils import timezone
 
 #local
 from apps.users.models import User
-from apps.distribution.models import Project, Job
-from apps.transcription.models import Transcription, Revision, Action
-from libs.utils import generate_id_token
+from apps.distribution.models import Project, Job, claim_job
+from apps.transcription.models import Transcription, Revision, Action, Word
+from apps.transcription.lexicon import get_lexicon, is_lexicon_word, invalidate_lexicon, suggest, use_suggest
+from libs.utils import generate_id_token, generate_id_tokens
 
 #util
 import random
 import json
+import datetime as dt
 
 #class views
 class TranscriptionView(View):
   def get(self, request, job_id_token):
     user = request.user
     if user.is_authenticated():
-      user = User.objects.get(email=user)
-
-      job = get_object_or_404(user.jobs, id_token=job_id_token) #does this do 'return HTTP... blah'?
+      job = get_object_or_404(user.jobs.select_related('project'), id_token=job_id_token) #does this do 'return HTTP... blah'?
 
-      #transcriptions
-      transcriptions = job.transcriptions.all()
+      #transcriptions: grammars are joined and revisions prefetched in one query, and nothing is written on GET
+      transcriptions = list(job.transcriptions.select_related('grammar').prefetch_related('revisions'))
       for transcription in transcriptions:
         transcription.set_latest_revision_done_by_current_user(user)
-        transcription.update()
 
-      #words
-      words = json.dumps([word.char for word in job.project.words.filter(Q(char__contains=' ') | Q(tag=True))])
-
-      #render
-      return render(request, 'transcription/transcription.html', {'transcriptions':transcriptions,'words':words,'job_id':job.id_token,})
+      #render: the autocomplete words are loaded separately from the lexicon view
+      return render(request, 'transcription/transcription.html', {'transcriptions':transcriptions,'job_id':job.id_token,'project_id':job.project.id_token,})
     else:
       return HttpResponseRedirect('/start/')
 
@@ -49,11 +49,8 @@ def create_new_job(request):
       user = User.objects.get(email=user)
 
       #if there are available jobs
-      if Job.objects.filter(is_available=True).count()>0:
-        job = Job.objects.filter(is_available=True)[0]
-        job.is_available = False
-        user.jobs.add(job)
-        job.save()
+      job = claim_job(user)
+      if job is not None:
         return HttpResponseRedirect('/transcription/' + str(job.id_token))
       else:
         return HttpResponseRedirect('/start/')
@@ -61,6 +58,10 @@ def create_new_job(request):
     else:
       return HttpResponseRedirect('/login/')
 
+def lease_lost():
+  ''' The job has been reclaimed (see reclaim_expired_jobs) and may belong to someone else now: nothing is written. '''
+  return HttpResponse('job reclaimed', status=409)
+
 def start_redirect(request):
   return HttpResponseRedirect('/start/')
 
@@ -71,8 +72,11 @@ def action_register(request):
     transcription = Transcription.objects.get(id_token=request.POST['transcription_id'])
 
     #make action object
+    job = Job.objects.get(id_token=request.POST['job_id'])
+    if not job.renew_lease(user):
+      return lease_lost()
     transcription.actions.create(client=transcription.client,
-                                 job=Job.objects.get(id_token=request.POST['job_id']),
+                                 job=job,
                                  user=user,
                                  id_token=generate_id_token(Action),
                                  char=request.POST['action_name'],
@@ -80,23 +84,66 @@ def action_register(request):
 
     return HttpResponse('')
 
-def update_revision(request):
-  if request.user.is_authenticated:
-    #get user and update revision utterance
-    transcription = Transcription.objects.get(id_token=request.POST['transcription_id'])
-    revision, created = transcription.revisions.get_or_create(user=User.objects.get(email=request.user),
-                                                              job=Job.objects.get(id_token=request.POST['job_id']))
+def register_actions(request):
+  '''
+  Record a batch of actions buffered by the browser. POST carries the job_id and actions, a JSON list of
+  {transcription_id, action_name, audio_time, date_performed} with date_performed in seconds since the epoch.
+  The job, the transcriptions and the id tokens are looked up once for the whole batch.
+  '''
+  if request.user.is_authenticated():
+    try:
+      job = Job.objects.get(id_token=request.POST['job_id'])
+      actions = [(action.get('transcription_id'),
+                  action.get('action_name', ''),
+                  float(action.get('audio_time') or 0),
+                  dt.datetime.fromtimestamp(float(action['date_performed']), timezone.utc) if action.get('date_performed') else None) for action in json.loads(request.POST['actions'])]
+    except (KeyError, ValueError, TypeError, AttributeError, OverflowError, OSError, Job.DoesNotExist): #OverflowError and OSError: dates out of range
+      return HttpResponseBadRequest()
+
+    if not job.renew_lease(request.user):
+      return lease_lost()
+    transcriptions = {id_token:(pk, client_pk) for id_token, pk, client_pk in job.transcriptions.filter(id_token__in=set([action[0] for action in actions])).values_list('id_token', 'pk', 'client')}
+    actions = [action for action in actions if action[0] in transcriptions]
+
+    Action.objects.bulk_create([Action(client_id=transcriptions[transcription_id][1],
+                                       job=job,
+                                       user=request.user,
+                                       transcription_id=transcriptions[transcription_id][0],
+                                       id_token=id_token,
+                                       char=action_name,
+                                       audio_time=audio_time,
+                                       date_performed=date_performed) for (transcription_id, action_name, audio_time, date_performed), id_token in zip(actions, generate_id_tokens(Action, len(actions)))])
 
-    if created:
-      revision.id_token = generate_id_token(Revision)
-
-    #split utterance
-    revision.utterance = request.POST['utterance']
-    revision.save()
+    return HttpResponse('')
+  else:
+    return HttpResponseForbidden()
 
-    #processing
-    revision.process_words()
-    revision.job.update()
+def update_revision(request):
+  if request.user.is_authenticated:
+    with transaction.atomic():
+      #get user and update revision utterance
+      transcription = Transcription.objects.get(id_token=request.POST['transcription_id'])
+      user = User.objects.get(email=request.user)
+      job = Job.objects.get(id_token=request.POST['job_id'])
+      if not job.renew_lease(user):
+        return lease_lost()
+      revision, created = transcription.revisions.get_or_create(user=user, job=job)
+
+      if created:
+        revision.id_token = generate_id_token(Revision)
+        if not transcription.revisions.filter(user=user).exclude(pk=revision.pk).exists(): #first revision of this transcription by the user
+          User.objects.filter(pk=user.pk).update(transcriptions_done=F('transcriptions_done')+1)
+
+      #split utterance
+      revision.utterance = request.POST['utterance']
+      revision.save()
+
+      #processing: counters are updated incrementally, see Transcription.complete
+      revision.process_words()
+      if revision.utterance!='':
+        transcription.complete()
+      else:
+        transcription.reopen()
 
     return HttpResponse('')
 
@@ -109,11 +156,45 @@ def add_word(request):
     #vars
     transcription = Transcription.objects.get(id_token=transcription_id)
     client = transcription.client
-    if client.words.filter(project=transcription.project, char=word).count()==0 and not (('[' in word and ']' not in word) or (']' in word and '[' not in word)):
-      client.words.create(project=transcription.project, grammar=transcription.grammar, char=word, tag=(('[' in word and ']' in word)))
+    if not (('[' in word and ']' not in word) or (']' in word and '[' not in word)):
+      try:
+        with transaction.atomic():
+          w, created = client.words.get_or_create(project=transcription.project, char=word, defaults={'grammar':transcription.grammar, 'id_token':generate_id_token(Word), 'tag':('[' in word and ']' in word)})
+      except IntegrityError:
+        created = False #added by another request at the same time
+      if created and is_lexicon_word(w.char, w.tag):
+        invalidate_lexicon(transcription.project_id)
 
     return HttpResponse('')
 
+def lexicon_etag(request, project_id_token):
+  if request.user.is_authenticated():
+    versions = Project.objects.filter(id_token=project_id_token).values_list('pk', 'lexicon_version')[:1]
+    return '%d-%d' % versions[0] if versions else None
+
+@cache_control(private=True, max_age=0)
+@condition(etag_func=lexicon_etag)
+def lexicon(request, project_id_token):
+  '''
+  Autocomplete words for a project as JSON. Responses carry the project's lexicon version as an ETag, so the browser
+  gets a 304 until a word is added to the project.
+  '''
+  if request.user.is_authenticated():
+    project = get_object_or_404(Project, id_token=project_id_token)
+    if use_suggest(project): #too many words to send, the browser asks suggest instead
+      return HttpResponse(json.dumps({'version':project.lexicon_version, 'suggest':True, 'words':[]}), content_type='application/json')
+    return HttpResponse(json.dumps({'version':project.lexicon_version, 'suggest':False, 'words':get_lexicon(project)}), content_type='application/json')
+  else:
+    return HttpResponseForbidden()
+
+def suggest_words(request):
+  ''' The most frequent words of a project starting with q, as a JSON list. '''
+  if request.user.is_authenticated():
+    project = get_object_or_404(Project, id_token=request.GET.get('project', ''))
+    return HttpResponse(json.dumps(suggest(project, request.GET.get('q', ''), settings.SUGGEST_RESULTS)), content_type='application/json')
+  else:
+    return HttpResponseForbidden()
+
 '''
 
 http://stackoverflow.com/a/2257449/2127199
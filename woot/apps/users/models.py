@@ -50,6 +50,9 @@ class User(AbstractBaseUser, PermissionsMixin):
   is_admin = models.BooleanField(default=False)
   objects = UserManager()
 
+  #-stats
+  transcriptions_done = models.IntegerField(editable=False, default=0) #distinct transcriptions revised, see update_revision
+
   #-settings
   autocomplete_setting = models.CharField(max_length=4, choices=(('f','full'),('t','tags'),('o','off')), default='full')
 
@@ -68,6 +71,11 @@ class User(AbstractBaseUser, PermissionsMixin):
   def __str__(self):
     return self.email
 
+  def update_stats(self):
+    ''' Recompute transcriptions_done from scratch. It is kept up to date incrementally when revisions are created. '''
+    self.transcriptions_done = self.revisions.values('transcription').distinct().count()
+    self.save()
+
   def has_perm(self, perm, obj=None):
     "Does the user have a specific permission?"
     # Simplest possible answer: Yes, always
@@ -0,0 +1,72 @@
+#libs.corpus
+
+#django
+
+#local
+
+#util
+import os
+import struct
+import numpy as np
+
+#vars
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_ALAW = 6
+FRAMERATE = 8000 #telephone audio
+
+WORDS = ['station', 'road', 'street', 'london', 'north', 'south', 'east', 'west', 'park', 'lane', 'yes', 'no',
+         'bridge', 'green', 'hill', 'cross', 'church', 'market', 'high', 'new']
+TAGS = ['[noise]', '[breath]', '[fil]', '[spk]']
+
+#methods
+def write_wav(path, data, format_tag, bits_per_sample, framerate=FRAMERATE):
+  ''' Write mono sample bytes as a RIFF wav file. The wave module only writes PCM, so the header is written here. '''
+  block_align = bits_per_sample // 8
+  header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE', b'fmt ', 16, format_tag, 1, framerate,
+                       framerate * block_align, block_align, bits_per_sample, b'data', len(data))
+  with open(path, 'wb') as open_wav_file:
+    open_wav_file.write(header)
+    open_wav_file.write(data)
+
+def utterance(random_state):
+  words = list(random_state.choice(WORDS, random_state.randint(1, 5)))
+  if random_state.rand()<0.2:
+    words.insert(random_state.randint(0, len(words)+1), random_state.choice(TAGS))
+  return ' '.join(words)
+
+def generate_corpus(data_dir, clients=1, projects=1, grammars=2, transcriptions=100, alaw=0.5, seed=0):
+  '''
+  Write a synthetic data/<client>/<project> tree with relfiles in the format documented in Grammar.export and wav
+  files of a few seconds each, a fraction (alaw) of them A-law and the rest 16-bit PCM.
+  Returns the number of relfiles and wav files written and the total seconds of audio.
+  '''
+  random_state = np.random.RandomState(seed)
+  counts = {'relfiles':0, 'wav_files':0, 'seconds':0.0}
+  for c in range(clients):
+    for p in range(projects):
+      project_path = os.path.join(data_dir, 'client%d' % c, 'project%d' % p)
+      for g in range(grammars):
+        grammar_name = 'grammar%d' % g
+        audio_path = os.path.join(project_path, '2014', '10October', '%02d' % (g+1))
+        os.makedirs(audio_path, exist_ok=True)
+
+        with open(os.path.join(project_path, grammar_name + '.csv'), 'w') as relfile:
+          for t in range(transcriptions):
+            #most utterances are short, a few are long
+            seconds = float(np.clip(random_state.lognormal(0.8, 0.5), 0.5, 15.0))
+            frames = int(seconds * FRAMERATE)
+            file_name = '%d-%d-%d-%06d.wav' % (c, p, g, t)
+            if random_state.rand()<alaw:
+              write_wav(os.path.join(audio_path, file_name), random_state.randint(0, 256, frames).astype(np.uint8).tobytes(), WAVE_FORMAT_ALAW, 8)
+            else:
+              samples = 8000 * np.sin(np.arange(frames) * 2 * np.pi * random_state.randint(100, 1000) / FRAMERATE) + random_state.normal(0, 500, frames)
+              write_wav(os.path.join(audio_path, file_name), samples.astype('<i2').tobytes(), WAVE_FORMAT_PCM, 16)
+
+            relfile.write('./%s|c:\\Program Files\\Nortel\\PERIsw30r\\grammars\\%s.grxml|ok|%s|{code:S%04d}|%d\n' % (
+              os.path.relpath(os.path.join(audio_path, file_name), project_path), grammar_name, utterance(random_state), t, random_state.randint(0, 1000)))
+            counts['wav_files'] += 1
+            counts['seconds'] += frames / float(FRAMERATE)
+
+        counts['relfiles'] += 1
+
+  return counts
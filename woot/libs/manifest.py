@@ -0,0 +1,117 @@
+#libs.manifest
+
+#django
+
+#local
+
+#util
+import os
+import json
+import hashlib
+
+#classes
+class Manifest(object):
+  '''
+  A persisted record of a directory tree, used to rescan only what has changed since the last scan.
+
+  Directories are stored with their mtime and the names of their subdirectories and files. A directory whose mtime has
+  not changed has not gained or lost any entries, so its listing is taken from the manifest instead of the disk.
+  Tracked files (relfiles) are also stored with their size, mtime and optionally a content hash, because their contents
+  can change without their directory changing.
+  '''
+  def __init__(self, path):
+    self.path = path
+    self.dirs = {} #dir path -> {'mtime', 'dirs', 'files'}
+    self.files = {} #tracked file path -> [size, mtime, hash]
+
+  @classmethod
+  def load(cls, path):
+    manifest = cls(path)
+    if os.path.exists(path):
+      with open(path) as open_manifest:
+        data = json.load(open_manifest)
+        manifest.dirs = data['dirs']
+        manifest.files = data['files']
+    return manifest
+
+  def save(self):
+    #write to a temporary file first so a crash never leaves a truncated manifest
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as open_manifest:
+      json.dump({'dirs':self.dirs, 'files':self.files}, open_manifest)
+    os.replace(tmp_path, self.path)
+
+  def scan(self, root, track, use_hash=False):
+    '''
+    Walk root and update the manifest in place. track(dir_path, file_name) decides which files are checked for changes
+    to their contents; all other files are only checked for existence.
+    Returns a dictionary with lists of new, changed and removed file paths.
+    '''
+    diff = {'new':[], 'changed':[], 'removed':[]}
+    seen = set()
+    stack = [root]
+    while stack:
+      dir_path = stack.pop()
+      seen.add(dir_path)
+
+      mtime = os.stat(dir_path).st_mtime_ns
+      entry = self.dirs.get(dir_path)
+      new_files = set()
+      if entry is None or entry['mtime']!=mtime:
+        subs, files = [], []
+        for dir_entry in os.scandir(dir_path):
+          (subs if dir_entry.is_dir() else files).append(dir_entry.name)
+
+        old_files = set(entry['files']) if entry is not None else set()
+        new_files = set(files) - old_files
+        diff['new'] += [os.path.join(dir_path, name) for name in sorted(new_files)]
+        for name in sorted(old_files - set(files)):
+          diff['removed'].append(self.forget(os.path.join(dir_path, name)))
+
+        entry = self.dirs[dir_path] = {'mtime':mtime, 'dirs':subs, 'files':files}
+
+      for name in entry['files']:
+        if track(dir_path, name):
+          path = os.path.join(dir_path, name)
+          if self.stat(path, use_hash) and name not in new_files:
+            diff['changed'].append(path)
+
+      stack.extend([os.path.join(dir_path, sub) for sub in entry['dirs']])
+
+    #directories that have disappeared since the last scan
+    for dir_path in [dir_path for dir_path in self.dirs if dir_path not in seen and self.contains(root, dir_path)]:
+      diff['removed'] += [self.forget(os.path.join(dir_path, name)) for name in self.dirs.pop(dir_path)['files']]
+
+    return diff
+
+  def stat(self, path, use_hash=False):
+    ''' Record size, mtime and hash of a tracked file. Returns True if it is new or has changed. '''
+    st = os.stat(path)
+    record = self.files.get(path)
+    if record is not None and record[0]==st.st_size and record[1]==st.st_mtime_ns:
+      return False
+
+    digest = file_hash(path) if use_hash else None
+    self.files[path] = [st.st_size, st.st_mtime_ns, digest]
+    return record is None or digest is None or record[2]!=digest
+
+  def forget(self, path):
+    self.files.pop(path, None)
+    return path
+
+  def walk(self, root):
+    ''' Same as os.walk, but from the manifest instead of the disk. '''
+    for dir_path, entry in self.dirs.items():
+      if self.contains(root, dir_path):
+        yield dir_path, entry['dirs'], entry['files']
+
+  def contains(self, root, dir_path):
+    return dir_path==root or dir_path.startswith(root + os.sep)
+
+#methods
+def file_hash(path, block_size=1<<20):
+  md5 = hashlib.md5()
+  with open(path, 'rb') as open_file:
+    for block in iter(lambda: open_file.read(block_size), b''):
+      md5.update(block)
+  return md5.hexdigest()
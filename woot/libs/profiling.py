@@ -0,0 +1,73 @@
+#libs.profiling
+
+#django
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, reset_queries
+
+#local
+
+#util
+import re
+import json
+import time
+import logging
+import threading
+from collections import deque, Counter
+
+#vars
+logger = logging.getLogger('profiling') #a rotating JSONL file, see LOGGING
+recent = deque(maxlen=settings.PROFILING_BUFFER_SIZE) #the latest records of this process, see apps.pages.views.profiling
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LISTS = re.compile(r'IN \((?:\?, )*\?\)')
+
+#classes
+class ProfilingMiddleware(object):
+  '''
+  Records the wall time, number of queries and query time of each request, and the statements it ran more than once
+  with different parameters (the sign of a query in a loop), tagged by url name. Records go to the profiling logger
+  and to an in-process ring buffer. Only installed when settings.PROFILING_ENABLED is set.
+  '''
+  def __init__(self):
+    if not settings.PROFILING_ENABLED:
+      raise MiddlewareNotUsed()
+    self.local = threading.local()
+
+  def process_request(self, request):
+    self.local.debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True #queries are only recorded with a debug cursor
+    reset_queries()
+    self.local.start = time.time()
+
+  def process_response(self, request, response):
+    start = getattr(self.local, 'start', None)
+    if start is None: #an earlier middleware answered before process_request ran
+      return response
+    self.local.start = None
+
+    seconds = time.time() - start
+    queries = connection.queries
+    connection.use_debug_cursor = self.local.debug_cursor
+    match = getattr(request, 'resolver_match', None)
+
+    duplicates = Counter(normalize(query['sql']) for query in queries)
+    record = {
+      'time':round(start, 3),
+      'url_name':(match.url_name or match.view_name) if match is not None else None,
+      'method':request.method,
+      'path':request.path,
+      'status':response.status_code,
+      'ms':round(1000*seconds, 2),
+      'queries':len(queries),
+      'query_ms':round(1000*sum(float(query['time']) for query in queries), 2),
+      'duplicates':[{'sql':sql, 'count':count} for sql, count in duplicates.most_common(settings.PROFILING_DUPLICATES) if count>1],
+    }
+
+    recent.append(record)
+    logger.info(json.dumps(record))
+    return response
+
+#methods
+def normalize(sql):
+  ''' A statement with its parameters replaced by ?, so that the same query with different values counts once. '''
+  return IN_LISTS.sub('IN (...)', LITERALS.sub('?', sql))
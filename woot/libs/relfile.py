@@ -0,0 +1,39 @@
+#libs.relfile
+
+#django
+
+#local
+
+#util
+import os
+from collections import namedtuple
+
+#vars
+RelfileLine = namedtuple('RelfileLine', ['file_name', 'grammar', 'confidence', 'utterance', 'value', 'confidence_value'])
+
+#methods
+def parse_relfile(path, delimiter='|'):
+  '''
+  Stream a relfile one line at a time, yielding a RelfileLine for each row. The format is documented in Grammar.export.
+  Blank lines are skipped and the file is never read into memory as a whole.
+  '''
+  with open(path) as open_relfile:
+    for line in open_relfile:
+      if not line.strip():
+        continue
+
+      tokens = line.split(delimiter)
+      confidence_value = tokens[5].rstrip() #chomp newline
+      yield RelfileLine(file_name=os.path.basename(tokens[0]),
+                        grammar=tokens[1],
+                        confidence=tokens[2],
+                        utterance=tokens[3].strip() if ''.join(tokens[3].split()) != '' else '',
+                        value=tokens[4],
+                        confidence_value=float(float(confidence_value)/1000.0) if confidence_value else 0.0) #show as decimal
+
+def parse_relfile_file_names(path, delimiter='|'):
+  ''' Only the audio file name of each line, for when the rest of the line is not needed. '''
+  with open(path) as open_relfile:
+    for line in open_relfile:
+      if line.strip():
+        yield os.path.basename(line.split(delimiter, 1)[0])
@@ -2,6 +2,7 @@
 
 #django
 from django.conf import settings
+from django.db import connection
 
 #local
 
@@ -9,49 +10,105 @@ from django.conf import settings
 import string
 import random
 import wave
-import audioop
+import struct
 import os
+import threading
+import functools
 from subprocess import call
 
+#third party
+import numpy as np
+
 #vars
 chars = string.ascii_uppercase + string.digits
 
+def get_id_token():
+  return ''.join([random.choice(chars) for _ in range(8)]) #8 character string
+
+def generate_id_tokens(Obj, n, batch_size=500): #expects Obj.objects
+  '''
+  n different id tokens that are not used by any Obj. Candidates are checked with one IN query per batch.
+  '''
+  id_tokens = []
+  while len(id_tokens)<n:
+    candidates = set([get_id_token() for _ in range(min(batch_size, n-len(id_tokens)))]) - set(id_tokens)
+    taken = set(Obj.objects.filter(id_token__in=candidates).values_list('id_token', flat=True))
+    id_tokens.extend(candidates - taken)
+
+  return id_tokens
+
+id_token_pools = {} #Obj -> (pid, unused tokens)
+id_token_lock = threading.Lock()
+
 def generate_id_token(Obj): #expects Obj.objects
-  def get_id_token():
-    return ''.join([random.choice(chars) for _ in range(8)]) #8 character string
+  '''
+  One id token for a new Obj, served from a pool of tokens checked settings.ID_TOKEN_POOL_SIZE at a time, so most
+  calls make no query. The pool belongs to the process that filled it and is never shared with forked children.
+  Threads share the pool; the lock is not held while the pool is refilled.
+  '''
+  while True:
+    with id_token_lock:
+      pid, pool = id_token_pools.get(Obj, (None, []))
+      if pid==os.getpid() and pool:
+        return pool.pop()
+
+    id_tokens = generate_id_tokens(Obj, settings.ID_TOKEN_POOL_SIZE)
+    with id_token_lock:
+      pid, pool = id_token_pools.get(Obj, (None, []))
+      id_token_pools[Obj] = (os.getpid(), (pool if pid==os.getpid() else []) + id_tokens)
+
+def in_thread(function):
+  '''
+  Wrap a function that runs in a thread of its own, e.g. in a ThreadPoolExecutor. Django opens a database connection
+  for each thread, so the connection of the thread is closed when the function returns.
+  '''
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    try:
+      return function(*args, **kwargs)
+    finally:
+      connection.close()
+  return wrapper
 
-  id_token = get_id_token()
-  while Obj.objects.filter(id_token=id_token).count()>0:
-    id_token = get_id_token()
+def bulk_update_column(Obj, column, values, batch_size=300):
+  '''
+  Set a single column on many rows with one UPDATE ... CASE statement per batch.
+  values is a dictionary of pk -> new value. Batches keep the number of parameters under the sqlite limit.
+  '''
+  table = connection.ops.quote_name(Obj._meta.db_table)
+  pk_column = connection.ops.quote_name(Obj._meta.pk.column)
+  column = connection.ops.quote_name(column)
 
-  return id_token
+  items = list(values.items())
+  cursor = connection.cursor()
+  for i in range(0, len(items), batch_size):
+    batch = items[i:i+batch_size]
+    sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (table, column, pk_column, ' '.join(['WHEN %s THEN %s']*len(batch)), pk_column, ', '.join(['%s']*len(batch)))
+    cursor.execute(sql, [param for item in batch for param in item] + [pk for pk, value in batch])
 
 ''' AUDIO CONVERSION AND PROCESSING '''
 
 ### BRIEF DECRIPTION ###
 # analyse a wav file (A-law compression, 8-bit sample width).
 
-### INSTRUCTIONS ###
-# - The main() function shown here demonstrates the code.
-#   Copy it to your own project.
-
 ### REQUIREMENTS ###
-# - tested with python 2.7.9 on Mac OS X 10.6.8
-# - uses ffmpeg
-# -- tested with ffmpeg version 2.5.1 (built with gcc 4.2.1)
+# - uses numpy
+# - uses ffmpeg, only for formats that are not decoded in process
 # - uses python built-in modules:
+# -- struct
 # -- wave
-# -- audioop
 # -- subprocess
 
 ### DESCRIPTION ###
-# 1] Use ffmpeg to convert A-law wav file to Microsoft PCM 16-bit wav file.
-# 2] Use wave to read basic properties of the resulting wav file.
-#    Calculate the total playing time in s of the wav file.
-# 3] Read the wav file as 100 sections. Use audioop to find the
-#    rms (root mean square) value of each section.
+# 1] Read the RIFF header of the wav file and memory-map its data chunk.
+#    A-law, mu-law and 8/16-bit PCM are decoded to 16-bit PCM with numpy
+#    lookup tables. Any other format is converted by ffmpeg first.
+# 2] If the file was not already 16-bit PCM, write it back in place as
+#    Microsoft PCM 16-bit so it can be played in the browser.
+# 3] Split the samples into NUMBER_OF_AUDIO_FILE_BINS sections and find the
+#    rms (root mean square) value of each section in one vectorized pass.
 #    The rms is a good measure of the intensity of an audio section.
-# 4] The getWAVFileProperties() function returns a tuple containing
+# 4] The process_audio() function returns a tuple containing
 #    - the total play time of the wav file in seconds
 #    - a list of the rms values of each section.
 
@@ -59,39 +116,156 @@ def generate_id_token(Obj): #expects Obj.objects
 sampleWidth = 2 # number of bytes in a frame.
   # for microsoft 16-bit PCM wav, this is 2.
 
-def process_audio(input_path):
-  # convert a-law wav file to microsoft pcm wav file
-  cmd = ['ffmpeg','-y','-i',input_path,'-f','wav',input_path]
-  call(cmd)
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_ALAW = 0x0006
+WAVE_FORMAT_MULAW = 0x0007
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+RMS_CHUNK_SAMPLES = 1<<20 # samples squared at a time by analyse_wav
+
+class UnsupportedAudioFormat(Exception):
+  pass
 
-  # get properties of the pcm wav file
-  seconds, rmsValues = getWAVFileProperties(input_path)
+def alaw_table():
+  # G.711 A-law to 16-bit linear, same values as audioop.alaw2lin
+  a = np.arange(256, dtype=np.int32) ^ 0x55
+  segment = (a & 0x70) >> 4
+  t = ((a & 0x0f) << 4) + np.where(segment==0, 8, 0x108)
+  t = np.where(segment>1, t << np.maximum(segment-1, 0), t)
+  return np.where(a & 0x80, t, -t).astype(np.int16)
+
+def mulaw_table():
+  # G.711 mu-law to 16-bit linear, same values as audioop.ulaw2lin
+  u = ~np.arange(256, dtype=np.int32) & 0xff
+  t = (((u & 0x0f) << 3) + 0x84) << ((u & 0x70) >> 4)
+  return np.where(u & 0x80, 0x84 - t, t - 0x84).astype(np.int16)
+
+DECODE_TABLES = {
+  WAVE_FORMAT_ALAW:alaw_table(),
+  WAVE_FORMAT_MULAW:mulaw_table(),
+}
+
+def process_audio(input_path):
+  try:
+    seconds, rmsValues = analyse_wav(input_path, convert=True)
+  except UnsupportedAudioFormat:
+    # convert anything else to microsoft pcm wav file
+    cmd = ['ffmpeg','-y','-i',input_path,'-f','wav',input_path]
+    call(cmd)
+    seconds, rmsValues = analyse_wav(input_path)
 
   return (seconds, rmsValues)
 
-def getWAVFileProperties(filePath):
+def read_wav_header(filePath):
+  '''
+  Find the format and the location of the data chunk of a RIFF wav file.
+  Returns (format_tag, channels, framerate, bits_per_sample, data_offset, data_size).
+  '''
+  with open(filePath, 'rb') as open_wav_file:
+    riff, riff_size, wave_id = struct.unpack('<4sI4s', open_wav_file.read(12))
+    if riff!=b'RIFF' or wave_id!=b'WAVE':
+      raise UnsupportedAudioFormat('not a RIFF wav file: %s' % filePath)
+
+    fmt = None
+    while True:
+      chunk_header = open_wav_file.read(8)
+      if len(chunk_header)<8:
+        raise UnsupportedAudioFormat('no data chunk: %s' % filePath)
+
+      chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+      if chunk_id==b'fmt ':
+        chunk = open_wav_file.read(chunk_size + (chunk_size & 1))
+        format_tag, channels, framerate, byte_rate, block_align, bits_per_sample = struct.unpack('<HHIIHH', chunk[:16])
+        if format_tag==WAVE_FORMAT_EXTENSIBLE and len(chunk)>=26:
+          format_tag = struct.unpack('<H', chunk[24:26])[0] #first two bytes of the sub-format guid
+        fmt = (format_tag, channels, framerate, bits_per_sample)
+      elif chunk_id==b'data':
+        if fmt is None:
+          raise UnsupportedAudioFormat('data chunk before fmt chunk: %s' % filePath)
+        #streamed files sometimes carry a bogus data size, so never read past the end of the file
+        data_offset = open_wav_file.tell()
+        data_size = min(chunk_size, os.path.getsize(filePath) - data_offset)
+        return fmt + (data_offset, data_size)
+      else:
+        open_wav_file.seek(chunk_size + (chunk_size & 1), 1)
+
+def decode_wav(filePath):
+  '''
+  Decode a wav file to 16-bit samples (interleaved if there is more than one channel).
+  The data chunk is memory-mapped, so 16-bit PCM is never copied into memory.
+  '''
+  format_tag, channels, framerate, bits_per_sample, data_offset, data_size = read_wav_header(filePath)
+  if channels==0 or framerate==0:
+    raise UnsupportedAudioFormat('empty format: %s' % filePath)
+
+  if data_size<=0:
+    return np.zeros(0, dtype=np.int16), channels, framerate, format_tag==WAVE_FORMAT_PCM and bits_per_sample==16
+
+  if format_tag==WAVE_FORMAT_PCM and bits_per_sample==16:
+    data = np.memmap(filePath, dtype='<i2', mode='r', offset=data_offset, shape=(data_size//2,))
+    return data, channels, framerate, True
+
+  data = np.memmap(filePath, dtype=np.uint8, mode='r', offset=data_offset, shape=(data_size,))
+  if format_tag in DECODE_TABLES and bits_per_sample==8:
+    return DECODE_TABLES[format_tag][data], channels, framerate, False
+  elif format_tag==WAVE_FORMAT_PCM and bits_per_sample==8:
+    return ((data.astype(np.int16) - 128) << 8), channels, framerate, False
 
-  a = wave.open(filePath, 'r')
-  nFrames = a.getnframes()
-  framerate = a.getframerate()
+  raise UnsupportedAudioFormat('format %d with %d bits per sample: %s' % (format_tag, bits_per_sample, filePath))
+
+def write_pcm_wav(filePath, samples, channels, framerate):
+  ''' Replace a wav file with a Microsoft PCM 16-bit version of the same samples. '''
+  tmp_path = filePath + '.tmp'
+  out = wave.open(tmp_path, 'wb')
+  out.setnchannels(channels)
+  out.setsampwidth(sampleWidth)
+  out.setframerate(framerate)
+  out.writeframes(samples.astype('<i2').tobytes())
+  out.close()
+  os.replace(tmp_path, filePath)
+
+def analyse_wav(filePath, convert=False):
+  '''
+  Returns the play time in seconds and the rms value of each of NUMBER_OF_AUDIO_FILE_BINS sections of a wav file.
+  With convert=True, files that are not 16-bit PCM are rewritten as 16-bit PCM.
+  '''
+  samples, channels, framerate, is_pcm = decode_wav(filePath)
+
+  # drop any partial frame at the end
+  nFrames = len(samples) // channels
+  samples = samples[:nFrames*channels]
   seconds = nFrames / float(framerate)
 
-  # get rms value for each section of the audio
-  framesPerSection = int(nFrames / float(settings.NUMBER_OF_AUDIO_FILE_BINS)) # note the truncation
-  rmsValues = []
-  count = 0
-  for i in range(settings.NUMBER_OF_AUDIO_FILE_BINS-1):
-    section = a.readframes(framesPerSection)
-    count += framesPerSection
-    r = audioop.rms(section, sampleWidth)
-    rmsValues.append(r)
-
-  # all the truncated time adds up.
-  # we therefore read the last audio section to the end of the file,
-  # rather than to an integer number of frames.
-  last = nFrames - count
-  section = a.readframes(last)
-  r = audioop.rms(section, sampleWidth)
-  rmsValues.append(r)
+  # the first sections are framesPerSection long (note the truncation).
+  # all the truncated time adds up, so the last section runs to the end of the file.
+  bins = settings.NUMBER_OF_AUDIO_FILE_BINS
+  framesPerSection = int(nFrames / float(bins))
+  starts = np.arange(bins, dtype=np.int64) * framesPerSection * channels
+  ends = np.append(starts[1:], len(samples))
+
+  # rms of each section from sums of squares, truncated to an integer like audioop.rms. The samples are read in chunks
+  # of RMS_CHUNK_SAMPLES, so memory stays bounded however long the file is and a memory-mapped file is never copied.
+  sums = np.zeros(bins, dtype=np.int64)
+  for chunk_start in range(0, len(samples), RMS_CHUNK_SAMPLES):
+    chunk = samples[chunk_start:chunk_start+RMS_CHUNK_SAMPLES]
+    squares = np.zeros(len(chunk)+1, dtype=np.int64)
+    np.cumsum(chunk.astype(np.int64)**2, out=squares[1:])
+    sums += squares[np.clip(ends - chunk_start, 0, len(chunk))] - squares[np.clip(starts - chunk_start, 0, len(chunk))]
+  counts = ends - starts
+  rmsValues = np.where(counts>0, np.sqrt(sums / np.maximum(counts, 1).astype(np.float64)), 0).astype(np.int64).tolist()
+
+  if convert and not is_pcm:
+    write_pcm_wav(filePath, samples, channels, framerate)
 
   return seconds, rmsValues
+
+def pack_rms(rmsValues):
+  '''
+  Normalise rms values to the loudest section and quantize them to one byte each.
+  The envelope is stored as NUMBER_OF_AUDIO_FILE_BINS bytes instead of a JSON list of floats.
+  '''
+  values = np.asarray(rmsValues, dtype=np.float64)
+  peak = values.max() if len(values) else 0
+  if peak: # silent files stay at zero
+    values = values * (255.0 / peak)
+  return np.round(values).astype(np.uint8).tobytes()
@@ -0,0 +1,56 @@
+"""Benchmark settings: a throwaway SQLite database and data tree, see the benchmark command."""
+
+#local
+from woot.settings.common import *
+
+#util
+from os import environ
+import tempfile
+
+########## BENCHMARK CONFIGURATION
+# Everything the benchmark writes goes here. A new directory is used for each run unless BENCH_ROOT is set.
+BENCH_ROOT = environ.get('BENCH_ROOT') or tempfile.mkdtemp(prefix='woot-bench-')
+BENCH_DATA_DIR = join(BENCH_ROOT, 'data')
+########## END BENCHMARK CONFIGURATION
+
+
+########## DEBUG CONFIGURATION
+# See: https://docs.djangoproject.com/en/dev/ref/settings/#debug
+DEBUG = False
+
+# See: https://docs.djangoproject.com/en/dev/ref/settings/#template-debug
+TEMPLATE_DEBUG = DEBUG
+########## END DEBUG CONFIGURATION
+
+
+########## DATABASE CONFIGURATION
+# See: https://docs.djangoproject.com/en/dev/ref/settings/#databases
+DATABASES = {
+  'default': {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': join(BENCH_ROOT, 'bench.sqlite3'),
+    'OPTIONS': {'timeout':30}, #simulated transcribers write at the same time, see the loadtest command
+  }
+}
+########## END DATABASE CONFIGURATION
+
+
+########## AUTHENTICATION
+# Simulated transcribers log in with a password, which is not worth hashing slowly here
+PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',)
+
+# The test client calls itself testserver
+ALLOWED_HOSTS = ALLOWED_HOSTS + ['testserver']
+########## END AUTHENTICATION
+
+
+########## FILES
+MEDIA_ROOT = join(BENCH_ROOT, 'media')
+SCAN_MANIFEST = join(BENCH_ROOT, 'manifest.json')
+PIPELINE_CHECKPOINT = join(BENCH_ROOT, 'pipeline.json')
+########## END FILES
+
+
+########## CELERY CONFIGURATION
+CELERY_ALWAYS_EAGER = True
+########## END CELERY CONFIGURATION
@@ -7,6 +7,7 @@ from datetime import timedelta
 from os.path import abspath, basename, dirname, join, normpath
 from sys import path
 import string
+import os
 
 #third party
 from djcelery import setup_loader
@@ -20,6 +21,16 @@ NUMBER_OF_TRANSCRIPTIONS_PER_JOB = 20
 JOB_ID_CHARS = string.ascii_uppercase + string.digits
 JOB_ID_LENGTH = 8
 
+# id tokens checked against the database at a time by libs.utils.generate_id_token
+ID_TOKEN_POOL_SIZE = 100
+
+# Jobs are packed to about this many seconds of audio, with at most JOB_MAX_TRANSCRIPTIONS transcriptions.
+JOB_TARGET_DURATION = 90
+JOB_MAX_TRANSCRIPTIONS = NUMBER_OF_TRANSCRIPTIONS_PER_JOB*2
+
+# A claimed job returns to the pool after this many seconds without activity from its user.
+JOB_LEASE_DURATION = 60*30
+
 ########## TESTS
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
@@ -29,6 +40,35 @@ AUTH_USER_MODEL = 'users.User'
 ########## AUDIO
 NUMBER_OF_AUDIO_FILE_BINS = 100
 
+########## AUTOCOMPLETE
+# Seconds a project's autocomplete list stays cached. Entries are versioned, so this only bounds memory use.
+LEXICON_CACHE_TIMEOUT = 60*60*24
+
+# Projects with more words than this are autocompleted by /transcription/suggest/ instead of the lexicon.
+SUGGEST_THRESHOLD = 5000
+SUGGEST_RESULTS = 10
+SUGGEST_INDEX_SIZE = 100000 # most frequent words kept in each project's index
+SUGGEST_MAX_PROJECTS = 20 # indexes kept in memory by each process
+SUGGEST_MEMO_PREFIX_LENGTH = 3 # results for prefixes up to this length are memoized
+SUGGEST_REFRESH_INTERVAL = 30 # seconds between loading new words
+SUGGEST_REBUILD_INTERVAL = 60*10 # seconds between recounting frequencies
+
+########## WORDS
+WORD_INTERNER_PROJECTS = 10 # projects whose words are kept in memory by each process
+WORD_INTERNER_SIZE = 100000 # words kept in memory for each project
+
+########## EXPORT
+EXPORT_WORKERS = 4 # grammars exported at the same time by Client.export
+EXPORT_BUFFER_SIZE = 1024*1024 # bytes
+
+########## IMPORT
+# Number of transcriptions written per bulk insert when a relfile is processed
+RELFILE_CHUNK_SIZE = 500
+PROCESSING_CHUNK_SIZE = 200 # transcriptions per process_audio_chunk task
+
+# Number of processed transcriptions written back to the database per transaction
+TRANSCRIPTION_BATCH_SIZE = 100
+
 ########## ALLOWED HOSTS
 ALLOWED_HOSTS = [
   'localhost',
@@ -51,6 +91,20 @@ path.append(DJANGO_ROOT)
 ########## END PATH CONFIGURATION
 
 
+########## SCAN CONFIGURATION
+# Record of the data directory kept between scans so that only changes are read, see libs.manifest:
+SCAN_MANIFEST = normpath(join(DJANGO_ROOT, 'manifest.json'))
+########## END SCAN CONFIGURATION
+
+########## PIPELINE CONFIGURATION
+# When each stage of the run command last finished, see apps.distribution.pipeline:
+PIPELINE_CHECKPOINT = normpath(join(DJANGO_ROOT, 'pipeline.json'))
+
+# Number of projects (or grammars of one project) processed side by side by the run command
+PIPELINE_CONCURRENCY = 4
+########## END PIPELINE CONFIGURATION
+
+
 ########## DEBUG CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#debug
 DEBUG = False
@@ -180,6 +234,9 @@ TEMPLATE_DIRS = (
 ########## MIDDLEWARE CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#middleware-classes
 MIDDLEWARE_CLASSES = (
+  # Request timing and queries, only used when PROFILING_ENABLED is set. First, so that it times everything below it.
+  'libs.profiling.ProfilingMiddleware',
+
   # Use GZip compression to reduce bandwidth.
   'django.middleware.gzip.GZipMiddleware',
 
@@ -196,6 +253,23 @@ MIDDLEWARE_CLASSES = (
 ########## END MIDDLEWARE CONFIGURATION
 
 
+########## PROFILING CONFIGURATION
+# Record the time and queries of every request, see libs.profiling
+PROFILING_ENABLED = bool(os.getenv('PROFILING_ENABLED'))
+
+# Requests kept in memory by each process for /profiling/
+PROFILING_BUFFER_SIZE = 500
+
+# Repeated statements listed per request
+PROFILING_DUPLICATES = 5
+
+# The records are also written as JSON lines to a log rotated at PROFILING_LOG_MAX_BYTES
+PROFILING_LOG = normpath(join(DJANGO_ROOT, 'profiling.jsonl'))
+PROFILING_LOG_MAX_BYTES = 10*1024*1024
+PROFILING_LOG_BACKUPS = 5
+########## END PROFILING CONFIGURATION
+
+
 ########## URL CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#root-urlconf
 ROOT_URLCONF = '%s.urls' % SITE_NAME
@@ -257,6 +331,11 @@ LOGGING = {
       '()': 'django.utils.log.RequireDebugFalse'
     }
   },
+  'formatters': {
+    'message': {
+      'format': '%(message)s'
+    }
+  },
   'handlers': {
     'mail_admins': {
       'level': 'ERROR',
@@ -266,6 +345,15 @@ LOGGING = {
     'console': {
       'level': 'DEBUG',
       'class': 'logging.StreamHandler'
+    },
+    'profiling': {
+      'level': 'INFO',
+      'class': 'logging.handlers.RotatingFileHandler',
+      'filename': PROFILING_LOG,
+      'maxBytes': PROFILING_LOG_MAX_BYTES,
+      'backupCount': PROFILING_LOG_BACKUPS,
+      'delay': True, #the file is only created once something is written to it
+      'formatter': 'message'
     }
   },
   'loggers': {
@@ -274,6 +362,11 @@ LOGGING = {
       'level': 'ERROR',
       'propagate': True,
     },
+    'profiling': {
+      'handlers': ['profiling'],
+      'level': 'INFO',
+      'propagate': False,
+    },
   }
 }
 ########## END LOGGING CONFIGURATION
@@ -323,6 +416,23 @@ CELERY_TASK_RESULT_EXPIRES = timedelta(minutes=30)
 # See: http://docs.celeryproject.org/en/master/configuration.html#std:setting-CELERY_CHORD_PROPAGATES
 CELERY_CHORD_PROPAGATES = True
 
+# Worker processes per celery worker, i.e. how many audio chunks one machine processes at once.
+# See: http://celery.readthedocs.org/en/latest/configuration.html#celeryd-concurrency
+CELERYD_CONCURRENCY = int(os.getenv('CELERYD_CONCURRENCY', 4))
+
+# Run tasks in the calling process, without a broker. Chords run end to end as well.
+# See: http://celery.readthedocs.org/en/latest/configuration.html#celery-always-eager
+CELERY_ALWAYS_EAGER = os.getenv('CELERY_ALWAYS_EAGER') in ('1', 'true', 'True') # so that CELERY_ALWAYS_EAGER=0 turns it off
+CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+
+# See: http://docs.celeryproject.org/en/latest/userguide/periodic-tasks.html
+CELERYBEAT_SCHEDULE = {
+  'reclaim-jobs': {
+    'task': 'apps.distribution.tasks.reclaim_jobs',
+    'schedule': timedelta(seconds=60),
+  },
+}
+
 # See: http://celery.github.com/celery/django/
 setup_loader()
 ########## END CELERY CONFIGURATION
@@ -6,7 +6,7 @@ from django.conf.urls import patterns, include, url
 from settings.common import MEDIA_ROOT
 
 #local
-from apps.pages.views import LoginView, StartView, logout_view
+from apps.pages.views import LoginView, StartView, logout_view, profiling_view
 
 #third party
 
@@ -30,6 +30,7 @@ urlpatterns = patterns('',
 
   #admin
   url(r'^admin/', include(admin.site.urls)),
+  url(r'^profiling/$', profiling_view),
 )
 
 #1. make users